@@ -6,6 +6,7 @@ from setuptools import find_packages
 from setuptools import Extension
 
 PYPY = hasattr(sys, 'pypy_version_info')
+LINUX = sys.platform.startswith('linux')
 
 def read(fname, here=os.path.dirname(__file__)):
     with open(os.path.join(here, fname), encoding='utf-8') as f:
@@ -79,7 +80,9 @@ if not PYPY:
     # (Not that this actually appears to do anything right now.)
 
     for mod_name, deps in (
-        ('metric', ()),
+        ('statsd', ()),
+        ('clientstack', ('statsd',)),
+        ('metric', ('statsd', 'clientstack')),
     ):
         deps = ([_py_source(mod) for mod in deps]
                 + [_pxd(mod) for mod in deps]
@@ -100,6 +103,16 @@ if not PYPY:
                 define_macros=[('CYTHON_TRACE', '0')],
             ))
 
+    # Linux-only helpers that are not accelerated Python modules,
+    # and thus have no pure-Python counterpart.
+    if LINUX:
+        ext_modules.append(
+            Extension(
+                'perfmetrics._sendmmsg',
+                sources=[_source('_sendmmsg', 'pyx')],
+                define_macros=[('CYTHON_TRACE', '0'), ('_GNU_SOURCE', '1')],
+            ))
+
     try:
         ext_modules = cythonize(
             ext_modules,
@@ -125,7 +138,7 @@ if not PYPY:
 
 setup(
     name='perfmetrics',
-    version='4.3.1.dev0',
+    version='4.4.0.dev0',
     author='Shane Hathaway',
     author_email='shane@hathawaymix.org',
     maintainer='Jason Madden',
@@ -178,5 +191,6 @@ setup(
     entry_points="""\
     [paste.filter_app_factory]
     statsd = perfmetrics:make_statsd_app
+    prometheus = perfmetrics.prometheus:make_prometheus_app
     """,
 )
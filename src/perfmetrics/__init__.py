@@ -15,8 +15,8 @@ from .clientstack import set_statsd_client
 from .clientstack import client_stack as statsd_client_stack
 
 
-from .statsd import statsd_client_from_uri
 from .statsd import StatsdClient
+from .transports import statsd_client_from_uri
 
 from .metric import Metric
 from .metric import MetricMod
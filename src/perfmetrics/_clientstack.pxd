@@ -0,0 +1,23 @@
+# definitions for clientstack.py
+
+import cython
+
+cdef threading
+cdef ContextVar
+cdef statsd_client_from_uri
+cdef object _global_client
+
+
+cdef class _AbstractClientStack(object):
+    cpdef get(self)
+    cpdef push(self, obj)
+    cpdef pop(self)
+    cpdef clear(self)
+
+
+cdef class ClientStack(_AbstractClientStack):
+    cdef object _local
+
+
+cdef class ContextClientStack(_AbstractClientStack):
+    cdef object _frames
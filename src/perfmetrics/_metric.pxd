@@ -2,16 +2,48 @@
 
 import cython
 
-cdef time
+from perfmetrics._clientstack cimport _AbstractClientStack
+
+cdef isasyncgenfunction
+cdef iscoroutinefunction
+cdef isgeneratorfunction
+cdef log
+cdef log1p
+cdef perf_counter_ns
 cdef MethodType
 cdef WeakKeyDictionary
 cdef functools
 cdef stdrandom
+cdef warnings
+cdef ContextClientStack
 
-cdef statsd_client
-cdef statsd_client_stack
-cdef StatsdClientMod
+cdef _AbstractClientStack statsd_client_stack
+cdef _compose_mod
 cdef null_client
+cdef _PreciseMilliseconds
+cdef _tag_items
+cdef is_coroutine_function
+cdef mark_coroutine_function
+cdef _TIMING_KINDS
+cdef _SAMPLING_KINDS
+cdef double _MAX_INTERVAL
+
+cdef _incr(client, str stat, double rate, buf, tuple tags)
+cdef dict _error_stats
+cdef str _count_error(client, str stat, failure, bint error_types, double rate, list buf,
+                      tuple tags)
+cdef object _elapsed_ms(client, str kind, long long elapsed_ns, bint precise)
+cdef _timing(client, str kind, str stat, long long elapsed_ns, bint precise,
+             double rate, buf, tuple tags)
+
+cdef class _Sampler(object):
+    cdef readonly str kind
+    cdef random
+    cdef long long _countdown
+
+    cdef long long _next_countdown(self, double rate) except? -1
+    cdef double sampled_rate(self, double rate) except? -1.0
+
 
 cdef class _MethodLikeMixin(object):
     pass
@@ -20,12 +52,25 @@ cdef class _AbstractMetricImpl(_MethodLikeMixin):
     cdef public bint metric_timing
     cdef public bint metric_count
     cdef public double metric_rate
+    cdef public tuple metric_tags
+    cdef public str metric_kind
+    cdef public bint metric_precise
+    cdef readonly unsigned long long metric_calls
+    cdef public bint metric_errors
+    cdef public bint metric_error_types
     cdef  f
     cdef str timing_format
+    cdef _Sampler _sampler
     cdef public __wrapped__
     cdef dict __dict__
 
     cdef str _compute_stat(self, tuple args)
+    cdef _call_with_outcome(self, client, str stat, double rate, tuple args, dict kwargs)
+    cdef _report_outcome(self, client, str stat, double rate, list buf,
+                         long long elapsed_ns, failure)
+    cdef _call_iterator(self, tuple args, dict kwargs, bint is_async)
+    cdef _iterated(self, client, str stat, double rate, list buf,
+                   long long elapsed_ns, long long first_ns, Py_ssize_t items, failure)
 
 
 cdef class _GivenStatMetricImpl(_AbstractMetricImpl):
@@ -35,14 +80,54 @@ cdef class _MethodMetricImpl(_AbstractMetricImpl):
 
     cdef klass_dict
 
+cdef class _AsyncGivenStatMetricImpl(_GivenStatMetricImpl):
+    pass
+
+cdef class _AsyncMethodMetricImpl(_MethodMetricImpl):
+    pass
+
+cdef class _GeneratorGivenStatMetricImpl(_GivenStatMetricImpl):
+    pass
+
+cdef class _GeneratorMethodMetricImpl(_MethodMetricImpl):
+    pass
+
+cdef class _AsyncGeneratorGivenStatMetricImpl(_GivenStatMetricImpl):
+    pass
+
+cdef class _AsyncGeneratorMethodMetricImpl(_MethodMetricImpl):
+    pass
+
 
 cdef class Metric(object):
     cdef public double rate
-    cdef double start
+    cdef long long start
     cdef public bint method
     cdef public bint count
     cdef public bint timing
     cdef public str stat
     cdef public str timing_format
+    cdef public tuple tags
+    cdef public str kind
+    cdef public bint precise
+    cdef readonly str sampling
+    cdef public bint errors
+    cdef public bint error_types
+    cdef _Sampler _sampler
     cdef random
     cdef dict __dict__
+
+
+cdef class MetricMod(object):
+    cdef public str format
+    cdef public tuple tags
+    cdef dict _mods
+
+    cdef _mod(self, client)
+
+
+cdef class _MetricModImpl(_MethodLikeMixin):
+    cdef MetricMod mod
+    cdef f
+    cdef public __wrapped__
+    cdef dict __dict__
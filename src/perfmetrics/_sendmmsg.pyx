@@ -0,0 +1,106 @@
+# cython: auto_pickle=False,embedsignature=True,always_allow_keywords=False
+# -*- coding: utf-8 -*-
+"""
+Send many datagrams with one system call using Linux's ``sendmmsg(2)``.
+
+This is only compiled on Linux. See
+:meth:`perfmetrics.statsd.StatsdClient.send_packets`.
+"""
+from cpython.bytes cimport PyBytes_AS_STRING
+from cpython.bytes cimport PyBytes_GET_SIZE
+from libc.errno cimport errno
+from libc.stdlib cimport calloc
+from libc.stdlib cimport free
+
+from os import strerror
+
+cdef extern from "<sys/uio.h>" nogil:
+    struct iovec:
+        void* iov_base
+        size_t iov_len
+
+cdef extern from "<sys/socket.h>" nogil:
+    ctypedef unsigned int socklen_t
+
+    struct msghdr:
+        void* msg_name
+        socklen_t msg_namelen
+        iovec* msg_iov
+        size_t msg_iovlen
+        void* msg_control
+        size_t msg_controllen
+        int msg_flags
+
+    struct mmsghdr:
+        msghdr msg_hdr
+        unsigned int msg_len
+
+    int c_sendmmsg "sendmmsg" (int sockfd, mmsghdr* msgvec, unsigned int vlen, int flags)
+
+cdef enum:
+    # The kernel refuses to handle more than UIO_MAXIOV messages at once.
+    MAX_BATCH = 1024
+
+
+def sendmmsg(int fd, packets, bytes address):
+    """
+    sendmmsg(fd, packets, address) -> int
+
+    Send each byte string in the sequence *packets* as its own
+    datagram on the socket file descriptor *fd* to *address*, a
+    packed ``struct sockaddr``.
+
+    Returns the number of packets sent, which is less than
+    ``len(packets)`` only if the socket is non-blocking and its
+    buffer filled up. Raises :exc:`OSError` if nothing could be sent.
+    """
+    # Keep our own references; the pointers we hand the kernel
+    # must stay valid while we don't hold the GIL.
+    cdef tuple datagrams = tuple(packets)
+    cdef Py_ssize_t count = len(datagrams)
+    cdef Py_ssize_t sent = 0
+    cdef Py_ssize_t i
+    cdef unsigned int batch
+    cdef int result
+    cdef int error
+    cdef bytes packet
+    cdef mmsghdr* msgs
+    cdef iovec* iovs
+
+    if count == 0:
+        return 0
+
+    batch = <unsigned int>(count if count < MAX_BATCH else MAX_BATCH)
+    msgs = <mmsghdr*>calloc(batch, sizeof(mmsghdr))
+    iovs = <iovec*>calloc(batch, sizeof(iovec))
+    if msgs is NULL or iovs is NULL:
+        free(msgs)
+        free(iovs)
+        raise MemoryError()
+
+    try:
+        while sent < count:
+            batch = <unsigned int>(count - sent if count - sent < MAX_BATCH else MAX_BATCH)
+            for i in range(batch):
+                packet = datagrams[sent + i]
+                iovs[i].iov_base = PyBytes_AS_STRING(packet)
+                iovs[i].iov_len = PyBytes_GET_SIZE(packet)
+                msgs[i].msg_hdr.msg_name = PyBytes_AS_STRING(address)
+                msgs[i].msg_hdr.msg_namelen = <socklen_t>PyBytes_GET_SIZE(address)
+                msgs[i].msg_hdr.msg_iov = &iovs[i]
+                msgs[i].msg_hdr.msg_iovlen = 1
+            with nogil:
+                result = c_sendmmsg(fd, msgs, batch, 0)
+                error = errno
+            if result < 0:
+                if sent:
+                    break
+                raise OSError(error, strerror(error))
+            sent += result
+            if <unsigned int>result < batch:
+                # A full non-blocking socket.
+                break
+    finally:
+        free(msgs)
+        free(iovs)
+    return sent
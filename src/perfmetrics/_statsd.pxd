@@ -0,0 +1,48 @@
+# definitions for statsd.py
+
+import cython
+
+cdef monotonic
+
+cdef bytes _make_timing_format(str unit, int precision)
+
+cdef class _AbstractStatsdClient(object):
+    cdef public str prefix
+    cdef public random
+    cdef readonly str timing_unit
+    cdef readonly int timing_precision
+    cdef readonly bint fractional_timing
+    cdef bytes _timing_format
+    cdef bytes _precise_timing_format
+    cdef int _timing_scale
+    cdef dict _stat_cache
+    cdef dict _tag_cache
+    cdef dict __dict__
+    cdef object __weakref__
+
+    cdef bytes _encode_stat(self, str stat)
+    cdef bytes _encode_tags(self, tags)
+
+
+cdef class StatsdClient(_AbstractStatsdClient):
+    cdef public udp_sock
+    cdef public addr
+    cdef public Py_ssize_t packet_size
+    cdef public double flush_interval
+    cdef public Py_ssize_t queue_size
+    cdef public _queue
+
+
+cdef class StatsdClientMod(object):
+    cdef public _wrapped
+    cdef public str format
+    cdef public tuple tags
+    cdef dict _stat_cache
+
+    cdef _tags(self, tags)
+    cdef str _format(self, stat)
+
+
+@cython.locals(mod=StatsdClientMod, recipe=tuple)
+cpdef StatsdClientMod _compose_mod(client, str format, tags, dict mods=*)
+cdef tuple _mod_recipe(client, str format, tags)
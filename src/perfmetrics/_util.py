@@ -7,8 +7,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import logging
 import os
 import sys
+import weakref
 
 PY3 = sys.version_info[0] >= 3
 PYPY = hasattr(sys, 'pypy_version_info')
@@ -19,6 +21,58 @@ OSX = sys.platform == 'darwin'
 
 PURE_PYTHON = PYPY or os.getenv('PURE_PYTHON') or os.getenv("PERFMETRICS_PURE_PYTHON")
 
+#: Objects whose ``_after_fork`` method must run in a child process
+#: after ``fork()``.
+_fork_reinit = weakref.WeakSet()
+
+def reinit_after_fork(obj):
+    """
+    Arrange for ``obj._after_fork()`` to be called in the child
+    process after the current process forks.
+
+    Objects that own sockets, background threads, or buffered
+    metrics use this to replace what they inherited, so the parent
+    and child don't share a socket or send the same metrics twice.
+    """
+    _fork_reinit.add(obj)
+
+def _after_fork_in_child():
+    for obj in list(_fork_reinit):
+        try:
+            obj._after_fork() # pylint:disable=protected-access
+        except Exception: # pylint:disable=broad-except
+            logging.getLogger(__name__).exception(
+                "Failed to reinitialize %r after fork", obj)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+def mark_coroutine_function(obj):
+    """
+    Make `inspect.iscoroutinefunction` (on Python 3.12 and later) and
+    `asyncio.iscoroutinefunction` true for *obj*, a callable object
+    that returns a coroutine. Returns *obj*.
+    """
+    import inspect
+    if hasattr(inspect, 'markcoroutinefunction'):
+        return inspect.markcoroutinefunction(obj)
+    from asyncio import coroutines
+    obj._is_coroutine = coroutines._is_coroutine # pylint:disable=protected-access
+    return obj
+
+def is_coroutine_function(obj):
+    """
+    Is *obj* a coroutine function, or was it passed to
+    `mark_coroutine_function`?
+    """
+    import inspect
+    if inspect.iscoroutinefunction(obj):
+        return True
+    # Marked before Python 3.12.
+    from asyncio import coroutines
+    marker = coroutines._is_coroutine # pylint:disable=protected-access
+    return getattr(obj, '_is_coroutine', None) is marker
+
 def import_c_accel(globs, cname):
     """
     Import the C-accelerator for the __name__
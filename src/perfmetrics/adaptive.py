@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive sampling.
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import threading
+
+from time import monotonic
+
+from ._util import reinit_after_fork
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    'AdaptiveSampler',
+]
+
+
+def _metric_impl(func):
+    # Find the object returned by a Metric decorator, looking through
+    # wrappers such as MetricMod.
+    while func is not None:
+        if hasattr(func, 'metric_rate') and hasattr(func, 'metric_calls'):
+            return func
+        func = getattr(func, '__wrapped__', None)
+    return None
+
+
+def _metric_name(impl):
+    name = getattr(impl, 'stat_name', None)
+    if name:
+        return name
+    # A metricmethod; its stat names depend on the class.
+    f = impl.__wrapped__
+    return '%s.%s' % (f.__module__, getattr(f, '__qualname__', f.__name__))
+
+
+class _Observed(object):
+    __slots__ = (
+        'impl',
+        'calls',
+        'frequency',
+    )
+
+    def __init__(self, impl):
+        self.impl = impl
+        self.calls = impl.metric_calls
+        self.frequency = None
+
+
+class AdaptiveSampler(object):
+    """
+    Adjust the ``metric_rate`` of functions decorated with
+    `perfmetrics.Metric` so that, together, they send at most
+    *budget* packets per second.
+
+    Register each decorated function with :meth:`register` (which
+    can also be used as a decorator, above the `~perfmetrics.Metric`
+    decorator). Every *interval* seconds, a background daemon thread
+    calls :meth:`adjust`, which measures how often each function was
+    called and shares the budget among them: functions called less
+    often than their fair share are recorded on every call, and the
+    remaining budget is divided equally among the busier ones, whose
+    rates are lowered accordingly (but never below *min_rate*). Call
+    frequencies are smoothed between intervals with weight
+    *smoothing* given to the newest measurement.
+
+    Each recorded call counts as one packet (the counter and timer
+    of a call are sent together). The rates are reported with each
+    metric, so Statsd extrapolates counts correctly as they change.
+    This works best with ``Metric(sampling='counter')`` or
+    ``sampling='geometric'``, which make ignored calls very cheap.
+
+    If *interval* is 0, no thread is started and the application must
+    call :meth:`adjust` itself.
+
+    .. versionadded:: 4.4.0
+    """
+
+    def __init__(self, budget, interval=1.0, min_rate=0.0001, smoothing=0.5):
+        self.budget = float(budget)
+        self.interval = float(interval)
+        self.min_rate = float(min_rate)
+        self.smoothing = float(smoothing)
+        self.clock = monotonic  # Testing hook
+        self._lock = threading.Lock()
+        self._observed = {}
+        self._last_adjusted = self.clock()
+        self._stopped = threading.Event()
+        self._thread = None
+        if self.interval > 0:
+            self._start_thread()
+        reinit_after_fork(self)
+
+    def _start_thread(self):
+        self._thread = threading.Thread(
+            target=self._adjust_periodically,
+            name='perfmetrics-adaptive',
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _after_fork(self):
+        # In a forked child; the thread didn't survive.
+        self._lock = threading.Lock()
+        if self._thread is not None:
+            self._start_thread()
+
+    def _adjust_periodically(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.adjust()
+            except Exception: # pylint:disable=broad-except
+                logger.exception("Failed to adjust sampling rates")
+
+    def close(self):
+        """
+        Stop the background thread. The rates are left as they are.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def register(self, func):
+        """
+        Start managing the rate of *func*, a function decorated with
+        `perfmetrics.Metric`. Returns *func*.
+        """
+        impl = _metric_impl(func)
+        if impl is None:
+            raise TypeError("%r was not decorated with Metric" % (func,))
+        with self._lock:
+            self._observed[_metric_name(impl)] = _Observed(impl)
+        return func
+
+    def unregister(self, func):
+        """
+        Stop managing the rate of *func*. Its rate is left as it is.
+        """
+        impl = _metric_impl(func)
+        if impl is not None:
+            with self._lock:
+                self._observed.pop(_metric_name(impl), None)
+
+    @property
+    def rates(self):
+        """
+        A dictionary mapping the name of each registered function's
+        metric to its current sample rate.
+        """
+        with self._lock:
+            return {
+                name: observed.impl.metric_rate
+                for name, observed in self._observed.items()
+            }
+
+    @property
+    def frequencies(self):
+        """
+        A dictionary mapping the name of each registered function's
+        metric to its (smoothed) calls per second, as of the last
+        adjustment. Functions that haven't been measured yet are
+        omitted.
+        """
+        with self._lock:
+            return {
+                name: observed.frequency
+                for name, observed in self._observed.items()
+                if observed.frequency is not None
+            }
+
+    def adjust(self):
+        """
+        Measure the call frequencies since the last adjustment and
+        update the rates.
+        """
+        with self._lock:
+            now = self.clock()
+            elapsed = now - self._last_adjusted
+            if elapsed <= 0:
+                return
+            self._last_adjusted = now
+
+            alpha = self.smoothing
+            for observed in self._observed.values():
+                calls = observed.impl.metric_calls
+                frequency = (calls - observed.calls) / elapsed
+                observed.calls = calls
+                if observed.frequency is not None:
+                    frequency = alpha * frequency + (1 - alpha) * observed.frequency
+                observed.frequency = frequency
+
+            # Water-filling: visit the functions from the least to the
+            # most frequently called, giving each the smaller of its
+            # demand and an equal share of what's left.
+            remaining = self.budget
+            pending = sorted(self._observed.values(), key=lambda o: o.frequency)
+            count = len(pending)
+            for observed in pending:
+                share = remaining / count
+                count -= 1
+                frequency = observed.frequency
+                if frequency <= share:
+                    rate = 1.0
+                    remaining -= frequency
+                else:
+                    rate = max(share / frequency, self.min_rate)
+                    remaining -= share
+                observed.impl.metric_rate = rate
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Client-side aggregation of metrics.
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import random
+import threading
+
+from .interfaces import IStatsdClient
+from .interfaces import implementer
+from .statsd import _tag_items
+from ._util import reinit_after_fork
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    'AggregatingStatsdClient',
+]
+
+
+def _key(stat, tags):
+    # Metrics with different tags are aggregated separately.
+    return (stat, _tag_items(tags)) if tags else (stat, None)
+
+
+def _number(value):
+    # Extrapolated values are floats; don't send "3.0" when "3" will do.
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+class _TimerStats(object):
+    __slots__ = (
+        'count',
+        'total',
+        'lower',
+        'upper',
+        'samples',
+        'seen',
+    )
+
+    def __init__(self, value):
+        self.count = 0
+        self.total = 0
+        self.lower = value
+        self.upper = value
+        self.samples = []
+        self.seen = 0
+
+
+@implementer(IStatsdClient)
+class AggregatingStatsdClient(object):
+    """
+    Aggregate metrics in memory and periodically send summaries
+    to another client.
+
+    Instead of sending one line for each call, this client keeps
+    running totals: counters are summed, gauges keep their last
+    value, sets keep their unique values, and timers are reduced to
+    their count, sum, minimum, maximum and upper *percentile*. Every
+    *flush_interval* seconds a background thread sends the results
+    through *client* (usually a `perfmetrics.statsd.StatsdClient`)
+    and resets them.
+
+    Timers are reported as ``<stat>.count`` (a counter) and
+    ``<stat>.sum``, ``<stat>.lower``, ``<stat>.upper`` and
+    ``<stat>.upper_<percentile>`` (gauges), using the same names the
+    statsd Graphite backend uses. The percentile is estimated from a
+    random sample of at most *max_samples* values per timer.
+
+    Sampled metrics (those with a *rate* less than 1) are extrapolated
+    when they are recorded, so the reported counts remain correct.
+
+    Metrics with the same name but different *tags* are aggregated
+    separately, and their summaries carry the tags. Histograms and
+    distributions are computed by the server and are sent through
+    *client* immediately.
+
+    Because many lines are produced at once, *client* should
+    coalesce them into reasonably sized packets; see the
+    *packet_size* parameter of `perfmetrics.statsd.StatsdClient`.
+    `perfmetrics.statsd_client_from_uri` does this automatically
+    when given the ``aggregate_interval`` query parameter.
+
+    If *flush_interval* is 0, no thread is started and the
+    application must call :meth:`flush` itself.
+
+    After ``fork()``, the child process starts over with empty
+    aggregates (the parent reports what came before) and its own
+    thread.
+
+    .. versionadded:: 4.4.0
+    """
+
+    def __init__(self, client, flush_interval=10.0, percentile=90,
+                 max_samples=1024):
+        self.client = client
+        self.flush_interval = float(flush_interval)
+        self.percentile = int(percentile)
+        self.max_samples = int(max_samples)
+        self.random = random.random  # Testing hook
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._sets = {}
+        self._timers = {}
+        self._stopped = threading.Event()
+        self._thread = None
+        if self.flush_interval > 0:
+            self._start_thread()
+        reinit_after_fork(self)
+
+    def _start_thread(self):
+        self._thread = threading.Thread(
+            target=self._flush_periodically,
+            name='perfmetrics-aggregate',
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _after_fork(self):
+        # In a forked child. The parent reports what was aggregated
+        # before the fork.
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._sets = {}
+        self._timers = {}
+        if self._thread is not None:
+            self._start_thread()
+
+    def _flush_periodically(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception: # pylint:disable=broad-except
+                logger.exception("Failed to flush aggregated metrics")
+
+    def close(self):
+        """
+        Stop the background thread, send the remaining metrics, and
+        close the underlying client.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        self.client.close()
+
+    def flush(self):
+        """
+        Send the metrics aggregated so far and start over.
+        """
+        with self._lock:
+            counters = self._counters
+            gauges = self._gauges
+            sets = self._sets
+            timers = self._timers
+            self._counters = {}
+            self._gauges = {}
+            self._sets = {}
+            self._timers = {}
+
+        client = self.client
+        buf = []
+        for (stat, tags), count in counters.items():
+            client.incr(stat, _number(count), buf=buf, tags=tags)
+        for (stat, tags), value in gauges.items():
+            client.gauge(stat, value, buf=buf, tags=tags)
+        for (stat, tags), values in sets.items():
+            for value in values:
+                client.set_add(stat, value, buf=buf, tags=tags)
+        for (stat, tags), timer in timers.items():
+            client.incr(stat + '.count', _number(timer.count), buf=buf, tags=tags)
+            client.gauge(stat + '.sum', _number(timer.total), buf=buf, tags=tags)
+            client.gauge(stat + '.lower', timer.lower, buf=buf, tags=tags)
+            client.gauge(stat + '.upper', timer.upper, buf=buf, tags=tags)
+            samples = sorted(timer.samples)
+            index = max(int(round(self.percentile / 100.0 * len(samples))), 1)
+            client.gauge('%s.upper_%d' % (stat, self.percentile),
+                         samples[index - 1], buf=buf, tags=tags)
+        if buf:
+            client.sendbuf(buf)
+        client.flush()
+
+    def timing(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.timing`.
+        """
+        # pylint:disable=unused-argument
+        if rate >= 1:
+            weight = 1
+        elif rate_applied or self.random() < rate:
+            weight = 1.0 / rate
+        else:
+            return
+
+        key = _key(stat, tags)
+        with self._lock:
+            timer = self._timers.get(key)
+            if timer is None:
+                timer = self._timers[key] = _TimerStats(value)
+            timer.count += weight
+            timer.total += value * weight
+            if value < timer.lower:
+                timer.lower = value
+            elif value > timer.upper:
+                timer.upper = value
+            # Reservoir sampling keeps an unbiased sample for the
+            # percentile in bounded memory.
+            timer.seen += 1
+            if len(timer.samples) < self.max_samples:
+                timer.samples.append(value)
+            else:
+                index = int(self.random() * timer.seen)
+                if index < self.max_samples:
+                    timer.samples[index] = value
+
+    def gauge(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.gauge`.
+        """
+        # pylint:disable=unused-argument
+        if rate >= 1 or rate_applied or self.random() < rate:
+            key = _key(stat, tags)
+            with self._lock:
+                self._gauges[key] = value
+
+    def incr(self, stat, count=1, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.incr`.
+        """
+        # pylint:disable=unused-argument
+        if rate < 1:
+            if not rate_applied and self.random() >= rate:
+                return
+            count /= rate
+
+        key = _key(stat, tags)
+        with self._lock:
+            counters = self._counters
+            counters[key] = counters.get(key, 0) + count
+
+    def decr(self, stat, count=1, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.decr`.
+        """
+        self.incr(stat, -count, rate=rate, buf=buf, rate_applied=rate_applied,
+                  tags=tags)
+
+    def set_add(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.set_add`.
+        """
+        # pylint:disable=unused-argument
+        if rate >= 1 or rate_applied or self.random() < rate:
+            key = _key(stat, tags)
+            with self._lock:
+                values = self._sets.get(key)
+                if values is None:
+                    values = self._sets[key] = set()
+                values.add(value)
+
+    def histogram(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.histogram`.
+
+        Histograms are computed by the server, so they are passed to
+        the underlying client without being aggregated here.
+        """
+        self.client.histogram(stat, value, rate, buf, rate_applied, tags)
+
+    def distribution(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.distribution`.
+
+        Distributions are aggregated globally by the server, so they
+        are passed to the underlying client without being aggregated
+        here.
+        """
+        self.client.distribution(stat, value, rate, buf, rate_applied, tags)
+
+    def sendbuf(self, buf):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.sendbuf`.
+
+        Metrics recorded through this object are never added to a
+        *buf*, so this only forwards lines that were produced
+        elsewhere.
+        """
+        if buf:
+            self.client.sendbuf(buf)
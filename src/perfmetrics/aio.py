@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio integration.
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import asyncio
+import logging
+from collections import deque
+
+from .interfaces import IStatsdClient
+from .interfaces import implementer
+from .statsd import _AbstractStatsdClient
+from .statsd import _encoded_lines
+from .statsd import _iter_packets
+from ._util import reinit_after_fork
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    'AsyncStatsdClient',
+]
+
+
+class _StatsdProtocol(asyncio.DatagramProtocol):
+
+    def error_received(self, exc):
+        logger.debug("Failed to send UDP packet: %s", exc)
+
+
+@implementer(IStatsdClient)
+class AsyncStatsdClient(_AbstractStatsdClient):
+    """
+    Send packets to statsd from an asyncio event loop without
+    blocking.
+
+    The metric methods only append lines to an in-memory queue. A
+    task running in the event loop wakes up every *flush_interval*
+    seconds, coalesces the queued lines into datagrams of at most
+    *packet_size* bytes, and writes them to an
+    :class:`asyncio.DatagramTransport`.
+
+    The client must be started from a coroutine running in the event
+    loop, either with :meth:`start` and :meth:`stop` or by using it as
+    an asynchronous context manager::
+
+        async def main():
+            async with AsyncStatsdClient('localhost', 8125) as client:
+                set_statsd_client(client)
+                ...
+
+    If the loop shuts down while the client is running (for example,
+    at the end of :func:`asyncio.run`), the flushing task is cancelled
+    and the client sends what remains in the queue and closes the
+    transport.
+
+    Before the client is started, and after it is stopped, lines
+    accumulate in the queue. At most *max_queue* lines are kept; when
+    the queue is full, the oldest lines are discarded and counted in
+    the ``dropped`` attribute.
+
+    *timing_unit* and *timing_precision* are as for
+    `perfmetrics.statsd.StatsdClient`.
+
+    .. versionadded:: 4.4.0
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='',
+                 packet_size=1432, flush_interval=0.1, max_queue=10000,
+                 timing_unit='ms', timing_precision=0):
+        super().__init__(prefix, timing_unit, timing_precision)
+        self.host = host
+        self.port = int(port)
+        self.packet_size = int(packet_size)
+        self.flush_interval = float(flush_interval)
+        self.dropped = 0
+        self._queue = deque(maxlen=int(max_queue))
+        self._transport = None
+        self._task = None
+        reinit_after_fork(self)
+
+    def _after_fork(self):
+        # In a forked child. The queued lines belong to the parent.
+        # (Event loops can't be used across fork(), so the child
+        # must start the client again in its own loop.)
+        self._queue.clear()
+        self.dropped = 0
+
+    async def start(self):
+        """
+        Connect the transport and start the flushing task in the
+        running event loop.
+        """
+        if self._task is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self._transport, _ = await loop.create_datagram_endpoint(
+            _StatsdProtocol,
+            remote_addr=(self.host, self.port))
+        self._task = loop.create_task(self._flush_periodically())
+
+    async def stop(self):
+        """
+        Stop the flushing task, send the queued lines, and close the
+        transport.
+        """
+        task = self._task
+        if task is None:
+            return
+        self._task = None
+        task.cancel()
+        await asyncio.wait((task,))
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, _typ, _value, _tb):
+        await self.stop()
+
+    async def _flush_periodically(self):
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                self.flush()
+        finally:
+            self._close_transport()
+
+    def _close_transport(self):
+        self.flush()
+        transport = self._transport
+        self._transport = None
+        if transport is not None:
+            transport.close()
+
+    def close(self):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.close`.
+
+        Prefer :meth:`stop` when called from a coroutine.
+        """
+        task = self._task
+        self._task = None
+        if task is not None:
+            task.cancel()
+        self._close_transport()
+
+    def flush(self):
+        """
+        Write the queued lines to the transport.
+
+        This does nothing if the client hasn't been started.
+        """
+        transport = self._transport
+        queue = self._queue
+        if transport is None or not queue:
+            return
+        lines = [queue.popleft() for _ in range(len(queue))]
+        for packet in _iter_packets(lines, self.packet_size):
+            transport.sendto(packet)
+
+    def _send(self, data):
+        queue = self._queue
+        if len(queue) == queue.maxlen:
+            self.dropped += 1
+        queue.append(data)
+
+    def sendbuf(self, buf):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.sendbuf`.
+
+        The lines are queued individually so they can be divided
+        among packets.
+        """
+        if buf:
+            buf = _encoded_lines(buf)
+            queue = self._queue
+            overflow = len(queue) + len(buf) - queue.maxlen
+            if overflow > 0:
+                self.dropped += overflow
+            queue.extend(buf)
@@ -1,17 +1,60 @@
+# cython: auto_pickle=False,embedsignature=True,always_allow_keywords=False
 # -*- coding: utf-8 -*-
+"""
+Stacks of statsd clients.
+
+"""
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
 import threading
+from contextvars import ContextVar
 
-from .statsd import statsd_client_from_uri
+from .transports import statsd_client_from_uri
 
 string_types = (str,)
 if str is bytes: # pragma: no cover
     string_types += (unicode,) # pylint:disable=undefined-variable
 
-class ClientStack(threading.local):
+#: The global client, set by `set_statsd_client`.
+_global_client = None
+
+
+class _ThreadStack(threading.local):
+    # The stack of a ClientStack for each thread.
+
+    def __init__(self):
+        threading.local.__init__(self) # pylint:disable=non-parent-init-called
+        self.stack = []
+
+
+class _AbstractClientStack(object):
+    # The methods here are compiled so that Metric and MetricMod can
+    # call them without looking them up.
+
+    @property
+    def default(self):
+        """
+        The global client, as set by `set_statsd_client`.
+        """
+        return _global_client
+
+    def get(self):
+        raise NotImplementedError
+
+    def push(self, obj):
+        raise NotImplementedError
+
+    def pop(self):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class ClientStack(_AbstractClientStack):
     """
     Thread local stack of StatsdClients.
 
@@ -20,13 +63,22 @@ class ClientStack(threading.local):
     using statsd_client_stack.push()/.pop()/.clear().
 
     This is like pyramid.threadlocal but it handles the default differently.
-    """
 
-    default = None
+    .. versionchanged:: 4.4.0
+       This is no longer a subclass of `threading.local`. The
+       ``stack`` attribute is a property returning the list for the
+       current thread.
+    """
 
     def __init__(self):
-        threading.local.__init__(self) # pylint:disable=non-parent-init-called
-        self.stack = []
+        self._local = _ThreadStack()
+
+    @property
+    def stack(self):
+        """
+        The list of clients pushed in the current thread.
+        """
+        return self._local.stack
 
     def get(self):
         """
@@ -35,21 +87,91 @@ class ClientStack(threading.local):
         Returns the thread-local client if there is one, or the global
         client if there is one, or None.
         """
-        stack = self.stack
-        return stack[-1] if stack else self.default
+        stack = self._local.stack
+        return stack[-1] if stack else _global_client
 
     def push(self, obj):
-        self.stack.append(obj)
+        self._local.stack.append(obj)
 
     def pop(self):
-        stack = self.stack
+        stack = self._local.stack
         return stack.pop() if stack else None
 
     def clear(self):
-        del self.stack[:]
+        del self._local.stack[:]
+
+
+class ContextClientStack(_AbstractClientStack):
+    """
+    Context local stack of StatsdClients.
+
+    This has the same methods as `ClientStack`, but the stack is
+    kept in a `contextvars.ContextVar` instead of a thread local, so
+    each asyncio task (which runs in a copy of the context it was
+    created in) has its own stack: a client pushed by one task, for
+    example by `perfmetrics.MetricMod`, isn't seen by the others.
+
+    The stack is a chain of immutable ``(client, parent)`` frames, so
+    pushing doesn't copy anything, and a task's pushes can't change
+    the frames shared with the context it was created in.
+
+    Set the ``PERFMETRICS_CLIENT_STACK`` environment variable to
+    ``context`` before importing perfmetrics to use this class for
+    ``perfmetrics.statsd_client_stack``.
 
+    .. versionadded:: 4.4.0
+    """
 
-client_stack = ClientStack()
+    def __init__(self):
+        self._frames = ContextVar('perfmetrics.client_stack', default=None)
+
+    @property
+    def stack(self):
+        """
+        A list of the clients in the stack for the current context,
+        with the most recently pushed client last.
+        """
+        clients = []
+        frame = self._frames.get()
+        while frame is not None:
+            clients.append(frame[0])
+            frame = frame[1]
+        clients.reverse()
+        return clients
+
+    def get(self):
+        """
+        Return the current StatsdClient for the context.
+
+        Returns the context-local client if there is one, or the
+        global client if there is one, or None.
+        """
+        frame = self._frames.get()
+        return frame[0] if frame is not None else _global_client
+
+    def push(self, obj):
+        frames = self._frames
+        frames.set((obj, frames.get()))
+
+    def pop(self):
+        frames = self._frames
+        frame = frames.get()
+        if frame is None:
+            return None
+        frames.set(frame[1])
+        return frame[0]
+
+    def clear(self):
+        self._frames.set(None)
+
+
+def _new_client_stack(environ):
+    # The kind of stack is chosen once, when this module is imported.
+    if environ.get('PERFMETRICS_CLIENT_STACK') == 'context':
+        return ContextClientStack()
+    return ClientStack()
+
+client_stack = _new_client_stack(os.environ)
 
 # Just expose the bound method, don't wrap it,
 # for speed.
@@ -67,8 +189,13 @@ def set_statsd_client(client_or_uri):
     looks for the ``STATSD_URI`` environment variable and calls
     `set_statsd_client` if that variable is found.
     """
+    global _global_client
     if isinstance(client_or_uri, string_types):
         client = statsd_client_from_uri(client_or_uri)
     else:
         client = client_or_uri
-    ClientStack.default = client
+    _global_client = client
+
+# pylint:disable=wrong-import-position,wrong-import-order
+from perfmetrics._util import import_c_accel
+import_c_accel(globals(), 'perfmetrics._clientstack')
@@ -24,10 +24,13 @@ except ImportError: # pragma: no cover
             pass
         def __call__(self, cls):
             return cls
+    def classImplements(cls, *ifaces): # pylint:disable=unused-argument
+        pass
 else:
     Interface = interface.Interface
     Attribute = interface.Attribute
     implementer = interface.implementer
+    classImplements = interface.classImplements
 
 
 class IStatsdClient(Interface):
@@ -42,12 +45,25 @@ class IStatsdClient(Interface):
     packet should be sent regardless of the specified sample rate.
 
     If the ``buf`` parameter is a list, StatsdClient
-    appends the packet contents to the ``buf`` list rather than send the
-    packet, making it possible to send multiple updates in a single packet.
+    appends the encoded line (a byte string) to the ``buf`` list rather
+    than send the packet, making it possible to send multiple updates in
+    a single packet by passing the list to :meth:`sendbuf`.
     Keep in mind that the size of UDP packets is limited (the limit varies
     by the network, but 1000 bytes is usually a good guess) and any extra
     bytes will be ignored silently.
 
+    The ``tags`` parameter attaches DogStatsD-style tags to the
+    metric, sent as ``|#key:value,key2:value2``. It may be a mapping
+    (a key whose value is None becomes a tag without a value) or an
+    iterable of ``key:value`` strings. Tags are sorted and
+    deduplicated, so the same tags given in any order produce the
+    same line. Not every StatsD server understands tags.
+
+    .. versionchanged:: 4.4.0
+       Add the ``tags`` parameter.
+    .. versionchanged:: 4.4.0
+       The lines appended to ``buf`` are byte strings instead of
+       native strings.
     """
     def close():
         """
@@ -56,7 +72,17 @@ class IStatsdClient(Interface):
         .. versionadded:: 3.0
         """
 
-    def timing(stat, value, rate=1, buf=None, rate_applied=False):
+    def flush():
+        """
+        Send any metrics that the client has buffered internally.
+
+        Clients that send each metric immediately do nothing here.
+        Closing a client implicitly flushes it.
+
+        .. versionadded:: 4.4.0
+        """
+
+    def timing(stat, value, rate=1, buf=None, rate_applied=False, tags=None):
         """
         Log timing information in milliseconds.
 
@@ -67,7 +93,7 @@ class IStatsdClient(Interface):
         gauges.
         """
 
-    def gauge(stat, value, rate=1, buf=None, rate_applied=False):
+    def gauge(stat, value, rate=1, buf=None, rate_applied=False, tags=None):
         """
         Update a gauge value.
 
@@ -78,7 +104,7 @@ class IStatsdClient(Interface):
         this may be done manually or with `MetricMod`.
         """
 
-    def incr(stat, count=1, rate=1, buf=None, rate_applied=False):
+    def incr(stat, count=1, rate=1, buf=None, rate_applied=False, tags=None):
         """
         Increment a counter by *count*.
 
@@ -88,14 +114,14 @@ class IStatsdClient(Interface):
         appropriate to use a gauge instead of a counter.
         """
 
-    def decr(stat, count=1, rate=1, buf=None, rate_applied=False):
+    def decr(stat, count=1, rate=1, buf=None, rate_applied=False, tags=None):
         """
         Decrement a counter.
 
         This is the opposite of :meth:`incr`.
         """
 
-    def set_add(stat, value, rate=1, buf=None, rate_applied=False):
+    def set_add(stat, value, rate=1, buf=None, rate_applied=False, tags=None):
         """
         Add a *value* to the set named by *stat*.
 
@@ -117,10 +143,42 @@ class IStatsdClient(Interface):
         .. versionadded:: 3.1.0
         """
 
+    def histogram(stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        Record a *value* in the histogram named by *stat*.
+
+        Histograms are computed by the agent that receives the metric
+        (for example, the DogStatsD agent), which reports statistics
+        such as the count, average, maximum and percentiles of the
+        values it received during each flush interval. Unlike
+        timers, *value* need not be a duration, and it may be a
+        float. Not every StatsD server understands histograms.
+
+        .. versionadded:: 4.4.0
+        """
+
+    def distribution(stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        Record a *value* in the distribution named by *stat*.
+
+        A distribution is like a histogram, but the values are
+        aggregated globally by the metrics service rather than by each
+        agent, so percentiles are accurate across all the hosts that
+        report the metric. Not every StatsD server understands
+        distributions.
+
+        .. versionadded:: 4.4.0
+        """
+
 
     def sendbuf(buf):
         """
-        Send a UDP packet containing string lines.
+        Send a UDP packet containing the lines in *buf*.
+
+        *buf* is a sequence of lines, such as the ``buf`` list filled
+        by the other methods. Lines are byte strings; native strings
+        are accepted too, and encoded as ASCII.
 
-        *buf* is a sequence of strings.
+        .. versionchanged:: 4.4.0
+           Lines are byte strings.
         """
@@ -8,19 +8,145 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from time import time
+from inspect import isasyncgenfunction
+from inspect import iscoroutinefunction
+from inspect import isgeneratorfunction
+from math import log
+from math import log1p
+from time import perf_counter_ns
 from types import MethodType
 from weakref import WeakKeyDictionary
 import functools
 import random as stdrandom
+import warnings
 
-from .clientstack import statsd_client
+from .clientstack import ContextClientStack
 from .clientstack import client_stack as statsd_client_stack
-from .statsd import StatsdClientMod
+from .statsd import _compose_mod
 from .statsd import null_client
+from .statsd import _PreciseMilliseconds
+from .statsd import _tag_items
+from ._util import is_coroutine_function
+from ._util import mark_coroutine_function
 
 logger = __import__('logging').getLogger(__name__)
 
+#: The `IStatsdClient` methods that `Metric` can report elapsed time with.
+_TIMING_KINDS = ('timing', 'histogram', 'distribution')
+
+#: How `Metric` can choose which calls to record when its rate is less than 1.
+_SAMPLING_KINDS = ('random', 'counter', 'geometric')
+
+# Keep countdowns for absurdly small rates within a C long long.
+_MAX_INTERVAL = 4611686018427387904.0
+
+def _incr(client, stat, rate, buf, tags):
+    # Only pass tags when there are some, so clients written before
+    # tags existed keep working.
+    if tags:
+        client.incr(stat, 1, rate, buf=buf, rate_applied=True, tags=tags)
+    else:
+        client.incr(stat, 1, rate, buf=buf, rate_applied=True)
+
+def _elapsed_ms(client, kind, elapsed_ns, precise):
+    # Clients get whole milliseconds unless we were asked for
+    # fractions, either by this metric (marked, so clients that send
+    # whole milliseconds don't truncate them) or by a client that
+    # sends fractional timings.
+    if precise:
+        return _PreciseMilliseconds(elapsed_ns / 1000000.0)
+    if kind == 'timing' and getattr(client, 'fractional_timing', False) is True:
+        return elapsed_ns / 1000000.0
+    return elapsed_ns // 1000000
+
+def _timing(client, kind, stat, elapsed_ns, precise, rate, buf, tags):
+    # *kind* names the client method to report with.
+    elapsed_ms = _elapsed_ms(client, kind, elapsed_ns, precise)
+    method = getattr(client, kind)
+    if tags:
+        method(stat, elapsed_ms, rate, buf=buf, rate_applied=True, tags=tags)
+    else:
+        method(stat, elapsed_ms, rate, buf=buf, rate_applied=True)
+
+#: Caches the names of error stats, by stat and by ``(stat, exception type)``.
+_error_stats = {}
+
+def _count_error(client, stat, failure, error_types, rate, buf, tags):
+    # Add the error counters for an exception of type *failure* to
+    # *buf*, and return the stat to report the elapsed time with.
+    try:
+        error_stat = _error_stats[stat]
+    except KeyError:
+        if len(_error_stats) >= 10000:
+            _error_stats.clear()
+        error_stat = _error_stats[stat] = stat + '.error'
+    _incr(client, error_stat, rate, buf, tags)
+    if error_types:
+        key = (stat, failure)
+        try:
+            type_stat = _error_stats[key]
+        except KeyError:
+            if len(_error_stats) >= 10000:
+                _error_stats.clear()
+            type_stat = _error_stats[key] = error_stat + '.' + failure.__name__
+        _incr(client, type_stat, rate, buf, tags)
+    return error_stat
+
+class _Sampler(object):
+    # Chooses which calls to record when the rate is less than 1.
+    #
+    # 'random' draws a random number for every call. 'counter' records
+    # exactly one call in every round(1/rate). 'geometric' draws the
+    # number of calls until the next recorded one from the geometric
+    # distribution, so each call is still recorded with probability
+    # *rate*, but a random number is only needed for the calls that
+    # are recorded. Between recorded calls, both counting strategies
+    # only decrement an integer.
+    __slots__ = (
+        'kind',
+        'random',
+        '_countdown',
+    )
+
+    def __init__(self, kind, random):
+        self.kind = kind
+        self.random = random
+        # Negative until the first call.
+        self._countdown = -1
+
+    def _next_countdown(self, rate):
+        # Return the number of calls until the next recorded one,
+        # counting it.
+        if self.kind == 'counter':
+            return int(min(1.0 / rate + 0.5, _MAX_INTERVAL))
+        skipped = log(1.0 - self.random()) / log1p(-rate)
+        return int(min(skipped, _MAX_INTERVAL)) + 1
+
+    def sampled_rate(self, rate):
+        # Return the sample rate to report for this call, or 0 to
+        # ignore it.
+        if rate <= 0:
+            return 0.0
+        if self.kind == 'random':
+            return rate if self.random() < rate else 0.0
+
+        if self._countdown < 0:
+            # Start as though the call before the first one had been
+            # recorded, so that the first interval is sampled like
+            # the rest: 'counter' records the first call.
+            self._countdown = 1 if self.kind == 'counter' else self._next_countdown(rate)
+        self._countdown -= 1
+        if self._countdown > 0:
+            return 0.0
+
+        # This call stands for the interval it starts. Report the rate
+        # that interval is chosen with, so the server extrapolates
+        # correctly even if the rate changes before it ends.
+        interval = self._countdown = self._next_countdown(rate)
+        if self.kind == 'counter':
+            return 1.0 / interval
+        return rate
+
 class _MethodLikeMixin(object):
     __slots__ = ()
     # We may be wrapped by another decorator,
@@ -39,64 +165,301 @@ class _MethodLikeMixin(object):
         # (im_class is None), so it's best to pass all three.
         return MethodType(self, inst, klass) if str is bytes else MethodType(self, inst)
 
-class _AbstractMetricImpl(_MethodLikeMixin):
+class _AbstractMetricImpl(_MethodLikeMixin): # pylint:disable=too-many-instance-attributes
     __slots__ = (
         'f',
         'random',
         'metric_timing',
         'metric_count',
         'metric_rate',
+        'metric_tags',
+        'metric_kind',
+        'metric_precise',
+        'metric_calls',
+        'metric_errors',
+        'metric_error_types',
         'timing_format',
+        '_sampler',
         '__wrapped__',
         '__dict__',
     )
     stat_name = None
-    def __init__(self, f, timing, count, rate, timing_format, random):
+    def __init__(self, f, timing, count, rate, timing_format, random, tags, kind,
+                 precise, sampling, errors, error_types):
         self.__wrapped__ = None
         self.f = f
         self.metric_timing = timing
         self.metric_count = count
         self.metric_rate = rate
+        self.metric_tags = tags
+        self.metric_kind = kind
+        self.metric_precise = precise
+        self.metric_calls = 0
+        self.metric_errors = errors
+        self.metric_error_types = error_types
         self.timing_format = timing_format
         self.random = random
+        self._sampler = _Sampler(sampling, random)
 
     def __call__(self, *args, **kwargs):
-        if self.metric_rate < 1 and self.random() >= self.metric_rate:
-            # Ignore this sample.
-            return self.f(*args, **kwargs)
+        # Count every call, sampled or not, for the benefit of
+        # perfmetrics.adaptive.
+        self.metric_calls += 1
+        rate = self.metric_rate
+        if rate < 1:
+            rate = self._sampler.sampled_rate(rate)
+            if not rate:
+                # Ignore this sample.
+                return self.f(*args, **kwargs)
 
-        client = statsd_client()
+        client = statsd_client_stack.get()
 
         if client is None:
             # No statsd client has been configured.
             return self.f(*args, **kwargs)
 
         stat = self.stat_name or self._compute_stat(args)
+        if self.metric_errors:
+            return self._call_with_outcome(client, stat, rate, args, kwargs)
         # TODO: A lot of this is duplicated with __exit__.
         # Can we do better?
         if self.metric_timing:
             if self.metric_count:
                 buf = []
-                client.incr(stat, 1, self.metric_rate, buf=buf, rate_applied=True)
+                _incr(client, stat, rate, buf, self.metric_tags)
             else:
                 buf = None
 
-            start = time()
+            start = perf_counter_ns()
 
             try:
                 return self.f(*args, **kwargs)
             finally:
-                end = time()
-                elapsed_ms = int((end - start) * 1000.0)
-                client.timing(self.timing_format % stat, elapsed_ms,
-                              self.metric_rate, buf=buf, rate_applied=True)
+                _timing(client, self.metric_kind, self.timing_format % stat,
+                        perf_counter_ns() - start, self.metric_precise,
+                        rate, buf, self.metric_tags)
+                if buf:
+                    client.sendbuf(buf)
+
+        else:
+            if self.metric_count:
+                _incr(client, stat, rate, None, self.metric_tags)
+            return self.f(*args, **kwargs)
+
+    async def _call_async(self, args, kwargs):
+        # The same as __call__, for coroutine functions: the time is
+        # measured until the coroutine returns.
+        self.metric_calls += 1
+        rate = self.metric_rate
+        if rate < 1:
+            rate = self._sampler.sampled_rate(rate)
+            if not rate:
+                return await self.f(*args, **kwargs)
+
+        client = statsd_client_stack.get()
+
+        if client is None:
+            return await self.f(*args, **kwargs)
+
+        stat = self.stat_name or self._compute_stat(args)
+        if self.metric_errors:
+            return await self._call_async_with_outcome(client, stat, rate, args, kwargs)
+        if self.metric_timing:
+            if self.metric_count:
+                buf = []
+                _incr(client, stat, rate, buf, self.metric_tags)
+            else:
+                buf = None
+
+            start = perf_counter_ns()
+
+            try:
+                return await self.f(*args, **kwargs)
+            finally:
+                _timing(client, self.metric_kind, self.timing_format % stat,
+                        perf_counter_ns() - start, self.metric_precise,
+                        rate, buf, self.metric_tags)
                 if buf:
                     client.sendbuf(buf)
 
         else:
             if self.metric_count:
-                client.incr(stat, 1, self.metric_rate, rate_applied=True)
+                _incr(client, stat, rate, None, self.metric_tags)
+            return await self.f(*args, **kwargs)
+
+    def _call_with_outcome(self, client, stat, rate, args, kwargs):
+        # __call__, when errors are counted.
+        buf = []
+        if self.metric_count:
+            _incr(client, stat, rate, buf, self.metric_tags)
+        failure = None
+        start = perf_counter_ns()
+        try:
             return self.f(*args, **kwargs)
+        except Exception as ex:
+            failure = type(ex)
+            raise
+        finally:
+            self._report_outcome(client, stat, rate, buf,
+                                 perf_counter_ns() - start, failure)
+
+    async def _call_async_with_outcome(self, client, stat, rate, args, kwargs):
+        # _call_async, when errors are counted.
+        buf = []
+        if self.metric_count:
+            _incr(client, stat, rate, buf, self.metric_tags)
+        failure = None
+        start = perf_counter_ns()
+        try:
+            return await self.f(*args, **kwargs)
+        except Exception as ex:
+            failure = type(ex)
+            raise
+        finally:
+            self._report_outcome(client, stat, rate, buf,
+                                 perf_counter_ns() - start, failure)
+
+    def _report_outcome(self, client, stat, rate, buf, elapsed_ns, failure):
+        # Add the error counters (if the call raised an exception of
+        # type *failure*) and the timing to *buf*, and send it.
+        if failure is not None:
+            stat = _count_error(client, stat, failure, self.metric_error_types,
+                                rate, buf, self.metric_tags)
+        if self.metric_timing:
+            _timing(client, self.metric_kind, self.timing_format % stat,
+                    elapsed_ns, self.metric_precise, rate, buf, self.metric_tags)
+        if buf:
+            client.sendbuf(buf)
+
+    def _call_iterator(self, args, kwargs, is_async):
+        # The same as __call__, for generator and async generator
+        # functions. If the call is recorded, the generator is
+        # wrapped to time it while it's iterated.
+        self.metric_calls += 1
+        rate = self.metric_rate
+        if rate < 1:
+            rate = self._sampler.sampled_rate(rate)
+            if not rate:
+                return self.f(*args, **kwargs)
+
+        client = statsd_client_stack.get()
+
+        if client is None:
+            return self.f(*args, **kwargs)
+
+        stat = self.stat_name or self._compute_stat(args)
+        if self.metric_count:
+            buf = []
+            _incr(client, stat, rate, buf, self.metric_tags)
+        else:
+            buf = None
+
+        if not self.metric_timing and not self.metric_errors:
+            if buf:
+                client.sendbuf(buf)
+            return self.f(*args, **kwargs)
+
+        if buf is None:
+            buf = []
+        if is_async:
+            return self._time_async_generator(self.f(*args, **kwargs), client, stat, rate, buf)
+        return self._time_generator(self.f(*args, **kwargs), client, stat, rate, buf)
+
+    def _time_generator(self, gen, client, stat, rate, buf):
+        # Delegate to *gen* like ``yield from``, counting the items.
+        start = perf_counter_ns()
+        first = 0
+        items = 0
+        failure = None
+        sent = None
+        thrown = None
+        send = gen.send
+        try:
+            while True:
+                try:
+                    if thrown is None:
+                        item = send(sent)
+                    else:
+                        item = gen.throw(thrown)
+                        thrown = None
+                except StopIteration as ex:
+                    return ex.value
+                if not items:
+                    first = perf_counter_ns() - start
+                items += 1
+                try:
+                    sent = yield item
+                except GeneratorExit:
+                    raise
+                except BaseException as ex: # pylint:disable=broad-except
+                    thrown = ex
+        except Exception as ex:
+            failure = type(ex)
+            raise
+        finally:
+            self._iterated(client, stat, rate, buf, perf_counter_ns() - start, first, items,
+                           failure)
+            gen.close()
+
+    async def _time_async_generator(self, agen, client, stat, rate, buf):
+        # The same as _time_generator, for an async generator.
+        start = perf_counter_ns()
+        first = 0
+        items = 0
+        failure = None
+        sent = None
+        thrown = None
+        asend = agen.asend
+        try:
+            while True:
+                try:
+                    if thrown is None:
+                        item = await asend(sent)
+                    else:
+                        item = await agen.athrow(thrown)
+                        thrown = None
+                except StopAsyncIteration:
+                    return
+                if not items:
+                    first = perf_counter_ns() - start
+                items += 1
+                try:
+                    sent = yield item
+                except GeneratorExit:
+                    raise
+                except BaseException as ex: # pylint:disable=broad-except
+                    thrown = ex
+        except Exception as ex:
+            failure = type(ex)
+            raise
+        finally:
+            self._iterated(client, stat, rate, buf, perf_counter_ns() - start, first, items,
+                           failure)
+            await agen.aclose()
+
+    def _iterated(self, client, stat, rate, buf, elapsed_ns, first_ns, items, failure):
+        # A timed generator has been exhausted, has raised an
+        # exception, or was closed: report the time it was iterated
+        # for, the time until the first item, and the number of items.
+        tags = self.metric_tags
+        if self.metric_errors and failure is not None:
+            timing_stat = _count_error(client, stat, failure, self.metric_error_types,
+                                       rate, buf, tags)
+        else:
+            timing_stat = stat
+        if self.metric_timing:
+            _timing(client, self.metric_kind, self.timing_format % timing_stat,
+                    elapsed_ns, self.metric_precise, rate, buf, tags)
+        if items and self.metric_timing:
+            _timing(client, self.metric_kind, self.timing_format % (stat + '.first'),
+                    first_ns, self.metric_precise, rate, buf, tags)
+        if items:
+            if tags:
+                client.incr(stat + '.items', items, rate, buf=buf, rate_applied=True,
+                            tags=tags)
+            else:
+                client.incr(stat + '.items', items, rate, buf=buf, rate_applied=True)
+        client.sendbuf(buf)
 
     def _compute_stat(self, args):
         raise NotImplementedError
@@ -130,10 +493,52 @@ class _MethodMetricImpl(_AbstractMetricImpl):
             self.klass_dict[klass] = stat_name
         return stat_name
 
+# Calling the decorated version of an ``async def`` function returns
+# the coroutine from ``_call_async``; no closure is needed. Likewise,
+# generator functions return the generator from ``_call_iterator``.
+
+class _AsyncGivenStatMetricImpl(_GivenStatMetricImpl):
+    __slots__ = ()
+
+    def __call__(self, *args, **kwargs):
+        return self._call_async(args, kwargs)
+
+class _AsyncMethodMetricImpl(_MethodMetricImpl):
+    __slots__ = ()
+
+    def __call__(self, *args, **kwargs):
+        return self._call_async(args, kwargs)
+
+class _GeneratorGivenStatMetricImpl(_GivenStatMetricImpl):
+    __slots__ = ()
 
-class Metric(object):
+    def __call__(self, *args, **kwargs):
+        return self._call_iterator(args, kwargs, False)
+
+class _GeneratorMethodMetricImpl(_MethodMetricImpl):
+    __slots__ = ()
+
+    def __call__(self, *args, **kwargs):
+        return self._call_iterator(args, kwargs, False)
+
+class _AsyncGeneratorGivenStatMetricImpl(_GivenStatMetricImpl):
+    __slots__ = ()
+
+    def __call__(self, *args, **kwargs):
+        return self._call_iterator(args, kwargs, True)
+
+class _AsyncGeneratorMethodMetricImpl(_MethodMetricImpl):
+    __slots__ = ()
+
+    def __call__(self, *args, **kwargs):
+        return self._call_iterator(args, kwargs, True)
+
+
+class Metric(object): # pylint:disable=too-many-instance-attributes
+    # Sphinx only reads a signature that is on one line.
+    # pylint:disable=line-too-long
     """
-    Metric(stat=None, rate=1, method=False, count=True, timing=True)
+    Metric(stat=None, rate=1, method=False, count=True, timing=True, tags=None, kind='timing', precise=False, sampling='random', errors=False, error_types=False)
 
     A decorator or context manager with options.
 
@@ -145,7 +550,38 @@ class Metric(object):
     the method's class name rather than the module name. Setting
     ``count`` to False disables the counter statistics sent to Statsd.
     Setting ``timing`` to False disables the timing statistics sent to
-    Statsd.
+    Statsd. ``tags`` are sent with each metric; see
+    `perfmetrics.interfaces.IStatsdClient` for their format. ``kind``
+    is the name of the client method that reports the elapsed time:
+    ``'timing'`` (the default), ``'histogram'`` or ``'distribution'``.
+    Elapsed time is passed to the client as an integer number of
+    milliseconds, unless ``precise`` is true or the client's
+    ``fractional_timing`` attribute is true (for
+    `perfmetrics.statsd.StatsdClient`, when it was created with a
+    *timing_precision* or *timing_unit*); then ``timing`` gets a float.
+    If ``precise`` is true, `~perfmetrics.statsd.StatsdClient` sends
+    this metric's times to the microsecond either way. Histograms and
+    distributions get whole milliseconds unless ``precise`` is true.
+
+    If ``errors`` is true, calls that raise an exception also
+    increment ``<stat>.error``, and their elapsed time is reported as
+    ``<stat>.error.t`` instead of ``<stat>.t``; if ``error_types`` is
+    also true (it implies ``errors``), ``<stat>.error.<exception class
+    name>`` is incremented too. These are sent in the same packet as
+    the other metrics of the call. Exceptions that aren't subclasses
+    of `Exception`, such as `KeyboardInterrupt` or
+    `asyncio.CancelledError`, aren't counted as errors.
+
+    ``sampling`` chooses how calls are selected when ``rate`` is less
+    than 1. The default, ``'random'``, calls ``random()`` for every
+    call. ``'counter'`` records exactly one call in every
+    ``round(1/rate)``, starting with the first (and reports that
+    exact rate to Statsd), which keeps low-traffic statistics
+    steady. ``'geometric'`` records each
+    call with probability ``rate`` like ``'random'``, but draws the
+    number of calls to skip ahead of time, so a random number is only
+    needed for the calls that are recorded. With either counting
+    strategy, an ignored call costs only an integer decrement.
 
     Sample use as a decorator::
 
@@ -169,6 +605,21 @@ class Metric(object):
     When using Metric as a context manager, you must provide the
     ``stat`` parameter or nothing will be recorded.
 
+    ``async def`` functions can be decorated too; the time until the
+    coroutine returns is recorded. ``async with Metric('stat'):``
+    works like ``with``. A context manager records its start time on
+    the ``Metric`` itself, so don't share one between tasks (or
+    threads) that may use it at the same time.
+
+    When a generator function (or an async generator function) is
+    decorated, the generator is timed from its first item being
+    requested until it's exhausted, raises an exception or is closed.
+    Along with the usual counter and ``<stat>.t`` timer, the time
+    until the first item is sent as ``<stat>.first.t`` and the number
+    of items as the counter ``<stat>.items``. The metrics are sent
+    when the generator finishes, so nothing is sent for a generator
+    that's never iterated.
+
     .. versionchanged:: 3.0
 
         When used as a decorator, set ``__wrapped__`` on the returned object, even
@@ -180,11 +631,44 @@ class Metric(object):
         has ``metric_timing``, ``metric_count`` and ``metric_rate``
         attributes that can be changed to alter its behaviour.
 
+    .. versionchanged:: 4.4.0
+
+        Add the ``tags``, ``kind``, ``precise`` and ``sampling`` parameters. The
+        returned object has ``metric_tags``, ``metric_kind`` and
+        ``metric_precise`` attributes, and a read-only ``metric_calls``
+        attribute counting how many times it has been called.
+
+    .. versionchanged:: 4.4.0
+
+        Decorating a coroutine function returns a coroutine function
+        that times the coroutine. Add ``async with`` support.
+
+    .. versionchanged:: 4.4.0
+
+        Time generators and async generators while they're iterated.
+
+    .. versionchanged:: 4.4.0
+
+        Add the ``errors`` and ``error_types`` parameters. The returned
+        object has ``metric_errors`` and ``metric_error_types``
+        attributes.
+
+    .. versionchanged:: 4.4.0
+
+        Measure elapsed time with :func:`time.perf_counter_ns` instead
+        of :func:`time.time`.
     """
+    # pylint:enable=line-too-long
 
     def __init__(self, stat=None, rate=1, method=False,
                  count=True, timing=True, timing_format='%s.t',
-                 random=stdrandom.random):  # testing hook
+                 random=stdrandom.random,  # testing hook
+                 tags=None, kind='timing', precise=False, sampling='random',
+                 errors=False, error_types=False):
+        if kind not in _TIMING_KINDS:
+            raise ValueError("kind must be one of %s, not %r" % (_TIMING_KINDS, kind))
+        if sampling not in _SAMPLING_KINDS:
+            raise ValueError("sampling must be one of %s, not %r" % (_SAMPLING_KINDS, sampling))
         self.stat = stat
         self.rate = rate
         self.method = method
@@ -192,7 +676,16 @@ class Metric(object):
         self.timing = timing
         self.timing_format = timing_format
         self.random = random
-        self.start = 0.0
+        # Canonicalize once so clients find the encoded tags in their
+        # cache without any per-call work.
+        self.tags = _tag_items(tags) if tags else None
+        self.kind = kind
+        self.precise = precise
+        self.sampling = sampling
+        self.errors = errors or error_types
+        self.error_types = error_types
+        self._sampler = _Sampler(sampling, random)
+        self.start = 0
 
     def __call__(self, f):
         """
@@ -201,31 +694,56 @@ class Metric(object):
         func_name = f.__name__
         func_full_name = '%s.%s' % (f.__module__, func_name)
 
+        is_async = iscoroutinefunction(f)
         if self.method:
-            metric = _MethodMetricImpl(f, self.timing, self.count,
-                                       self.rate, self.timing_format,
-                                       self.random)
+            if is_async:
+                kind = _AsyncMethodMetricImpl
+            elif isgeneratorfunction(f):
+                kind = _GeneratorMethodMetricImpl
+            elif isasyncgenfunction(f):
+                kind = _AsyncGeneratorMethodMetricImpl
+            else:
+                kind = _MethodMetricImpl
+            metric = kind(f, self.timing, self.count,
+                          self.rate, self.timing_format,
+                          self.random, self.tags, self.kind,
+                          self.precise, self.sampling,
+                          self.errors, self.error_types)
         else:
-            metric = _GivenStatMetricImpl(
+            if is_async:
+                kind = _AsyncGivenStatMetricImpl
+            elif isgeneratorfunction(f):
+                kind = _GeneratorGivenStatMetricImpl
+            elif isasyncgenfunction(f):
+                kind = _AsyncGeneratorGivenStatMetricImpl
+            else:
+                kind = _GivenStatMetricImpl
+            metric = kind(
                 self.stat or func_full_name,
                 f, self.timing, self.count,
                 self.rate, self.timing_format,
-                self.random)
+                self.random, self.tags, self.kind,
+                self.precise, self.sampling,
+                self.errors, self.error_types)
 
         metric = functools.update_wrapper(metric, f)
         metric.__wrapped__ = f # Python 2 doesn't set this, but it's handy to have.
+        if is_async:
+            mark_coroutine_function(metric)
         return metric
 
     # Metric can also be used as a context manager.
 
     def __enter__(self):
-        self.start = time()
+        self.start = perf_counter_ns()
 
-    def __exit__(self, _typ, _value, _tb):
+    def __exit__(self, typ, _value, _tb):
         rate = self.rate
-        if rate < 1 and self.random() >= rate:
-            # Ignore this sample.
-            return
+        if rate < 1:
+            rate = self._sampler.sampled_rate(rate)
+            if not rate:
+                # Ignore this sample.
+                return
 
         client = statsd_client_stack.get()
         if client is not None:
@@ -233,42 +751,157 @@ class Metric(object):
             stat = self.stat
             if stat:
                 if self.count:
-                    client.incr(stat, rate=rate, buf=buf, rate_applied=True)
+                    _incr(client, stat, rate, buf, self.tags)
+                timing_stat = stat
+                if self.errors and typ is not None and issubclass(typ, Exception):
+                    timing_stat = _count_error(client, stat, typ, self.error_types,
+                                               rate, buf, self.tags)
                 if self.timing:
-                    elapsed = int((time() - self.start) * 1000.0)
-                    client.timing(self.timing_format % stat, elapsed,
-                                  rate=rate, buf=buf, rate_applied=True)
+                    _timing(client, self.kind, self.timing_format % timing_stat,
+                            perf_counter_ns() - self.start, self.precise,
+                            rate, buf, self.tags)
                 if buf:
                     client.sendbuf(buf)
 
+    async def __aenter__(self):
+        self.start = perf_counter_ns()
+
+    async def __aexit__(self, typ, value, tb):
+        self.__exit__(typ, value, tb)
+
+class _MetricModImpl(_MethodLikeMixin):
+    # What MetricMod returns when it decorates a function.
+    __slots__ = (
+        'mod',
+        'f',
+        '__wrapped__',
+        '__dict__',
+    )
+
+    def __init__(self, mod, f):
+        self.mod = mod
+        self.f = f
+        self.__wrapped__ = f
+
+    def __call__(self, *args, **kwargs):
+        client = statsd_client_stack.get()
+        if client is None:
+            # Statsd is not configured.
+            return self.f(*args, **kwargs)
+
+        statsd_client_stack.push(self.mod._mod(client))
+        try:
+            return self.f(*args, **kwargs)
+        finally:
+            statsd_client_stack.pop()
+
+def _run_with_mod(coro, mod):
+    # Run *coro* like ``yield from coro.__await__()``, with *mod*
+    # pushed onto the client stack only while *coro* is running, so
+    # tasks that run while it's suspended don't see it, whatever kind
+    # of stack this is.
+    sent = None
+    thrown = None
+    while True:
+        statsd_client_stack.push(mod)
+        try:
+            if thrown is None:
+                future = coro.send(sent)
+            else:
+                exc, thrown = thrown, None
+                future = coro.throw(exc)
+        except StopIteration as ex:
+            return ex.value
+        finally:
+            statsd_client_stack.pop()
+        try:
+            sent = yield future
+        except GeneratorExit:
+            statsd_client_stack.push(mod)
+            try:
+                coro.close()
+            finally:
+                statsd_client_stack.pop()
+            raise
+        except BaseException as ex: # pylint:disable=broad-except
+            thrown = ex
+
+
+class _AwaitWithMod(object):
+    # Awaits a coroutine with _run_with_mod.
+    __slots__ = (
+        'coro',
+        'mod',
+    )
+
+    def __init__(self, coro, mod):
+        self.coro = coro
+        self.mod = mod
+
+    def __await__(self):
+        return _run_with_mod(self.coro, self.mod)
+
+
 class MetricMod(object):
     """Decorator/context manager that modifies the name of metrics in context.
 
-    format is a format string such as 'XYZ.%s'.
+    format is a format string such as 'XYZ.%s'. If tags are given,
+    they are added to every metric sent in context.
+
+    ``async def`` functions can be decorated; the modification
+    applies whenever the coroutine is running, until it returns, but
+    not to other tasks that run while it's suspended. ``async with``
+    can also be used, but then the modification lasts until the block
+    exits, so other tasks only don't see it if
+    `perfmetrics.clientstack.ContextClientStack` is in use; with a
+    `perfmetrics.clientstack.ClientStack`, entering the block warns.
+
+    .. versionchanged:: 4.4.0
+       Add the ``tags`` parameter.
+    .. versionchanged:: 4.4.0
+       Support coroutine functions and ``async with``.
+    .. versionchanged:: 4.4.0
+       Compiled with Cython. Decorating a function returns a callable
+       object (which acts like a method in a class) rather than a
+       function.
+    .. versionchanged:: 4.4.0
+       Nested modifications are combined, so each metric is formatted
+       once however deeply they nest. The combined formats, and the
+       stat names formatted with them, are cached by the format and
+       tags they were combined with and reused by later calls; no
+       reference to any client is kept.
     """
 
-    def __init__(self, format): # pylint: disable=redefined-builtin
+    def __init__(self, format, tags=None): # pylint: disable=redefined-builtin
         self.format = format
+        self.tags = _tag_items(tags) if tags else None
+        self._mods = {}
+
+    def _mod(self, client):
+        # Return a StatsdClientMod to push for *client*. Making one is
+        # cheap; how our format and tags combine with those of a
+        # StatsdClientMod we're nested in, and the stat names that
+        # produces, are cached in self._mods without referring to any
+        # client, so clients needn't be hashable and aren't kept alive.
+        return _compose_mod(client, self.format, self.tags, self._mods)
 
     def __call__(self, f):
         """Decorate a function or method to add a metric prefix in context.
         """
 
-        @functools.wraps(f)
-        def call_with_mod(*args, **kw):
-            client = statsd_client_stack.get()
-            if client is None:
-                # Statsd is not configured.
-                return f(*args, **kw)
+        if is_coroutine_function(f):
+            @functools.wraps(f)
+            async def call_async_with_mod(*args, **kw):
+                client = statsd_client_stack.get()
+                if client is None:
+                    return await f(*args, **kw)
 
-            statsd_client_stack.push(StatsdClientMod(client, self.format))
-            try:
-                return f(*args, **kw)
-            finally:
-                statsd_client_stack.pop()
+                return await _AwaitWithMod(f(*args, **kw), self._mod(client))
 
-        call_with_mod.__wrapped__ = f
-        return call_with_mod
+            call_async_with_mod.__wrapped__ = f
+            return call_async_with_mod
+
+        return functools.update_wrapper(_MetricModImpl(self, f), f)
 
     def __enter__(self):
         client = statsd_client_stack.get()
@@ -276,11 +909,23 @@ class MetricMod(object):
         if client is None:
             statsd_client_stack.push(null_client)
         else:
-            statsd_client_stack.push(StatsdClientMod(client, self.format))
+            statsd_client_stack.push(self._mod(client))
 
     def __exit__(self, _typ, _value, _tb):
         statsd_client_stack.pop()
 
+    async def __aenter__(self):
+        if not isinstance(statsd_client_stack, ContextClientStack):
+            warnings.warn(
+                "With a thread-local ClientStack, other tasks see the "
+                "MetricMod of an 'async with' block while it's suspended; "
+                "use a ContextClientStack",
+                RuntimeWarning, stacklevel=2)
+        self.__enter__()
+
+    async def __aexit__(self, typ, value, tb):
+        self.__exit__(typ, value, tb)
+
 # pylint:disable=wrong-import-position,wrong-import-order
 from perfmetrics._util import import_c_accel
 import_c_accel(globals(), 'perfmetrics._metric')
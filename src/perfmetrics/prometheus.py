@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+"""
+Exposing metrics to Prometheus.
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import math
+import random
+import re
+import threading
+from bisect import bisect_left
+from collections.abc import Mapping
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler
+from wsgiref.simple_server import WSGIServer
+from wsgiref.simple_server import make_server
+
+from .interfaces import IStatsdClient
+from .interfaces import implementer
+from ._util import reinit_after_fork
+
+__all__ = [
+    'PrometheusStatsdClient',
+    'make_prometheus_app',
+    'start_prometheus_server',
+]
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The buckets of the Prometheus client libraries, in seconds.
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75,
+    1.0, 2.5, 5.0, 7.5, 10.0,
+)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_INVALID_NAME_CHARS = re.compile(r'[^a-zA-Z0-9_:]')
+_INVALID_LABEL_CHARS = re.compile(r'[^a-zA-Z0-9_]')
+
+
+def _metric_name(name):
+    name = _INVALID_NAME_CHARS.sub('_', name)
+    return '_' + name if name[:1].isdigit() else name
+
+
+def _label_name(name):
+    name = _INVALID_LABEL_CHARS.sub('_', name)
+    return '_' + name if name[:1].isdigit() else name
+
+
+def _label_value(value):
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(tags):
+    # Render tags as a Prometheus label set. A tag without a value
+    # becomes a label with the value "true".
+    if not tags:
+        return ''
+    if isinstance(tags, Mapping):
+        items = tags.items()
+    else:
+        items = [tag.partition(':')[::2] for tag in tags]
+    labels = {}
+    for key, value in items:
+        labels[_label_name(str(key))] = 'true' if value is None or value == '' else str(value)
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, _label_value(value))
+        for key, value in sorted(labels.items())
+    )
+
+
+def _with_label(labels, name, value):
+    label = '%s="%s"' % (name, value)
+    return '{%s,%s' % (label, labels[1:]) if labels else '{%s}' % label
+
+
+def _format_value(value):
+    # Prometheus spells infinities and NaN differently than Python.
+    value = float(value)
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if math.isnan(value):
+        return 'NaN'
+    return repr(value)
+
+
+class _Family(object):
+    __slots__ = (
+        'name',
+        'type',
+        'series',
+        'by_labels',
+    )
+
+    def __init__(self, name, kind):
+        self.name = name
+        self.type = kind
+        self.series = []
+        self.by_labels = {}
+
+
+class _Value(object):
+    # A counter or gauge.
+    __slots__ = (
+        'labels',
+        'value',
+    )
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.value = 0
+
+
+class _Histogram(object):
+    __slots__ = (
+        'labels',
+        'counts',
+        'sum',
+        'count',
+    )
+
+    def __init__(self, labels, buckets):
+        self.labels = labels
+        # Not cumulative; the last is for values above every bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+
+@implementer(IStatsdClient)
+class PrometheusStatsdClient(object):
+    """
+    Keep metrics in memory for Prometheus to scrape.
+
+    Use this as the statsd client (for example, with
+    `perfmetrics.set_statsd_client`, or with a ``prometheus://`` URI)
+    when metrics must be pulled rather than pushed. It keeps running
+    totals that are never reset, as Prometheus expects:
+
+    - counters become ``<stat>_total`` counters;
+    - gauges stay gauges;
+    - timers become ``<stat>_seconds`` histograms (the
+      milliseconds given to :meth:`timing` are converted to
+      seconds), with the upper bounds *buckets* (by default, those of
+      the Prometheus client libraries);
+    - histograms and distributions become histograms of the values
+      given, with the same *buckets*.
+
+    Sets are ignored. Sampled metrics are extrapolated as they are
+    recorded. Stat names (prefixed with *prefix*) have dots and other
+    characters Prometheus doesn't allow replaced by underscores, and
+    tags become labels (a tag without a value gets the value
+    ``true``). Metrics whose names and labels come out the same
+    (such as ``a.b`` and ``a_b``) are recorded as one series; a
+    metric whose name is already used by a metric of another type
+    (such as a gauge ``x_total`` and a counter ``x``) is logged and
+    otherwise ignored.
+
+    :meth:`render` produces the text exposition format one metric
+    family at a time, copying each series' values while briefly
+    holding the lock the metric methods use, so scraping many series
+    doesn't hold up the threads recording them. Serve it with
+    :func:`make_prometheus_app` or :func:`start_prometheus_server`.
+
+    .. versionadded:: 4.4.0
+    """
+
+    def __init__(self, prefix='', buckets=DEFAULT_BUCKETS):
+        if prefix and not prefix.endswith('.'):
+            prefix += '.'
+        self.prefix = prefix
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        self.random = random.random  # Testing hook
+        self.server = None
+        self._lock = threading.Lock()
+        self._series = {}
+        self._families = {}
+        reinit_after_fork(self)
+
+    def _after_fork(self):
+        # In a forked child. The lock may have been held by another
+        # thread; the values are the parent's to report.
+        self._lock = threading.Lock()
+        self._series = {}
+        self._families = {}
+        self.server = None
+
+    def _get_series(self, kind, stat, tags):
+        # This key is only what we were given; _add_series finds the
+        # series it belongs to.
+        if tags:
+            key = (kind, stat,
+                   tuple(tags.items()) if isinstance(tags, Mapping) else tuple(tags))
+        else:
+            key = (kind, stat, None)
+        series = self._series.get(key)
+        if series is None:
+            series = self._add_series(key, tags)
+        return series
+
+    def _add_series(self, key, tags):
+        kind, stat, _ = key
+        name = _metric_name(self.prefix + stat)
+        if kind == 'counter':
+            name += '_total'
+        elif kind == 'timer':
+            name += '_seconds'
+            kind = 'histogram'
+        labels = _labels(tags)
+        with self._lock:
+            series = self._series.get(key)
+            if series is not None:
+                return series
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = _Family(name, kind)
+            # Stats and tags that differ only in characters Prometheus
+            # doesn't allow, or in the order of the tags, share a series.
+            series = family.by_labels.get(labels) if family.type == kind else None
+            if series is None:
+                if kind == 'histogram':
+                    series = _Histogram(labels, self.buckets)
+                else:
+                    series = _Value(labels)
+                if family.type == kind:
+                    family.series.append(series)
+                    family.by_labels[labels] = series
+            self._series[key] = series
+        if family.type != kind:
+            # Such as a gauge named "x_total" and a counter named "x".
+            # Keep what is recorded out of the family we already have.
+            logger.warning(
+                "Ignoring %s %r%s: %s is already a %s",
+                kind, stat, labels, name, family.type)
+        return series
+
+    def _observe(self, kind, stat, value, rate, rate_applied, tags):
+        if rate >= 1:
+            weight = 1
+        elif rate_applied or self.random() < rate:
+            weight = 1.0 / rate
+        else:
+            return
+        series = self._get_series(kind, stat, tags)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series.counts[index] += weight
+            series.sum += value * weight
+            series.count += weight
+
+    def timing(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.timing`.
+        """
+        # pylint:disable=unused-argument
+        self._observe('timer', stat, value / 1000.0, rate, rate_applied, tags)
+
+    def histogram(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.histogram`.
+        """
+        # pylint:disable=unused-argument
+        self._observe('histogram', stat, value, rate, rate_applied, tags)
+
+    def distribution(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.distribution`.
+        """
+        # pylint:disable=unused-argument
+        self._observe('histogram', stat, value, rate, rate_applied, tags)
+
+    def gauge(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.gauge`.
+        """
+        # pylint:disable=unused-argument
+        if rate >= 1 or rate_applied or self.random() < rate:
+            self._get_series('gauge', stat, tags).value = value
+
+    def incr(self, stat, count=1, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.incr`.
+        """
+        # pylint:disable=unused-argument
+        if rate < 1:
+            if not rate_applied and self.random() >= rate:
+                return
+            count /= rate
+        series = self._get_series('counter', stat, tags)
+        with self._lock:
+            series.value += count
+
+    def decr(self, stat, count=1, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.decr`.
+        """
+        self.incr(stat, -count, rate=rate, buf=buf, rate_applied=rate_applied,
+                  tags=tags)
+
+    def set_add(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.set_add`.
+
+        Prometheus has no equivalent of sets, so this does nothing.
+        """
+
+    def sendbuf(self, buf):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.sendbuf`.
+
+        Metrics recorded through this object are never added to a
+        *buf*, and lines produced elsewhere are discarded.
+        """
+
+    def flush(self):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.flush`.
+
+        Metrics are only sent when scraped, so this does nothing.
+        """
+
+    def close(self):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.close`.
+
+        Stops the server started by :func:`start_prometheus_server`,
+        if any.
+        """
+        server = self.server
+        self.server = None
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    def render(self):
+        """
+        Iterate over the metrics in the Prometheus text exposition
+        format, as UTF-8 byte strings containing one metric family
+        each.
+        """
+        with self._lock:
+            families = sorted(self._families.values(), key=lambda f: f.name)
+        lock = self._lock
+        buckets = [_format_value(b) for b in self.buckets] + ['+Inf']
+        for family in families:
+            name = family.name
+            lines = ['# TYPE %s %s' % (name, family.type)]
+            # Series are only ever appended.
+            for series in family.series[:]:
+                labels = series.labels
+                if family.type != 'histogram':
+                    lines.append('%s%s %s' % (name, labels, _format_value(series.value)))
+                    continue
+                with lock:
+                    counts = series.counts[:]
+                    total = series.sum
+                    count = series.count
+                cumulative = 0
+                for bucket, bucket_count in zip(buckets, counts):
+                    cumulative += bucket_count
+                    lines.append('%s_bucket%s %s' % (
+                        name, _with_label(labels, 'le', bucket), _format_value(cumulative)))
+                lines.append('%s_sum%s %s' % (name, labels, _format_value(total)))
+                lines.append('%s_count%s %s' % (name, labels, _format_value(count)))
+            lines.append('')
+            yield '\n'.join(lines).encode('utf-8')
+
+
+def make_prometheus_app(nextapp=None, _globals=None, path='/metrics', client=None):
+    """
+    Create a WSGI app that serves the metrics of *client*, a
+    `PrometheusStatsdClient`, at *path*, and passes other requests to
+    *nextapp* (or answers them with a 404 error if there is none).
+
+    If *client* is not given, the ``statsd_client`` attribute of
+    *nextapp* is used; this composes with
+    `perfmetrics.make_statsd_app` given a ``prometheus://`` URI. As
+    a Paste filter, that looks like this::
+
+        [pipeline:main]
+        pipeline = prometheus statsd myapp
+
+        [filter:prometheus]
+        use = egg:perfmetrics#prometheus
+
+        [filter:statsd]
+        use = egg:perfmetrics#statsd
+        statsd_uri = prometheus://
+
+    .. versionadded:: 4.4.0
+    """
+    if client is None:
+        client = getattr(nextapp, 'statsd_client', None)
+    if not isinstance(client, PrometheusStatsdClient):
+        raise ValueError("A PrometheusStatsdClient is required, not %r" % (client,))
+
+    def app(environ, start_response):
+        if environ.get('PATH_INFO') == path:
+            start_response('200 OK', [('Content-Type', CONTENT_TYPE)])
+            return client.render()
+        if nextapp is not None:
+            return nextapp(environ, start_response)
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return [b'Not Found']
+
+    app.statsd_client = client
+    return app
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, *args): # pylint:disable=arguments-differ
+        # Don't write every scrape to stderr.
+        pass
+
+
+def start_prometheus_server(client, port=9102, host=''):
+    """
+    Serve the metrics of *client*, a `PrometheusStatsdClient`, over
+    HTTP on *host* and *port* from a background daemon thread, and
+    return the server.
+
+    Each request is handled in its own thread. The server is stopped
+    when *client* is closed.
+
+    .. versionadded:: 4.4.0
+    """
+    app = make_prometheus_app(client=client)
+    server = make_server(host, int(port), app,
+                         server_class=_ThreadingWSGIServer,
+                         handler_class=_QuietHandler)
+    thread = threading.Thread(
+        target=server.serve_forever,
+        name='perfmetrics-prometheus',
+    )
+    thread.daemon = True
+    thread.start()
+    client.server = server
+    return server
@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+Aggregation of metrics across processes in shared memory.
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import mmap
+import multiprocessing
+import os
+import random
+import threading
+
+from .interfaces import IStatsdClient
+from .interfaces import implementer
+from .statsd import _tag_items
+from .aggregate import _number
+from ._util import reinit_after_fork
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    'SharedMemoryStatsdClient',
+]
+
+# Layout of the shared segment. All numbers are native 8-byte
+# integers or doubles.
+#
+# Header: the flush generation and the number of registered stats.
+_HEADER_SIZE = 64
+_GENERATION = 0
+_STAT_COUNT = 1
+# Then, one pid for each stripe: the process that writes to it.
+#
+# Then, the name of each stat: a two-byte length followed by the
+# kind and ``stat|#tags``.
+_NAME_SIZE = 256
+#
+# Then, for each stripe and each stat, a slot of five doubles: the
+# (extrapolated) count or counter total, the sum of timings, the
+# lowest and highest timings, and the generation those were set in.
+_SLOT_SIZE = 5
+
+_COUNTER = 'c'
+_TIMER = 't'
+
+#: Returned by ``_index`` for metrics that can't be kept in the
+#: shared segment.
+_UNSHARED = -1
+
+
+def _pid_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Probably EPERM: it exists, but isn't ours.
+        pass
+    return True
+
+
+@implementer(IStatsdClient)
+class SharedMemoryStatsdClient(object): # pylint:disable=too-many-instance-attributes
+    """
+    Aggregate counters and timers from many processes in shared
+    memory, and send summaries from one of them.
+
+    Create this client in the parent process of a pre-forking server
+    (for example, a gunicorn master running with ``--preload``, or
+    by setting ``STATSD_URI`` with the ``shared_interval`` query
+    parameter) *before* the workers are forked. It allocates an
+    anonymous shared memory segment with room for *max_workers*
+    processes and *max_stats* distinct counters and timers (a stat
+    name and set of tags counts once for each kind).
+
+    Each process that records a metric claims a stripe of the segment
+    for itself (reusing the stripe of a process that has exited), so
+    processes never write to the same memory and need no locks to
+    update it. Counters keep a running total, and timers keep their
+    count, sum, lowest and highest values. Every *flush_interval*
+    seconds, a background thread in the process that created the
+    client adds up all the stripes and sends, through *client*, the
+    change in each counter and, for each timer, the same
+    ``<stat>.count``, ``<stat>.sum``, ``<stat>.lower`` and
+    ``<stat>.upper`` metrics as
+    `perfmetrics.aggregate.AggregatingStatsdClient` (without the
+    percentile). The number of packets therefore depends on the
+    number of stats, not the number of processes.
+
+    Counts and sums are exact. ``lower`` and ``upper`` are updated
+    without coordinating with the flushing process, so a value
+    recorded at the very moment of a flush may be left out of them.
+
+    Gauges, sets, histograms and distributions, and any metrics that
+    don't fit in the segment, are sent by each process through its
+    own *client* immediately. Only the creating process sends the
+    shared summaries; in other processes, :meth:`flush` only flushes
+    *client*.
+
+    If *flush_interval* is 0, no thread is started and the
+    application must call :meth:`flush` itself (in the creating
+    process).
+
+    This requires ``fork()``.
+
+    .. versionadded:: 4.4.0
+    """
+
+    def __init__(self, client, flush_interval=10.0, max_workers=64, max_stats=1024):
+        self.client = client
+        self.flush_interval = float(flush_interval)
+        self.max_workers = max_workers = int(max_workers)
+        self.max_stats = max_stats = int(max_stats)
+        self.random = random.random  # Testing hook
+
+        owners_end = _HEADER_SIZE + 8 * max_workers
+        self._names_offset = owners_end
+        data_offset = owners_end + _NAME_SIZE * max_stats
+        size = data_offset + 8 * _SLOT_SIZE * max_workers * max_stats
+        # An anonymous mapping is shared with the children we fork.
+        self._mmap = mmap.mmap(-1, size)
+        view = memoryview(self._mmap)
+        self._ints = view[:owners_end].cast('q')
+        self._data = view[data_offset:].cast('d')
+        view.release()
+        # The memory starts zeroed; that must not look like a timer
+        # slot that was set in the current generation.
+        self._ints[_GENERATION] = 1
+
+        # Only held to claim stripes and add names, not to record
+        # metrics.
+        self._shared_lock = multiprocessing.Lock()
+        self._lock = threading.Lock()
+        self._owner_pid = os.getpid()
+        self._stripe = None
+        self._slots = {}
+        self._names = []
+        self._previous = {}
+
+        self._stopped = threading.Event()
+        self._thread = None
+        if self.flush_interval > 0:
+            self._thread = threading.Thread(
+                target=self._flush_periodically,
+                name='perfmetrics-shared',
+            )
+            self._thread.daemon = True
+            self._thread.start()
+        reinit_after_fork(self)
+
+    def _after_fork(self):
+        # In a forked child: claim a stripe of our own when we need
+        # one. The flushing thread stays with the parent.
+        self._lock = threading.Lock()
+        self._stripe = None
+        self._thread = None
+
+    def _flush_periodically(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception: # pylint:disable=broad-except
+                logger.exception("Failed to flush shared metrics")
+
+    def close(self):
+        """
+        Stop the background thread, send the remaining metrics (in
+        the creating process), and close the underlying client.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        if self._mmap is not None:
+            self._ints.release()
+            self._data.release()
+            self._mmap.close()
+            self._mmap = None
+        self.client.close()
+
+    def _claim_stripe(self):
+        # Return the index of our stripe, or _UNSHARED if all are
+        # taken by running processes.
+        pid = os.getpid()
+        owners = self._ints
+        with self._shared_lock:
+            for stripe in range(self.max_workers):
+                owner = owners[_HEADER_SIZE // 8 + stripe]
+                if owner == pid or not owner or not _pid_is_alive(owner):
+                    owners[_HEADER_SIZE // 8 + stripe] = pid
+                    return stripe
+        logger.warning(
+            "All %d shared metric stripes are in use; process %d will send "
+            "metrics directly", self.max_workers, pid)
+        return _UNSHARED
+
+    def _sync_names(self):
+        # Learn the stats that other processes registered.
+        names = self._names
+        mm = self._mmap
+        for slot in range(len(names), self._ints[_STAT_COUNT]):
+            offset = self._names_offset + slot * _NAME_SIZE
+            length = int.from_bytes(mm[offset:offset + 2], 'little')
+            entry = mm[offset + 2:offset + 2 + length].decode('utf-8')
+            stat, has_tags, tags = entry[1:].partition('|#')
+            key = (entry[0], stat, tuple(tags.split(',')) if has_tags else None)
+            names.append(key)
+            self._slots.setdefault(key, slot)
+
+    def _register(self, key):
+        kind, stat, tags = key
+        entry = (kind + stat + ('|#' + ','.join(tags) if tags else '')).encode('utf-8')
+        with self._shared_lock:
+            self._sync_names()
+            slot = self._slots.get(key)
+            if slot is not None:
+                return slot
+            slot = self._ints[_STAT_COUNT]
+            if slot >= self.max_stats or len(entry) > _NAME_SIZE - 2:
+                # Don't ask again.
+                self._slots[key] = _UNSHARED
+                return _UNSHARED
+            offset = self._names_offset + slot * _NAME_SIZE
+            self._mmap[offset:offset + 2 + len(entry)] = (
+                len(entry).to_bytes(2, 'little') + entry)
+            # Publish the name only once it's complete.
+            self._ints[_STAT_COUNT] = slot + 1
+            self._names.append(key)
+            self._slots[key] = slot
+            return slot
+
+    def _index(self, kind, stat, tags):
+        # Return the index in the shared doubles of our slot for the
+        # metric, or _UNSHARED.
+        stripe = self._stripe
+        if stripe is None:
+            stripe = self._stripe = self._claim_stripe()
+        if stripe == _UNSHARED:
+            return _UNSHARED
+        key = (kind, stat, _tag_items(tags) if tags else None)
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._register(key)
+        if slot == _UNSHARED:
+            return _UNSHARED
+        return (stripe * self.max_stats + slot) * _SLOT_SIZE
+
+    def flush(self):
+        """
+        In the process that created this client, send the changes
+        since the last flush. In any process, flush the underlying
+        client.
+        """
+        client = self.client
+        if os.getpid() == self._owner_pid and self._mmap is not None:
+            buf = []
+            with self._shared_lock:
+                self._sync_names()
+            generation = self._ints[_GENERATION]
+            previous = self._previous
+            for slot, (kind, stat, tags) in enumerate(self._names):
+                count, total, lower, upper = self._sum_stripes(slot, kind, generation)
+                last_count, last_total = previous.get(slot, (0.0, 0.0))
+                previous[slot] = (count, total)
+                count -= last_count
+                if not count:
+                    continue
+                if kind == _COUNTER:
+                    client.incr(stat, _number(count), buf=buf, tags=tags)
+                else:
+                    client.incr(stat + '.count', _number(count), buf=buf, tags=tags)
+                    client.gauge(stat + '.sum', _number(total - last_total), buf=buf, tags=tags)
+                    if lower is not None:
+                        client.gauge(stat + '.lower', _number(lower), buf=buf, tags=tags)
+                        client.gauge(stat + '.upper', _number(upper), buf=buf, tags=tags)
+            # Timers start new lower and upper values.
+            self._ints[_GENERATION] = generation + 1
+            if buf:
+                client.sendbuf(buf)
+        client.flush()
+
+    def _sum_stripes(self, slot, kind, generation):
+        # Add up *slot* across all the stripes. Returns the count,
+        # total, lower and upper values (the last two are None unless
+        # a timer was recorded in *generation*).
+        data = self._data
+        count = total = 0.0
+        lower = upper = None
+        for index in range(slot * _SLOT_SIZE, len(data), self.max_stats * _SLOT_SIZE):
+            count += data[index]
+            total += data[index + 1]
+            if kind == _TIMER and data[index + 4] == generation:
+                if lower is None or data[index + 2] < lower:
+                    lower = data[index + 2]
+                if upper is None or data[index + 3] > upper:
+                    upper = data[index + 3]
+        return count, total, lower, upper
+
+    def timing(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.timing`.
+        """
+        index = self._index(_TIMER, stat, tags)
+        if index == _UNSHARED:
+            self.client.timing(stat, value, rate, buf, rate_applied, tags)
+            return
+        if rate >= 1:
+            weight = 1
+        elif rate_applied or self.random() < rate:
+            weight = 1.0 / rate
+        else:
+            return
+
+        data = self._data
+        generation = self._ints[_GENERATION]
+        with self._lock:
+            data[index] += weight
+            data[index + 1] += value * weight
+            if data[index + 4] != generation:
+                data[index + 2] = data[index + 3] = value
+                data[index + 4] = generation
+            elif value < data[index + 2]:
+                data[index + 2] = value
+            elif value > data[index + 3]:
+                data[index + 3] = value
+
+    def incr(self, stat, count=1, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.incr`.
+        """
+        index = self._index(_COUNTER, stat, tags)
+        if index == _UNSHARED:
+            self.client.incr(stat, count, rate, buf, rate_applied, tags)
+            return
+        if rate < 1:
+            if not rate_applied and self.random() >= rate:
+                return
+            count /= rate
+
+        data = self._data
+        with self._lock:
+            data[index] += count
+
+    def decr(self, stat, count=1, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.decr`.
+        """
+        self.incr(stat, -count, rate=rate, buf=buf, rate_applied=rate_applied,
+                  tags=tags)
+
+    def gauge(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.gauge`.
+
+        Gauges are passed to the underlying client.
+        """
+        self.client.gauge(stat, value, rate, buf, rate_applied, tags)
+
+    def set_add(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.set_add`.
+
+        Sets are passed to the underlying client.
+        """
+        self.client.set_add(stat, value, rate, buf, rate_applied, tags)
+
+    def histogram(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.histogram`.
+
+        Histograms are passed to the underlying client.
+        """
+        self.client.histogram(stat, value, rate, buf, rate_applied, tags)
+
+    def distribution(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.distribution`.
+
+        Distributions are passed to the underlying client.
+        """
+        self.client.distribution(stat, value, rate, buf, rate_applied, tags)
+
+    def sendbuf(self, buf):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.sendbuf`.
+        """
+        if buf:
+            self.client.sendbuf(buf)
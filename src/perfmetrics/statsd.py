@@ -1,3 +1,4 @@
+# cython: auto_pickle=False,embedsignature=True,always_allow_keywords=False
 # -*- coding: utf-8 -*-
 """
 Statsd client implementations.
@@ -7,184 +8,902 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import atexit
+import errno
 import logging
 import random
 import socket
-
-try:
-    # Python 3
-    from urllib.parse import urlsplit
-    from urllib.parse import parse_qsl
-    from urllib.parse import uses_query
-
-    basestring = str
-
-except ImportError: # pragma: no cover
-    # Python 2
-    from urlparse import urlsplit
-    from urlparse import parse_qsl
-    from urlparse import uses_query
+import struct
+import threading
+import weakref
+from collections import deque
+from time import monotonic
 
 from .interfaces import IStatsdClient
+from .interfaces import classImplements
 from .interfaces import implementer
+from ._util import PURE_PYTHON
+from ._util import reinit_after_fork
+
+# Not __name__, which is perfmetrics._statsd when compiled.
+logger = logging.getLogger('perfmetrics.statsd')
 
-logger = logging.getLogger(__name__)
+sendmmsg = None
+if not PURE_PYTHON: # pragma: no cover
+    try:
+        from ._sendmmsg import sendmmsg
+    except ImportError:
+        # Not Linux, or not compiled.
+        pass
 
 __all__ = [
     'StatsdClient',
     'StatsdClientMod',
     'NullStatsdClient',
-    'statsd_client_from_uri',
 ]
 
-if 'statsd' not in uses_query:  # pragma: no cover
-    uses_query.append('statsd')
+#: Names defined in perfmetrics.transports that are also available
+#: here, where they used to be.
+_TRANSPORTS = frozenset((
+    'UnixStatsdClient',
+    'TCPStatsdClient',
+    'ShardedStatsdClient',
+    'statsd_client_from_uri',
+))
+
+#: Errors meaning the socket's buffer is full. These are expected with
+#: non-blocking sockets under load, and count as drops.
+_DROP_ERRNOS = frozenset(
+    getattr(errno, name)
+    for name in ('EAGAIN', 'EWOULDBLOCK', 'ENOBUFS')
+    if hasattr(errno, name)
+)
+
+
+#: Errors meaning the server can't be reached at its current address;
+#: another address may work.
+_FAILOVER_ERRNOS = frozenset(
+    getattr(errno, name)
+    for name in ('ECONNREFUSED', 'EHOSTUNREACH', 'ENETUNREACH')
+    if hasattr(errno, name)
+)
+
+
+def _as_bool(value):
+    # Values from a URI are strings.
+    if isinstance(value, str):
+        return value.lower() in {'1', 'true', 'yes', 'on'}
+    return bool(value)
+
+
+def _line_count(packet):
+    return packet.count(b'\n') + 1
 
-def statsd_client_from_uri(uri):
+
+def _encoded_lines(lines):
+    """
+    Return the sequence *lines* with any native strings encoded.
+
+    The clients here always produce bytes, but a caller may have
+    formatted some lines itself.
     """
-    Create and return :class:`perfmetrics.statsd.StatsdClient`.
+    for line in lines:
+        if not isinstance(line, bytes):
+            return [
+                line if isinstance(line, bytes) else line.encode('ascii')
+                for line in lines
+            ]
+    return lines
 
-    A typical URI is ``statsd://localhost:8125``. An optional query
-    parameter is ``prefix``. The default prefix is an empty string.
 
+def _tag_items(tags):
     """
-    parts = urlsplit(uri)
-    if parts.scheme != 'statsd':
-        raise ValueError("URI scheme not supported: %s" % uri)
+    Return *tags* in canonical form: a sorted tuple of unique
+    ``key:value`` strings.
 
-    kw = {}
-    if parts.query:
-        kw.update(parse_qsl(parts.query))
-    return StatsdClient(parts.hostname, parts.port, **kw)
+    *tags* is a mapping (a key with a value of None becomes a bare
+    ``key`` tag) or an iterable of ``key:value`` strings.
+    """
+    if hasattr(tags, 'items'):
+        tags = [
+            key if value is None else '%s:%s' % (key, value)
+            for key, value in tags.items()
+        ]
+    return tuple(sorted(set(tags)))
 
 
-@implementer(IStatsdClient)
-class StatsdClient(object):
+def _iter_packets(lines, packet_size):
     """
-    Send packets to statsd.
+    Join the byte string *lines* into packets, each no larger
+    than *packet_size* bytes unless a single line is larger than that.
+    """
+    batch = []
+    batch_size = 0
+    for line in lines:
+        size = len(line)
+        if batch:
+            if batch_size + 1 + size > packet_size:
+                yield b'\n'.join(batch)
+                batch = []
+                batch_size = 0
+            else:
+                size += 1
+        batch.append(line)
+        batch_size += size
+    if batch:
+        yield b'\n'.join(batch)
 
-    Default implementation of :class:`perfmetrics.interfaces.IStatsdClient`.
 
-    Derived from statsd.py by Steve Ivy <steveivy@gmail.com>.
+class _PreciseMilliseconds(float):
+    # The elapsed milliseconds measured by ``Metric(precise=True)``.
+    # Clients that would send whole milliseconds send these to the
+    # microsecond instead.
+    __slots__ = ()
+
+
+def _make_timing_format(unit, precision):
+    if precision > 0:
+        return ('%%.%df|%s' % (precision, unit)).encode('ascii')
+    return ('%%d|%s' % (unit,)).encode('ascii')
+
+
+def _pack_sockaddr(family, addr):
     """
+    Return the ``struct sockaddr`` for the Python socket address
+    *addr* as bytes, or None if we don't know how.
 
-    def __init__(self, host='localhost', port=8125, prefix=''):
-        # Resolve the host name early.
-        info = socket.getaddrinfo(host, int(port), 0, socket.SOCK_DGRAM)
-        family, socktype, proto, _canonname, addr = info[0]
-        self.addr = addr
-        self.log = logger
-        self.udp_sock = socket.socket(family, socktype, proto)
+    This is only used with ``sendmmsg``, so the layout is Linux's.
+    """
+    if family == socket.AF_INET:
+        host, port = addr
+        return (struct.pack('=H', family) + struct.pack('!H', port)
+                + socket.inet_pton(family, host) + b'\0' * 8)
+    if family == socket.AF_INET6:
+        host, port, flowinfo, scope_id = addr
+        return (struct.pack('=H', family) + struct.pack('!HI', port, flowinfo)
+                + socket.inet_pton(family, host.split('%')[0])
+                + struct.pack('=I', scope_id))
+    if family == getattr(socket, 'AF_UNIX', None):
+        return struct.pack('=H', family) + addr.encode('utf-8') + b'\0'
+    return None
+
+
+class _AbstractStatsdClient(object):
+    """
+    Formats metrics as statsd lines.
+
+    Subclasses implement ``_send`` to deliver a byte string of one or
+    more lines, and ``sendbuf``.
+    """
+
+    #: The maximum number of encoded stat names (and, separately,
+    #: tag sets) to cache.
+    max_cached_stats = 10000
+
+    def __init__(self, prefix='', timing_unit='ms', timing_precision=0):
         self.random = random.random  # Testing hook
         if prefix and not prefix.endswith('.'):
             prefix += '.'
         self.prefix = prefix
+        self._stat_cache = {}
+        self._tag_cache = {}
 
-    def close(self):
-        """
-        See :meth:`perfmetrics.interfaces.IStatsdClient.close`.
+        if timing_unit not in ('ms', 'us'):
+            raise ValueError("timing_unit must be 'ms' or 'us', not %r" % (timing_unit,))
+        # Values from a URI are strings.
+        self.timing_unit = timing_unit
+        self.timing_precision = timing_precision = int(timing_precision)
+        self.fractional_timing = timing_precision > 0 or timing_unit == 'us'
+        # Timings are always given to us in milliseconds.
+        self._timing_scale = 1000 if timing_unit == 'us' else 1
+        self._timing_format = _make_timing_format(timing_unit, timing_precision)
+        # Whole microseconds are already precise.
+        self._precise_timing_format = _make_timing_format(
+            timing_unit,
+            timing_precision if timing_unit == 'us' else max(timing_precision, 3))
 
-        .. versionadded:: 3.0
-        """
-        if self.udp_sock:
-            self.udp_sock.close()
-            self.udp_sock = None
+    def _encode_stat(self, stat):
+        # Return ``prefix + stat + ':'`` as bytes. Applications use a
+        # bounded number of stat names, so cache them; if we see an
+        # unreasonable number, start over.
+        cache = self._stat_cache
+        try:
+            return cache[stat]
+        except KeyError:
+            if len(cache) >= self.max_cached_stats:
+                cache.clear()
+            encoded = cache[stat] = (self.prefix + stat + ':').encode('ascii')
+            return encoded
+
+    def _encode_tags(self, tags):
+        # Return ``|#k:v,...`` as bytes. Like stat names, the tag sets
+        # an application uses are usually few and repeated, so the
+        # canonical encoding is cached by the (hashable) items given.
+        if isinstance(tags, dict):
+            key = tuple(tags.items())
+        elif isinstance(tags, (tuple, list)):
+            key = tuple(tags)
+        elif hasattr(tags, 'items'):
+            # Other mappings, as in _tag_items.
+            key = tuple(tags.items())
+        else:
+            # Any other iterable, which may only be iterated once.
+            tags = key = tuple(tags)
+        cache = self._tag_cache
+        try:
+            return cache[key]
+        except KeyError:
+            if len(cache) >= self.max_cached_stats:
+                cache.clear()
+            encoded = cache[key] = ('|#' + ','.join(_tag_items(tags))).encode('ascii')
+            return encoded
 
-    def timing(self, stat, value, rate=1, buf=None, rate_applied=False):
+    def timing(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
         """
         See :meth:`perfmetrics.interfaces.IStatsdClient.timing`.
 
         """
         if rate >= 1 or rate_applied or self.random() < rate:
-            s = '%s%s:%d|ms' % (self.prefix, stat, value)
+            if type(value) is _PreciseMilliseconds: # pylint:disable=unidiomatic-typecheck
+                timing_format = self._precise_timing_format
+            else:
+                timing_format = self._timing_format
+            if self._timing_scale != 1:
+                value *= self._timing_scale
+            s = self._encode_stat(stat) + timing_format % value
+            if tags:
+                s += self._encode_tags(tags)
             if buf is None:
                 self._send(s)
             else:
                 buf.append(s)
 
-    def gauge(self, stat, value, rate=1, buf=None, rate_applied=False):
+    def gauge(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
         """
         See :meth:`perfmetrics.interfaces.IStatsdClient.gauge`.
         """
         if rate >= 1 or rate_applied or self.random() < rate:
-            s = '%s%s:%s|g' % (self.prefix, stat, value)
+            s = self._encode_stat(stat) + ('%s|g' % (value,)).encode('ascii')
+            if tags:
+                s += self._encode_tags(tags)
             if buf is None:
                 self._send(s)
             else:
                 buf.append(s)
 
-    def incr(self, stat, count=1, rate=1, buf=None, rate_applied=False):
+    def incr(self, stat, count=1, rate=1, buf=None, rate_applied=False, tags=None):
         """
         See :meth:`perfmetrics.interfaces.IStatsdClient.incr`.
         """
         if rate >= 1:
-            s = '%s%s:%s|c' % (self.prefix, stat, count)
+            suffix = '%s|c' % (count,)
         elif rate_applied or self.random() < rate:
-            s = '%s%s:%s|c|@%s' % (self.prefix, stat, count, rate)
+            suffix = '%s|c|@%s' % (count, rate)
         else:
             return
 
+        s = self._encode_stat(stat) + suffix.encode('ascii')
+        if tags:
+            s += self._encode_tags(tags)
         if buf is None:
             self._send(s)
         else:
             buf.append(s)
 
-    def decr(self, stat, count=1, rate=1, buf=None, rate_applied=False):
+    def decr(self, stat, count=1, rate=1, buf=None, rate_applied=False, tags=None):
         """
         See :meth:`perfmetrics.interfaces.IStatsdClient.decr`.
         """
-        self.incr(stat, -count, rate=rate, buf=buf, rate_applied=rate_applied)
+        self.incr(stat, -count, rate, buf, rate_applied, tags)
 
-    def set_add(self, stat, value, rate=1, buf=None, rate_applied=False):
+    def set_add(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
         """
         See :meth:`perfmetrics.interfaces.IStatsdClient.set_add`.
         """
         if rate >= 1 or rate_applied or self.random() < rate:
-            s = '%s%s:%s|s' % (self.prefix, stat, value)
+            s = self._encode_stat(stat) + ('%s|s' % (value,)).encode('ascii')
+            if tags:
+                s += self._encode_tags(tags)
             if buf is None:
                 self._send(s)
             else:
                 buf.append(s)
 
+    def histogram(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.histogram`.
+        """
+        if rate >= 1:
+            suffix = '%s|h' % (value,)
+        elif rate_applied or self.random() < rate:
+            suffix = '%s|h|@%s' % (value, rate)
+        else:
+            return
+
+        s = self._encode_stat(stat) + suffix.encode('ascii')
+        if tags:
+            s += self._encode_tags(tags)
+        if buf is None:
+            self._send(s)
+        else:
+            buf.append(s)
+
+    def distribution(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.distribution`.
+        """
+        if rate >= 1:
+            suffix = '%s|d' % (value,)
+        elif rate_applied or self.random() < rate:
+            suffix = '%s|d|@%s' % (value, rate)
+        else:
+            return
+
+        s = self._encode_stat(stat) + suffix.encode('ascii')
+        if tags:
+            s += self._encode_tags(tags)
+        if buf is None:
+            self._send(s)
+        else:
+            buf.append(s)
+
     def _send(self, data):
-        """Send a UDP packet containing a string."""
+        raise NotImplementedError # pragma: no cover
+
+
+class StatsdClient(_AbstractStatsdClient): # pylint:disable=too-many-instance-attributes
+    """
+    Send packets to statsd.
+
+    Default implementation of :class:`perfmetrics.interfaces.IStatsdClient`.
+
+    Derived from statsd.py by Steve Ivy <steveivy@gmail.com>.
+
+    By default, each metric (or each buffer passed to :meth:`sendbuf`)
+    is sent in its own UDP packet. If *packet_size* is a positive
+    number of bytes, the client instead coalesces the lines from all
+    calls into datagrams no larger than *packet_size* (a line that is
+    larger than that on its own is sent by itself). A pending datagram
+    is sent when the next line would not fit, when its oldest line is
+    more than *flush_interval* seconds old, when :meth:`flush` is
+    called, when the client is closed, or when the interpreter exits.
+    A background daemon thread flushes the client every
+    *flush_interval* seconds, so lines don't wait for more traffic.
+    Good values for *packet_size* are 512 for the public internet and
+    1432 for a typical Ethernet LAN.
+
+    If *queue_size* is a positive number, metrics are sent by a
+    background daemon thread instead of the calling thread. Sending a
+    metric then only appends its line to a queue, and the thread
+    wakes up every *flush_interval* seconds (or sooner, when the
+    queue is half full) to send everything in the queue, coalesced
+    into packets of *packet_size* bytes (1432 if coalescing is not
+    otherwise enabled). Lines that arrive when the queue already
+    holds *queue_size* lines are discarded and counted in the
+    ``dropped`` attribute. The queue is sent when the client is
+    flushed or closed, and when the interpreter exits.
+
+    Timings are sent as whole milliseconds (``|ms``) by default, so
+    anything faster than a millisecond is reported as 0. Set
+    *timing_precision* to send that many decimal places, and set
+    *timing_unit* to ``'us'`` to convert timings to microseconds and
+    send them with the ``|us`` type instead (only some servers
+    understand that). Either way, :meth:`timing` is still given
+    milliseconds, and the ``fractional_timing`` attribute is true, so
+    `perfmetrics.Metric` passes the exact elapsed time rather than
+    whole milliseconds. Timings from a ``Metric(precise=True)`` are
+    sent with at least three decimal places even if
+    *timing_precision* is not set.
+
+    If *nonblocking* is true, the socket is connected to the server
+    once and put in non-blocking mode, so sending never waits for
+    room in the socket's buffer; *sndbuf*, if given, sets the size of
+    that buffer (``SO_SNDBUF``) in bytes. Packets that can't be sent
+    because the buffer is full (``EAGAIN`` or ``ENOBUFS``) are not
+    logged; their lines are counted in ``dropped``. Other failures
+    are counted in ``errors``, and logged at most once every
+    :attr:`error_log_interval` seconds, with the number of failures
+    since the previous message. Failures that haven't been logged
+    yet when sending starts working again are logged once the
+    interval has passed, by the next successful send or flush, or
+    when the client is closed.
+
+    The host name is resolved when the client is created, and all
+    the addresses it resolves to (of the same family as the first)
+    are kept. If sending fails because the server can't be reached
+    (``ECONNREFUSED``, ``EHOSTUNREACH`` or ``ENETUNREACH``; a
+    connected socket reports ``ECONNREFUSED`` when earlier packets
+    were refused), the client switches to the next address. If
+    *resolve_interval* is a positive number of seconds, a background
+    daemon thread calls :meth:`resolve` that often, so the client
+    follows a server whose address changes. Sending never waits for
+    a lookup.
+
+    The client can be created before a server forks its workers.
+    After ``fork()``, the child process opens its own socket, starts
+    its own background threads, and discards the lines that were
+    waiting to be sent (the parent still sends them), so nothing is
+    counted twice.
+
+    .. versionchanged:: 4.4.0
+       Add the *packet_size*, *flush_interval*, *queue_size*,
+       *timing_unit*, *timing_precision*, *nonblocking*, *sndbuf* and
+       *resolve_interval* parameters.
+    .. versionchanged:: 4.4.0
+       Failures to send are logged at most once per
+       :attr:`error_log_interval` and counted in ``errors``.
+    .. versionchanged:: 4.4.0
+       Reinitialize in a child process after ``fork()``.
+    """
+
+    #: The minimum number of seconds between messages logging
+    #: failures to send.
+    error_log_interval = 60.0
+
+    def __init__(self, host='localhost', port=8125, prefix='',
+                 packet_size=0, flush_interval=1.0, queue_size=0,
+                 timing_unit='ms', timing_precision=0,
+                 nonblocking=False, sndbuf=0, resolve_interval=0):
+        # Check the arguments before opening the socket.
+        super().__init__(prefix, timing_unit, timing_precision)
+        self.host = host
+        self.port = port
+        self.log = logger
+        self._addrs = ()
+        self.udp_sock, self.addr = self._open_socket()
+        if not self._addrs:
+            self._addrs = (self.addr,)
+        # Values from a URI are strings.
+        self.packet_size = int(packet_size)
+        self.flush_interval = float(flush_interval)
+        self.queue_size = int(queue_size)
+        self.nonblocking = _as_bool(nonblocking)
+        self.sndbuf = int(sndbuf)
+        self.resolve_interval = float(resolve_interval)
+        #: The number of lines discarded because a queue or the
+        #: socket's buffer was full.
+        self.dropped = 0
+        #: The number of failed attempts to send, other than drops.
+        self.errors = 0
+        self._unlogged_errors = 0
+        self._error_logged_at = None
+        self._connected = False
+        self._sockaddr = None
+        self._batch = []
+        self._batch_size = 0
+        self._batch_started = 0.0
+        self._batch_lock = threading.Lock()
+        self._queue = None
+        self._sender = None
+        if self.udp_sock is not None:
+            self._configure_socket(self.udp_sock)
+        if self.queue_size > 0:
+            self._queue = deque()
+        if self._queue is not None or self.packet_size > 0:
+            self._wakeup = threading.Event()
+            self._stopping = False
+            self._start_sender()
+        self._resolver = None
+        # Subclasses without a host name to look up don't need the
+        # thread; their resolve() does nothing.
+        if self.resolve_interval > 0 and self.host is not None and self.udp_sock is not None:
+            self._start_resolver()
+        reinit_after_fork(self)
+
+    def _after_fork(self):
+        # In a forked child. The socket is shared with the parent, the
+        # background threads didn't survive, and the pending lines
+        # belong to the parent, which will send them.
         try:
-            self.udp_sock.sendto(data.encode('ascii'), self.addr)
+            self._reopen_socket()
         except IOError:
-            self.log.exception("Failed to send UDP packet")
+            # Keep sharing the parent's socket, but don't leave the
+            # rest of the parent's state behind.
+            self.log.exception("Failed to open a new socket after fork")
+        self.dropped = 0
+        self.errors = 0
+        self._unlogged_errors = 0
+        self._error_logged_at = None
+        self._batch_lock = threading.Lock()
+        self._batch = []
+        self._batch_size = 0
+        if self._queue is not None:
+            self._queue.clear()
+        if self._sender is not None:
+            self._wakeup = threading.Event()
+            self._stopping = False
+            self._start_sender()
+        if self._resolver is not None:
+            self._start_resolver()
+
+    def _reopen_socket(self):
+        sock = self.udp_sock
+        # Anything else (such as the in-memory socket of
+        # perfmetrics.testing.FakeStatsDClient) isn't shared with the
+        # parent's process.
+        if isinstance(sock, socket.socket):
+            self.udp_sock = socket.socket(sock.family, sock.type, sock.proto)
+            sock.close()
+            self._connected = False
+            self._configure_socket(self.udp_sock)
+
+    def _open_socket(self):
+        """
+        Return a new socket and the address to send to.
+        """
+        # Resolve the host name early.
+        info = socket.getaddrinfo(self.host, int(self.port), 0, socket.SOCK_DGRAM)
+        family, socktype, proto, _canonname, addr = info[0]
+        self._addrs = self._family_addresses(info, family)
+        return socket.socket(family, socktype, proto), addr
+
+    @staticmethod
+    def _family_addresses(info, family):
+        addrs = []
+        for info_family, _socktype, _proto, _canonname, addr in info:
+            if info_family == family and addr not in addrs:
+                addrs.append(addr)
+        return tuple(addrs)
+
+    def resolve(self):
+        """
+        Look up the host name again.
+
+        If the current address is no longer among the results, switch
+        to the first one. Only addresses of the socket's family are
+        considered. Raises :exc:`OSError` if the lookup fails.
+
+        .. versionadded:: 4.4.0
+        """
+        family = self.udp_sock.family
+        info = socket.getaddrinfo(self.host, int(self.port), family, socket.SOCK_DGRAM)
+        addrs = self._family_addresses(info, family)
+        if addrs:
+            self._addrs = addrs
+            if self.addr not in addrs:
+                self.log.info("Statsd host %s moved to %s", self.host, addrs[0])
+                self._use_address(addrs[0])
+
+    def _use_address(self, addr):
+        # Assigning the attribute is atomic; senders pick up the new
+        # address with their next packet.
+        self.addr = addr
+        if self._connected:
+            try:
+                self.udp_sock.connect(addr)
+            except IOError as e:
+                self._send_failed(e, 0)
+
+    def _failover(self):
+        addrs = self._addrs
+        if len(addrs) > 1:
+            try:
+                index = addrs.index(self.addr)
+            except ValueError:
+                index = -1
+            self._use_address(addrs[(index + 1) % len(addrs)])
+
+    def _start_resolver(self):
+        self._resolver_stop = threading.Event()
+        self._resolver = threading.Thread(
+            target=self._run_resolver,
+            name='perfmetrics-resolver',
+        )
+        self._resolver.daemon = True
+        self._resolver.start()
+
+    def _stop_resolver(self):
+        resolver = self._resolver
+        if resolver is not None:
+            self._resolver = None
+            self._resolver_stop.set()
+            resolver.join()
+
+    def _run_resolver(self):
+        stop = self._resolver_stop
+        while not stop.wait(self.resolve_interval):
+            try:
+                self.resolve()
+            except IOError:
+                self.log.warning("Failed to resolve statsd host %s", self.host,
+                                 exc_info=True)
+
+    def _configure_socket(self, sock):
+        if self.sndbuf > 0:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.nonblocking:
+            try:
+                sock.connect(self.addr)
+            except IOError:
+                # For example, no server is listening on a Unix socket
+                # yet. Keep using sendto.
+                self.log.warning("Failed to connect to statsd at %s", self.addr,
+                                 exc_info=True)
+            else:
+                self._connected = True
+            sock.setblocking(False)
+
+    def _send_failed(self, exc, lines):
+        """
+        Account for the *lines* that could not be sent because of
+        *exc*.
+        """
+        error = getattr(exc, 'errno', None)
+        if error in _DROP_ERRNOS:
+            self.dropped += lines
+            return
+        self.errors += 1
+        if error in _FAILOVER_ERRNOS:
+            self._failover()
+        self._unlogged_errors += 1
+        logged_at = self._error_logged_at
+        if logged_at is None or monotonic() - logged_at >= self.error_log_interval:
+            self._log_errors(exc)
+
+    def _log_unlogged_errors(self, force=False):
+        """
+        Log the failures counted since the last message, if it was
+        at least :attr:`error_log_interval` seconds ago (or *force*
+        is true), so they are reported even if sending stops failing.
+        """
+        if force or monotonic() - self._error_logged_at >= self.error_log_interval:
+            self._log_errors(None)
+
+    def _log_errors(self, exc):
+        count = self._unlogged_errors
+        self._unlogged_errors = 0
+        self._error_logged_at = monotonic()
+        self.log.error(
+            "Failed to send to statsd (failures since the last message: %d)",
+            count, exc_info=exc)
+
+    def close(self):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.close`.
+
+        .. versionadded:: 3.0
+        """
+        self._stop_resolver()
+        self._stop_sender()
+        self.flush()
+        if self._unlogged_errors:
+            self._log_unlogged_errors(True)
+        if self.udp_sock:
+            self.udp_sock.close()
+            self.udp_sock = None
+
+    def flush(self):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.flush`.
+
+        .. versionadded:: 4.4.0
+        """
+        if self._queue is not None:
+            self._send_queued()
+        with self._batch_lock:
+            packet = self._take_batch()
+        if packet:
+            self._send_packet(packet)
+        if self._unlogged_errors:
+            self._log_unlogged_errors()
+
+    def _start_sender(self):
+        self._sender = threading.Thread(
+            target=self._run_sender,
+            name='perfmetrics-sender',
+        )
+        self._sender.daemon = True
+        self._sender.start()
+        _background_clients.add(self)
+
+    def _stop_sender(self):
+        sender = self._sender
+        if sender is not None:
+            self._sender = None
+            self._stopping = True
+            self._wakeup.set()
+            sender.join()
+            _background_clients.discard(self)
+
+    def _run_sender(self):
+        wakeup = self._wakeup
+        while not self._stopping:
+            wakeup.wait(self.flush_interval)
+            wakeup.clear()
+            try:
+                self.flush()
+            except Exception: # pylint:disable=broad-except
+                self.log.exception("Failed to send queued metrics")
+
+    def _send_queued(self):
+        queue = self._queue
+        popleft = queue.popleft
+        lines = []
+        try:
+            for _ in range(len(queue)):
+                lines.append(popleft())
+        except IndexError: # pragma: no cover
+            # Another thread flushed at the same time.
+            pass
+        if lines:
+            self.send_packets(list(_iter_packets(lines, self.packet_size or 1432)))
+
+    def _enqueue(self, lines):
+        queue = self._queue
+        queued = len(queue)
+        room = self.queue_size - queued
+        if room < len(lines):
+            self.dropped += len(lines) - max(room, 0)
+            lines = lines[:max(room, 0)]
+        queue.extend(lines)
+        if queued < self.queue_size // 2 <= queued + len(lines):
+            self._wakeup.set()
+
+    def _send(self, data):
+        """Send (or batch) a byte string containing one or more lines."""
+        if not isinstance(data, bytes):
+            data = data.encode('ascii')
+        if self._queue is not None:
+            self._enqueue((data,))
+        elif self.packet_size > 0:
+            self._batch_lines((data,))
+        else:
+            self._send_packet(data)
+
+    def _send_packet(self, packet):
+        """Send a UDP packet containing bytes."""
+        try:
+            if self._connected:
+                self.udp_sock.send(packet)
+            else:
+                self.udp_sock.sendto(packet, self.addr)
+        except IOError as e:
+            self._send_failed(e, _line_count(packet))
+        else:
+            if self._unlogged_errors:
+                self._log_unlogged_errors()
+
+    def send_packets(self, packets):
+        """
+        Send each of the byte strings in the list *packets* as its
+        own packet.
+
+        On Linux, this uses the ``sendmmsg`` system call to send up
+        to 1024 datagrams at once. Elsewhere, the packets are sent one
+        at a time. This is used to flush coalesced and queued metrics.
+
+        .. versionadded:: 4.4.0
+        """
+        sock = self.udp_sock
+        if (sendmmsg is not None
+                and len(packets) > 1
+                and isinstance(sock, socket.socket)):
+            addr = self.addr
+            cached = self._sockaddr
+            if cached is None or cached[0] != addr:
+                cached = self._sockaddr = (addr, _pack_sockaddr(sock.family, addr))
+            if cached[1] is not None:
+                try:
+                    sent = sendmmsg(sock.fileno(), packets, cached[1])
+                except IOError as e:
+                    self._send_failed(e, sum(_line_count(p) for p in packets))
+                else:
+                    if sent < len(packets):
+                        # A full non-blocking socket.
+                        self.dropped += sum(_line_count(p) for p in packets[sent:])
+                    if self._unlogged_errors:
+                        self._log_unlogged_errors()
+                return
+
+        for packet in packets:
+            self._send_packet(packet)
+
+    def _take_batch(self):
+        # Return the pending datagram, if any, and start a new
+        # one. The caller must hold the batch lock.
+        if not self._batch:
+            return None
+        packet = b'\n'.join(self._batch)
+        self._batch = []
+        self._batch_size = 0
+        return packet
+
+    def _batch_lines(self, lines):
+        packets = []
+        packet_size = self.packet_size
+        now = monotonic()
+        with self._batch_lock:
+            for line in lines:
+                size = len(line)
+                if self._batch:
+                    if self._batch_size + 1 + size > packet_size:
+                        packets.append(self._take_batch())
+                    else:
+                        size += 1 # The newline separator
+                if not self._batch:
+                    self._batch_started = now
+                self._batch.append(line)
+                self._batch_size += size
+            if (self._batch_size >= packet_size
+                    or now - self._batch_started >= self.flush_interval):
+                packets.append(self._take_batch())
+        # Don't hold the lock while making system calls.
+        if packets:
+            self.send_packets(packets)
 
     def sendbuf(self, buf):
         """
         See :meth:`perfmetrics.interfaces.IStatsdClient.sendbuf`.
+
+        .. versionchanged:: 4.4.0
+           When packet coalescing is enabled, the lines in *buf* are
+           added to the pending datagrams instead of being joined into
+           a single (possibly oversized) packet.
         """
         if buf:
-            self._send('\n'.join(buf))
+            buf = _encoded_lines(buf)
+            if self._queue is not None:
+                self._enqueue(buf)
+            elif self.packet_size > 0:
+                self._batch_lines(buf)
+            else:
+                self._send_packet(b'\n'.join(buf))
+
+classImplements(StatsdClient, IStatsdClient)
+
+
+#: Clients with a background sender thread (those that queue or
+#: coalesce lines), to be flushed at exit.
+_background_clients = weakref.WeakSet()
+
+@atexit.register
+def _flush_background_clients():
+    for client in list(_background_clients):
+        client._stop_sender() # pylint:disable=protected-access
+        client.flush()
 
 
-@implementer(IStatsdClient)
 class StatsdClientMod(object):
     """
     Wrap `StatsdClient`, modifying all stat names in context.
 
+    If *tags* are given, they are added to the tags of every metric
+    sent through this object.
+
     .. versionchanged:: 3.0
 
        The wrapped object's attributes are now accessible on this object.
 
        This object now uses ``__slots__``.
+
+    .. versionchanged:: 4.4.0
+       Add the *tags* parameter.
+    .. versionchanged:: 4.4.0
+       Formatted stat names are kept in a bounded cache.
     """
 
     __slots__ = (
         '_wrapped',
         'format',
+        'tags',
+        '_stat_cache',
     )
 
-    def __init__(self, wrapped, format): # pylint: disable=redefined-builtin
+    #: The maximum number of formatted stat names to cache.
+    max_cached_stats = 10000
+
+    def __init__(self, wrapped, format, tags=None): # pylint: disable=redefined-builtin
         self._wrapped = wrapped
         self.format = format
+        self.tags = _tag_items(tags) if tags else None
+        self._stat_cache = {}
 
     def close(self):
         self._wrapped.close()
 
+    def flush(self):
+        self._wrapped.flush()
+
     def __getattr__(self, name):
         return getattr(self._wrapped, name)
 
@@ -194,24 +913,134 @@ class StatsdClientMod(object):
         else:
             setattr(self._wrapped, name, value)
 
-    def timing(self, stat, *args, **kw):
-        self._wrapped.timing(self.format % stat, *args, **kw)
+    def _tags(self, tags):
+        if not tags:
+            return self.tags
+        if not self.tags:
+            return tags
+        return self.tags + _tag_items(tags)
 
-    def gauge(self, stat, *args, **kw):
-        self._wrapped.gauge(self.format % stat, *args, **kw)
+    def _format(self, stat):
+        # Return ``self.format % stat``. Like the clients, cache the
+        # results, starting over if there are too many.
+        cache = self._stat_cache
+        try:
+            return cache[stat]
+        except KeyError:
+            if len(cache) >= self.max_cached_stats:
+                cache.clear()
+            formatted = cache[stat] = self.format % stat
+            return formatted
 
-    def incr(self, stat, *args, **kw):
-        self._wrapped.incr(self.format % stat, *args, **kw)
+    # Only pass tags when there are some, so clients written before
+    # tags existed can still be wrapped.
 
-    def decr(self, stat, *args, **kw):
-        self._wrapped.decr(self.format % stat, *args, **kw)
+    def timing(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        tags = self._tags(tags)
+        if tags:
+            self._wrapped.timing(self._format(stat), value, rate, buf, rate_applied, tags)
+        else:
+            self._wrapped.timing(self._format(stat), value, rate, buf, rate_applied)
 
-    def set_add(self, stat, *args, **kw):
-        self._wrapped.set_add(self.format % stat, *args, **kw)
+    def gauge(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        tags = self._tags(tags)
+        if tags:
+            self._wrapped.gauge(self._format(stat), value, rate, buf, rate_applied, tags)
+        else:
+            self._wrapped.gauge(self._format(stat), value, rate, buf, rate_applied)
+
+    def incr(self, stat, count=1, rate=1, buf=None, rate_applied=False, tags=None):
+        tags = self._tags(tags)
+        if tags:
+            self._wrapped.incr(self._format(stat), count, rate, buf, rate_applied, tags)
+        else:
+            self._wrapped.incr(self._format(stat), count, rate, buf, rate_applied)
+
+    def decr(self, stat, count=1, rate=1, buf=None, rate_applied=False, tags=None):
+        tags = self._tags(tags)
+        if tags:
+            self._wrapped.decr(self._format(stat), count, rate, buf, rate_applied, tags)
+        else:
+            self._wrapped.decr(self._format(stat), count, rate, buf, rate_applied)
+
+    def set_add(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        tags = self._tags(tags)
+        if tags:
+            self._wrapped.set_add(self._format(stat), value, rate, buf, rate_applied, tags)
+        else:
+            self._wrapped.set_add(self._format(stat), value, rate, buf, rate_applied)
+
+    def histogram(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        tags = self._tags(tags)
+        if tags:
+            self._wrapped.histogram(self._format(stat), value, rate, buf, rate_applied, tags)
+        else:
+            self._wrapped.histogram(self._format(stat), value, rate, buf, rate_applied)
+
+    def distribution(self, stat, value, rate=1, buf=None, rate_applied=False, tags=None):
+        tags = self._tags(tags)
+        if tags:
+            self._wrapped.distribution(self._format(stat), value, rate, buf, rate_applied,
+                                       tags)
+        else:
+            self._wrapped.distribution(self._format(stat), value, rate, buf, rate_applied)
 
     def sendbuf(self, buf):
         self._wrapped.sendbuf(buf)
 
+classImplements(StatsdClientMod, IStatsdClient)
+
+
+def _compose_mod(client, format, tags, mods=None): # pylint: disable=redefined-builtin
+    """
+    Return a `StatsdClientMod` that applies *format* and *tags*
+    to stats sent to *client*.
+
+    If *client* is itself a `StatsdClientMod` whose format has a
+    single plain ``%s``, the result wraps the same client with the
+    two formats (and tag sets) combined, so that nested prefixes cost
+    one format operation instead of one per level.
+
+    *mods*, if given, is a dict kept by the caller for this *format*
+    and *tags*. It caches, by the format and tags of *client* (if it
+    is a `StatsdClientMod`), how they combine and the stat names
+    formatted so far, so that the wrappers made for each call share
+    them. It holds no reference to any client.
+    """
+    # pylint:disable=protected-access,unidiomatic-typecheck
+    if type(client) is StatsdClientMod:
+        key = (client.format, client.tags)
+    else:
+        key = None
+    recipe = mods.get(key) if mods is not None else None
+    if recipe is None:
+        recipe = _mod_recipe(client, format, tags)
+        if mods is not None:
+            if len(mods) >= 16:
+                mods.clear()
+            mods[key] = recipe
+    mod = StatsdClientMod.__new__(StatsdClientMod)
+    mod._wrapped = client._wrapped if recipe[0] else client
+    mod.format = recipe[1]
+    mod.tags = recipe[2]
+    mod._stat_cache = recipe[3]
+    return mod
+
+
+def _mod_recipe(client, format, tags): # pylint: disable=redefined-builtin
+    # Return whether the result wraps what *client* wraps, the format
+    # and tags to apply, and an empty cache of formatted stat names.
+    if type(client) is StatsdClientMod: # pylint:disable=unidiomatic-typecheck
+        outer_format = client.format
+        if outer_format.count('%') == 1 and '%s' in outer_format:
+            # (outer % (inner % stat)) == ((outer % inner) % stat)
+            if client.tags and tags:
+                tags = client.tags + _tag_items(tags)
+            elif not tags:
+                tags = client.tags
+            return (True, outer_format % format, _tag_items(tags) if tags else None, {})
+    return (False, format, _tag_items(tags) if tags else None, {})
+
 
 @implementer(IStatsdClient)
 class NullStatsdClient(object):
@@ -220,6 +1049,9 @@ class NullStatsdClient(object):
     def close(self):
         """Does nothing."""
 
+    def flush(self):
+        """Does nothing."""
+
     def timing(self, stat, *args, **kw):
         """Does nothing."""
 
@@ -235,8 +1067,26 @@ class NullStatsdClient(object):
     def set_add(self, stat, value, *args, **kw):
         """Does nothing."""
 
+    def histogram(self, stat, value, *args, **kw):
+        """Does nothing."""
+
+    def distribution(self, stat, value, *args, **kw):
+        """Does nothing."""
+
     def sendbuf(self, buf):
         """Does nothing"""
 
 
 null_client = NullStatsdClient()
+
+# pylint:disable=wrong-import-position,wrong-import-order
+from perfmetrics._util import import_c_accel
+import_c_accel(globals(), 'perfmetrics._statsd')
+
+def __getattr__(name):
+    # The other clients are defined in perfmetrics.transports, which
+    # needs this module first.
+    if name in _TRANSPORTS:
+        from perfmetrics import transports
+        return getattr(transports, name)
+    raise AttributeError("module 'perfmetrics.statsd' has no attribute %r" % (name,))
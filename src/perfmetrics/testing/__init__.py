@@ -10,7 +10,9 @@ __all__ = [
     'FakeStatsDClient',
     'Observation',
     'OBSERVATION_KIND_COUNTER',
+    'OBSERVATION_KIND_DISTRIBUTION',
     'OBSERVATION_KIND_GAUGE',
+    'OBSERVATION_KIND_HISTOGRAM',
     'OBSERVATION_KIND_SET',
     'OBSERVATION_KIND_TIMER',
 ]
@@ -18,6 +20,8 @@ __all__ = [
 from .client import FakeStatsDClient
 from .observation import Observation
 from .observation import OBSERVATION_KIND_COUNTER
+from .observation import OBSERVATION_KIND_DISTRIBUTION
 from .observation import OBSERVATION_KIND_GAUGE
+from .observation import OBSERVATION_KIND_HISTOGRAM
 from .observation import OBSERVATION_KIND_SET
 from .observation import OBSERVATION_KIND_TIMER
@@ -8,6 +8,7 @@ from hamcrest.core.matcher import Matcher
 from hamcrest.core.base_matcher import BaseMatcher
 
 from hamcrest import all_of
+from hamcrest import equal_to
 from hamcrest import instance_of
 from hamcrest import is_
 from hamcrest import has_properties
@@ -15,7 +16,9 @@ from hamcrest import none
 
 
 from .observation import OBSERVATION_KIND_COUNTER as METRIC_COUNTER_KIND
+from .observation import OBSERVATION_KIND_DISTRIBUTION as METRIC_DISTRIBUTION_KIND
 from .observation import OBSERVATION_KIND_GAUGE as METRIC_GAUGE_KIND
+from .observation import OBSERVATION_KIND_HISTOGRAM as METRIC_HISTOGRAM_KIND
 from .observation import OBSERVATION_KIND_SET as METRIC_SET_KIND
 from .observation import OBSERVATION_KIND_TIMER as METRIC_TIMER_KIND
 
@@ -27,6 +30,8 @@ __all__ = [
     'is_gauge',
     'is_set',
     'is_timer',
+    'is_histogram',
+    'is_distribution',
 ]
 
 _marker = object()
@@ -35,7 +40,9 @@ _metric_kind_display_name = {
     'c': 'counter',
     'g': 'gauge',
     'ms': 'timer',
-    's': 'set'
+    's': 'set',
+    'h': 'histogram',
+    'd': 'distribution',
 }
 
 
@@ -53,6 +60,13 @@ class IsMetric(BaseMatcher):
                 # This one is special, it doesn't get
                 # to be a string, it's kept as a number.
                 value = is_(value)
+            elif key == 'tags' and not isinstance(value, Matcher):
+                # Tags are a dictionary; compare the values as strings,
+                # which is what we parse.
+                value = equal_to({
+                    k: v if v is None else str(v)
+                    for k, v in value.items()
+                })
             elif not isinstance(value, Matcher):
                 value = str(value)
             matchers[key] = value
@@ -102,7 +116,8 @@ def _is_metric(args, kwargs):
             'kind',
             'name',
             'value',
-            'sampling_rate'
+            'sampling_rate',
+            'tags',
     )):
         if name in kwargs or len(args) <= arg_ix:
             continue
@@ -113,7 +128,7 @@ def _is_metric(args, kwargs):
 
 def is_observation(*args, **kwargs):
     """
-    is_observation(*, kind, name, value, sampling_rate) -> matcher
+    is_observation(*, kind, name, value, sampling_rate, tags) -> matcher
 
     A hamcrest matcher that validates the specific parts of a `~.Observation`.
     All arguments are optional and can be provided by name or position.
@@ -123,13 +138,18 @@ def is_observation(*args, **kwargs):
     :keyword str value: A hamcrest matcher or string that matches the value for this metric
     :keyword float sampling_rate: A hamcrest matcher or
         number that matches the sampling rate this metric was collected with
+    :keyword dict tags: A hamcrest matcher or dictionary that matches the
+        tags of this metric. Dictionary values are compared as strings.
+
+    .. versionchanged:: 4.4.0
+       Add *tags*.
     """
     return _is_metric(args, kwargs)
 
 
 def is_counter(*args, **kwargs):
     """
-    is_counter(*, name, value, sampling_rate) -> matcher
+    is_counter(*, name, value, sampling_rate, tags) -> matcher
 
     A hamcrest matcher validating the parts of a counter `~.Observation`.
 
@@ -142,7 +162,7 @@ def is_counter(*args, **kwargs):
 
 def is_gauge(*args, **kwargs):
     """
-    is_gauge(*, name, value, sampling_rate) -> matcher
+    is_gauge(*, name, value, sampling_rate, tags) -> matcher
 
     A hamcrest matcher validating the parts of a gauge `~.Observation`
 
@@ -155,7 +175,7 @@ def is_gauge(*args, **kwargs):
 
 def is_timer(*args, **kwargs):
     """
-    is_timer(*, name, value, sampling_rate) -> matcher
+    is_timer(*, name, value, sampling_rate, tags) -> matcher
 
     A hamcrest matcher validating the parts of a timer `~.Observation`
 
@@ -167,7 +187,7 @@ def is_timer(*args, **kwargs):
 
 def is_set(*args, **kwargs):
     """
-    is_set(*, name, value, sampling_rate) -> matcher
+    is_set(*, name, value, sampling_rate, tags) -> matcher
 
     A hamcrest matcher validating the parts of a set `~.Observation`
 
@@ -176,3 +196,29 @@ def is_set(*args, **kwargs):
     kwargs['kind'] = METRIC_SET_KIND
     args = (None,) + args
     return _is_metric(args, kwargs)
+
+def is_histogram(*args, **kwargs):
+    """
+    is_histogram(*, name, value, sampling_rate, tags) -> matcher
+
+    A hamcrest matcher validating the parts of a histogram `~.Observation`
+
+    .. seealso:: `is_metric`
+    .. versionadded:: 4.4.0
+    """
+    kwargs['kind'] = METRIC_HISTOGRAM_KIND
+    args = (None,) + args
+    return _is_metric(args, kwargs)
+
+def is_distribution(*args, **kwargs):
+    """
+    is_distribution(*, name, value, sampling_rate, tags) -> matcher
+
+    A hamcrest matcher validating the parts of a distribution `~.Observation`
+
+    .. seealso:: `is_metric`
+    .. versionadded:: 4.4.0
+    """
+    kwargs['kind'] = METRIC_DISTRIBUTION_KIND
+    args = (None,) + args
+    return _is_metric(args, kwargs)
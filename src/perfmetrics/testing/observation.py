@@ -16,6 +16,16 @@ OBSERVATION_KIND_SET = 's'
 #: The statsd metric kind for Timers
 OBSERVATION_KIND_TIMER = 'ms'
 
+#: The statsd metric kind for Histograms
+#:
+#: .. versionadded:: 4.4.0
+OBSERVATION_KIND_HISTOGRAM = 'h'
+
+#: The statsd metric kind for Distributions
+#:
+#: .. versionadded:: 4.4.0
+OBSERVATION_KIND_DISTRIBUTION = 'd'
+
 
 def _parse_sampling_data(data):
     """
@@ -28,31 +38,52 @@ def _parse_sampling_data(data):
     return float(data[1:])
 
 
+def _parse_tag_data(data):
+    """
+    Parses the tags from the provided packet part *data* into a dictionary.
+
+    Tags without a value map to None.
+    """
+    tags = {}
+    for tag in data[1:].split(','):
+        key, _, value = tag.partition(':')
+        tags[key] = value if _ else None
+    return tags
+
+
 def _as_metric(metric_data):
     """
     Parses a single metric packet, *metric_data*, in to a `Metric`.
 
-    Metrics take the form of ``<name>:<value>|<type>(|@<sampling_rate>)``
+    Metrics take the form of
+    ``<name>:<value>|<type>(|@<sampling_rate>)(|#<tag>:<value>,...)``
 
     A `ValueError` is raised for invalid data
     """
 
     sampling = None
+    tags = None
     name = None
     value = None
     kind = None
     parts = metric_data.split('|')
-    if len(parts) < 2 or len(parts) > 3:
+    if len(parts) < 2 or len(parts) > 4:
         raise ValueError('Unexpected metric data %s. Wrong number of parts' % metric_data)
 
+    if parts[-1].startswith('#'):
+        tags = _parse_tag_data(parts.pop(-1))
+
     if len(parts) == 3:
         sampling_data = parts.pop(-1)
         sampling = _parse_sampling_data(sampling_data)
 
+    if len(parts) != 2:
+        raise ValueError('Unexpected metric data %s. Wrong number of parts' % metric_data)
+
     kind = parts[1]
     name, value = parts[0].split(':')
 
-    return Observation(name, value, kind, sampling_rate=sampling)
+    return Observation(name, value, kind, sampling_rate=sampling, tags=tags)
 
 
 def _as_metrics(data):
@@ -86,11 +117,18 @@ class Observation(object):
     #: The rate with which this event has been sampled from (optional)
     sampling_rate = None
 
-    def __init__(self, name, value, kind, sampling_rate=None):
+    #: A dictionary of the tags sent with this event (optional).
+    #: Tags without a value map to None.
+    #:
+    #: .. versionadded:: 4.4.0
+    tags = None
+
+    def __init__(self, name, value, kind, sampling_rate=None, tags=None):
         self.name = name
         self.value = value
         self.sampling_rate = sampling_rate
         self.kind = kind
+        self.tags = tags
 
     @classmethod
     def make(cls, packet):
@@ -116,10 +154,15 @@ class Observation(object):
 
     def __str__(self):
         sampling_string = '|@%g' % self.sampling_rate if self.sampling_rate is not None else ''
-        return '%s:%s|%s%s' % (self.name, self.value, self.kind, sampling_string)
+        tags_string = '|#' + ','.join(
+            key if value is None else '%s:%s' % (key, value)
+            for key, value in sorted(self.tags.items())
+        ) if self.tags else ''
+        return '%s:%s|%s%s%s' % (self.name, self.value, self.kind, sampling_string, tags_string)
 
     def __repr__(self):
-        return "%s(name=%r, value=%r, kind=%r, sampling_rate=%r)" % (
+        tags = ', tags=%r' % (self.tags,) if self.tags else ''
+        return "%s(name=%r, value=%r, kind=%r, sampling_rate=%r%s)" % (
             self.__class__.__name__,
-            self.name, self.value, self.kind, self.sampling_rate
+            self.name, self.value, self.kind, self.sampling_rate, tags
         )
@@ -20,6 +20,8 @@ from ..matchers import is_counter
 from ..matchers import is_gauge
 from ..matchers import is_set
 from ..matchers import is_timer
+from ..matchers import is_histogram
+from ..matchers import is_distribution
 
 from ..observation import Observation as Metric
 
@@ -101,3 +103,20 @@ class TestIsMetric(unittest.TestCase):
     def test_components_can_be_matchers(self):
         assert_that(self.counter, is_metric('c', 'foo', '1', none()))
         assert_that(self.timer, is_not(is_metric('ms', 'foo', '100', none())))
+
+    def test_tags(self):
+        tagged = Metric.make('foo:1|c|#env:prod,host,count:3')
+        assert_that(tagged, is_counter('foo', '1', None,
+                                       {'env': 'prod', 'host': None, 'count': 3}))
+        assert_that(tagged, is_not(is_counter(tags={'env': 'prod'})))
+        assert_that(self.counter, is_counter(tags=none()))
+        assert_that(self.counter, is_not(is_counter(tags={'env': 'prod'})))
+
+    def test_is_histogram_and_distribution(self):
+        histogram = Metric.make('foo:1|h')
+        distribution = Metric.make('foo:1|d')
+        assert_that(histogram, is_histogram('foo', '1'))
+        assert_that(distribution, is_distribution('foo', '1'))
+        assert_that(histogram, is_not(is_distribution()))
+        assert_that(distribution, is_not(is_histogram()))
+        assert_that(self.timer, is_not(is_histogram()))
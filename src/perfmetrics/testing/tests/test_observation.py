@@ -21,6 +21,8 @@ from ..matchers import is_counter
 from ..matchers import is_timer
 from ..matchers import is_gauge
 from ..matchers import is_set
+from ..matchers import is_histogram
+from ..matchers import is_distribution
 
 from ..observation import Observation as Metric
 
@@ -103,6 +105,32 @@ class TestMetricParsing(unittest.TestCase):
 
         assert_that(metric, is_counter('gorets', '1', 0.1))
 
+    def test_histogram_and_distribution(self):
+        metrics = Metric.make_all('glork:1.5|h|@0.5\nglork:2|d')
+        assert_that(metrics, contains(is_histogram('glork', '1.5', 0.5),
+                                      is_distribution('glork', '2')))
+
+    def test_tags(self):
+        metric = Metric.make('gorets:1|c|@0.1|#env:prod,host')
+        assert_that(metric, is_counter('gorets', '1', 0.1, {'env': 'prod', 'host': None}))
+        assert_that(str(metric), is_('gorets:1|c|@0.1|#env:prod,host'))
+        assert_that(repr(metric), is_(
+            "Observation(name='gorets', value='1', kind='c', sampling_rate=0.1, "
+            "tags={'env': 'prod', 'host': None})"))
+
+        metric = Metric.make('glork:320|ms|#b:2,a:1')
+        assert_that(metric, is_timer('glork', '320', None, {'a': '1', 'b': '2'}))
+        assert_that(str(metric), is_('glork:320|ms|#a:1,b:2'))
+
+        metric = Metric.make('glork:320|ms')
+        assert_that(repr(metric), is_(
+            "Observation(name='glork', value='320', kind='ms', sampling_rate=None)"))
+
+    def test_invalid_tags(self):
+        for packet in ('gorets:1|c|#a|#b', 'gorets:1|c|@0.1|#a|junk', 'gorets:1|#a'):
+            assert_that(calling(functools.partial(Metric.make_all, packet)),
+                        raises(ValueError))
+
     def test_factory(self):
         metric = Metric.make('gaugor:+333|g')
         assert_that(str(metric), is_('gaugor:+333|g'))
@@ -1,6 +1,43 @@
 # -*- coding: utf-8 -*-
 
+import os
+import socket
+import struct
+import sys
 
 from nti.testing.matchers import is_true # pylint:disable=unused-import
 from nti.testing.matchers import implements # pylint:disable=unused-import
 from nti.testing.matchers import validly_provides # pylint:disable=unused-import
+
+
+def _sendmmsg(fd, packets, address):
+    # Stand in for perfmetrics._sendmmsg.sendmmsg when it isn't
+    # compiled, reading the struct sockaddr the way Linux does.
+    family, = struct.unpack_from('=H', address)
+    if family == socket.AF_INET:
+        port, = struct.unpack_from('!H', address, 2)
+        addr = (socket.inet_ntop(family, address[4:8]), port)
+    elif family == socket.AF_INET6:
+        port, flowinfo = struct.unpack_from('!HI', address, 2)
+        scope_id, = struct.unpack_from('=I', address, 24)
+        addr = (socket.inet_ntop(family, address[8:24]), port, flowinfo, scope_id)
+    else:
+        addr = address[2:address.index(b'\0', 2)].decode('utf-8')
+    with socket.socket(family, socket.SOCK_DGRAM, fileno=os.dup(fd)) as sock:
+        for packet in packets:
+            sock.sendto(packet, addr)
+    return len(packets)
+
+
+def use_sendmmsg(test):
+    """
+    Make ``send_packets`` take its ``sendmmsg`` path for the rest of
+    *test*, even without the compiled extension.
+    """
+    from perfmetrics.statsd import StatsdClient
+    # The compiled module, if in use.
+    statsd = sys.modules[StatsdClient.__module__]
+    if statsd.sendmmsg is None:
+        statsd.sendmmsg = _sendmmsg
+        test.addCleanup(setattr, statsd, 'sendmmsg', None)
+    return statsd
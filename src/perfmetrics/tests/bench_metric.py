@@ -7,6 +7,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import asyncio
+
 from pyperf import Runner
 from pyperf import perf_counter
 
@@ -14,10 +16,18 @@ from perfmetrics import metric
 from perfmetrics import metricmethod
 from perfmetrics import set_statsd_client
 from perfmetrics import Metric
+from perfmetrics import MetricMod
+from perfmetrics.clientstack import ClientStack
+from perfmetrics.clientstack import ContextClientStack
+from perfmetrics.statsd import StatsdClient
+from perfmetrics.statsd import StatsdClientMod
 from perfmetrics.statsd import null_client
 
 metricsampled_1 = Metric(rate=0.1)
 metricsampled_9 = Metric(rate=0.999)
+metricsampled_001_random = Metric(rate=0.001, timing=False)
+metricsampled_001_counter = Metric(rate=0.001, timing=False, sampling='counter')
+metricsampled_001_geometric = Metric(rate=0.001, timing=False, sampling='geometric')
 
 INNER_LOOPS = 1000
 
@@ -33,9 +43,37 @@ def func_with_metricsampled_1():
 def func_with_metricsampled_99():
     pass
 
+@metricsampled_001_random
+def func_with_metricsampled_001_random():
+    pass
+
+@metricsampled_001_counter
+def func_with_metricsampled_001_counter():
+    pass
+
+@metricsampled_001_geometric
+def func_with_metricsampled_001_geometric():
+    pass
+
+@Metric(errors=True)
+def func_with_metric_errors():
+    pass
+
+@Metric(error_types=True)
+def failing_func_with_metric_error_types():
+    raise ValueError
+
 def func_without_metric():
     pass
 
+@metric
+async def coroutine_with_metric():
+    pass
+
+@metric
+def generator_with_metric(count):
+    yield from count
+
 class AClass(object):
 
     @metricmethod
@@ -99,6 +137,100 @@ def bench_call_sampled_1_func_with_null_client(loops):
 def bench_call_sampled_99_func_with_null_client(loops):
     return _bench_call_func_with_client(loops, func_with_metricsampled_99, null_client)
 
+def bench_call_sampled_001_random_func_with_null_client(loops):
+    return _bench_call_func_with_client(
+        loops, func_with_metricsampled_001_random, null_client)
+
+def bench_call_sampled_001_counter_func_with_null_client(loops):
+    return _bench_call_func_with_client(
+        loops, func_with_metricsampled_001_counter, null_client)
+
+def bench_call_sampled_001_geometric_func_with_null_client(loops):
+    return _bench_call_func_with_client(
+        loops, func_with_metricsampled_001_geometric, null_client)
+
+
+##
+# This measures counting errors.
+##
+
+def bench_call_func_with_errors_with_null_client(loops):
+    return _bench_call_func_with_client(loops, func_with_metric_errors, null_client)
+
+def _call_failing():
+    try:
+        failing_func_with_metric_error_types()
+    except ValueError:
+        pass
+
+def bench_call_failing_func_with_error_types_with_null_client(loops):
+    return _bench_call_func_with_client(loops, _call_failing, null_client)
+
+
+##
+# This measures the overhead of timing a coroutine.
+##
+
+async def _await_coroutine(count, f):
+    t0 = perf_counter()
+    for _ in count:
+        await f()
+    t1 = perf_counter()
+    return t1 - t0
+
+def bench_await_coroutine_with_metric_with_null_client(loops):
+    set_statsd_client(null_client)
+    result = asyncio.run(_await_coroutine(range(loops * INNER_LOOPS),
+                                          coroutine_with_metric))
+    set_statsd_client(None)
+    return result
+
+
+##
+# This measures the per-item overhead of timing a generator.
+##
+
+def bench_iterate_generator_with_metric_with_null_client(loops):
+    set_statsd_client(null_client)
+    t0 = perf_counter()
+    for _ in generator_with_metric(range(loops * INNER_LOOPS)):
+        pass
+    t1 = perf_counter()
+    set_statsd_client(None)
+    return t1 - t0
+
+
+##
+# This measures the overhead of nested MetricMod decorators.
+##
+
+def _nested_mods(levels):
+    f = func_with_metric
+    for i in range(levels):
+        f = MetricMod('level%d.%%s' % i)(f)
+    return f
+
+def bench_call_func_with_1_mod_with_null_client(loops):
+    return _bench_call_func_with_client(loops, _nested_mods(1), null_client)
+
+def bench_call_func_with_3_mods_with_null_client(loops):
+    return _bench_call_func_with_client(loops, _nested_mods(3), null_client)
+
+def bench_call_func_with_5_mods_with_null_client(loops):
+    return _bench_call_func_with_client(loops, _nested_mods(5), null_client)
+
+def bench_metricmod_context_manager_with_null_client(loops):
+    mod = MetricMod('mod.%s')
+    set_statsd_client(null_client)
+    count = range(loops * INNER_LOOPS)
+    t0 = perf_counter()
+    for _ in count:
+        with mod:
+            pass
+    t1 = perf_counter()
+    set_statsd_client(None)
+    return t1 - t0
+
 
 ##
 # This measures actually sending the UDP packet
@@ -110,6 +242,71 @@ def bench_call_func_with_udp_client(loops):
         'statsd://localhost:8125'
     )
 
+##
+# These measure the cost of formatting metrics in the client,
+# without any system calls.
+##
+
+def _bench_client_with_buf(loops, client):
+    buf = []
+    count = range(loops * INNER_LOOPS)
+    t0 = perf_counter()
+    for _ in count:
+        client.incr('perfmetrics.bench.stat', 1, 1, buf, True)
+        client.timing('perfmetrics.bench.stat.t', 42, 1, buf, True)
+        del buf[:]
+    t1 = perf_counter()
+    client.close()
+    return t1 - t0
+
+def bench_client_format_with_buf(loops):
+    return _bench_client_with_buf(loops, StatsdClient(prefix='prefix'))
+
+def bench_client_mod_format_with_buf(loops):
+    return _bench_client_with_buf(
+        loops,
+        StatsdClientMod(StatsdClient(prefix='prefix'), 'mod.%s'))
+
+
+##
+# These compare the thread-local and context-local client stacks.
+##
+
+def _bench_client_stack_get(loops, stack):
+    stack.push(null_client)
+    get = stack.get
+    count = range(loops * INNER_LOOPS)
+    t0 = perf_counter()
+    for _ in count:
+        get()
+    t1 = perf_counter()
+    stack.clear()
+    return t1 - t0
+
+def _bench_client_stack_push_pop(loops, stack):
+    push = stack.push
+    pop = stack.pop
+    count = range(loops * INNER_LOOPS)
+    t0 = perf_counter()
+    for _ in count:
+        push(null_client)
+        pop()
+    t1 = perf_counter()
+    return t1 - t0
+
+def bench_client_stack_get_thread(loops):
+    return _bench_client_stack_get(loops, ClientStack())
+
+def bench_client_stack_get_context(loops):
+    return _bench_client_stack_get(loops, ContextClientStack())
+
+def bench_client_stack_push_pop_thread(loops):
+    return _bench_client_stack_push_pop(loops, ClientStack())
+
+def bench_client_stack_push_pop_context(loops):
+    return _bench_client_stack_push_pop(loops, ContextClientStack())
+
+
 def main():
     runner = Runner()
     for name, func in sorted([
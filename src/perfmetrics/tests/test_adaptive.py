@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+from perfmetrics import Metric
+from perfmetrics import MetricMod
+from perfmetrics import set_statsd_client
+from perfmetrics.testing import FakeStatsDClient
+
+# pylint:disable=protected-access
+
+
+class TestAdaptiveSampler(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeStatsDClient()
+        set_statsd_client(self.client)
+        self.addCleanup(set_statsd_client, None)
+        self.now = 0.0
+
+    def _makeOne(self, budget, **kwargs):
+        from perfmetrics.adaptive import AdaptiveSampler
+        kwargs.setdefault('interval', 0)
+        inst = AdaptiveSampler(budget, **kwargs)
+        self.addCleanup(inst.close)
+        inst.clock = lambda: self.now
+        inst._last_adjusted = self.now
+        return inst
+
+    def _call(self, func, count):
+        for _ in range(count):
+            func()
+
+    def test_register_requires_metric(self):
+        sampler = self._makeOne(10)
+        with self.assertRaises(TypeError):
+            sampler.register(lambda: None)
+        # Unregistering something unknown is harmless.
+        sampler.unregister(lambda: None)
+
+    def test_rates_within_budget(self):
+        sampler = self._makeOne(100)
+
+        @sampler.register
+        @Metric('a', count=True, timing=False)
+        def a():
+            """Does nothing"""
+
+        self._call(a, 50)
+        self.now = 1.0
+        sampler.adjust()
+        self.assertEqual(sampler.rates, {'a': 1.0})
+        self.assertEqual(sampler.frequencies, {'a': 50.0})
+
+    def test_budget_shared(self):
+        sampler = self._makeOne(100, smoothing=1)
+
+        @Metric('quiet', count=True, timing=False)
+        def quiet():
+            """Does nothing"""
+
+        @Metric('busy', count=True, timing=False)
+        def busy():
+            """Does nothing"""
+
+        @Metric('busier', count=True, timing=False)
+        def busier():
+            """Does nothing"""
+
+        for func in quiet, busy, busier:
+            sampler.register(func)
+
+        self._call(quiet, 10)
+        self._call(busy, 200)
+        self._call(busier, 900)
+        self.now = 1.0
+        sampler.adjust()
+        # quiet keeps its 10 calls; busy and busier split the other 90.
+        self.assertEqual(sampler.rates, {
+            'quiet': 1.0,
+            'busy': 45 / 200,
+            'busier': 45 / 900,
+        })
+
+        # The counts are scaled up by the rate.
+        self.client.clear()
+        self._call(busier, 900)
+        observed = sum(1 for o in self.client.observations if o.name == 'busier')
+        self.assertTrue(0 < observed < 900)
+        self.assertTrue(all(o.sampling_rate == 0.05 for o in self.client.observations))
+
+        # When the load drops, the rates come back up.
+        self.now = 2.0
+        self._call(busy, 10)
+        sampler.adjust()
+        self.assertEqual(sampler.rates['busy'], 1.0)
+
+    def test_min_rate_and_smoothing(self):
+        sampler = self._makeOne(1, min_rate=0.01, smoothing=0.5)
+
+        @sampler.register
+        @Metric('a', count=True, timing=False)
+        def a():
+            """Does nothing"""
+
+        self._call(a, 1000)
+        self.now = 1.0
+        sampler.adjust()
+        self.assertEqual(sampler.rates, {'a': 0.01})
+        self.assertEqual(sampler.frequencies, {'a': 1000.0})
+
+        self.now = 2.0
+        sampler.adjust()
+        self.assertEqual(sampler.frequencies, {'a': 500.0})
+
+        # No time has passed.
+        sampler.adjust()
+        self.assertEqual(sampler.frequencies, {'a': 500.0})
+
+    def test_metricmethod_and_mod(self):
+        sampler = self._makeOne(10)
+
+        class Spam(object):
+            @Metric(method=True)
+            def eggs(self):
+                """Does nothing"""
+
+        sampler.register(Spam.eggs)
+        name = __name__ + '.TestAdaptiveSampler.test_metricmethod_and_mod.<locals>.Spam.eggs'
+        self.assertEqual(list(sampler.rates), [name])
+        sampler.unregister(Spam.eggs)
+        self.assertEqual(sampler.rates, {})
+
+        @sampler.register
+        @MetricMod('mod.%s')
+        @Metric('a')
+        def a():
+            """Does nothing"""
+        self.assertEqual(list(sampler.rates), ['a'])
+
+    def test_after_fork(self):
+        from perfmetrics.adaptive import AdaptiveSampler
+        sampler = AdaptiveSampler(10, interval=60)
+        self.addCleanup(sampler.close)
+        thread = sampler._thread
+        sampler._after_fork()
+        self.assertIsNot(sampler._thread, thread)
+        self.assertTrue(sampler._thread.is_alive())
+        sampler._stopped.set()
+        thread.join()
+
+    def test_thread(self):
+        from perfmetrics.adaptive import AdaptiveSampler
+        sampler = AdaptiveSampler(10, interval=0.001)
+        calls = []
+
+        def adjust():
+            calls.append(1)
+            if len(calls) == 1:
+                raise ValueError("Logged and ignored")
+            sampler._stopped.set()
+        sampler.adjust = adjust
+        sampler._thread.join(5)
+        sampler.close()
+        sampler.close()
+        self.assertEqual(len(calls), 2)
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+from hamcrest import assert_that
+from hamcrest import contains_inanyorder
+
+from perfmetrics.interfaces import IStatsdClient
+from perfmetrics.testing import FakeStatsDClient
+from perfmetrics.testing.matchers import is_counter
+from perfmetrics.testing.matchers import is_distribution
+from perfmetrics.testing.matchers import is_gauge
+from perfmetrics.testing.matchers import is_histogram
+from perfmetrics.testing.matchers import is_set
+
+from . import validly_provides
+
+# pylint:disable=protected-access
+
+
+class TestAggregatingStatsdClient(unittest.TestCase):
+
+    sink = None
+
+    def _makeOne(self, flush_interval=0, **kwargs):
+        from perfmetrics.aggregate import AggregatingStatsdClient
+        self.sink = FakeStatsDClient()
+        inst = AggregatingStatsdClient(self.sink, flush_interval, **kwargs)
+        self.addCleanup(inst.close)
+        return inst
+
+    def test_provides(self):
+        assert_that(self._makeOne(), validly_provides(IStatsdClient))
+
+    def test_flush_empty(self):
+        client = self._makeOne()
+        client.flush()
+        self.assertEqual(self.sink.packets, [])
+
+    def test_counters_are_summed(self):
+        client = self._makeOne()
+        for _ in range(5):
+            client.incr('a')
+        client.incr('b', 10)
+        client.decr('b', 3)
+        self.assertEqual(self.sink.packets, [])
+        client.flush()
+        assert_that(self.sink.observations, contains_inanyorder(
+            is_counter('a', '5'),
+            is_counter('b', '7'),
+        ))
+        self.sink.clear()
+        client.flush()
+        self.assertEqual(self.sink.packets, [])
+
+    def test_sampled_counters_are_extrapolated(self):
+        client = self._makeOne()
+        client.random = lambda: 0.5
+        client.incr('a', rate=0.1, rate_applied=True)
+        client.incr('a', 3, rate=0.75)
+        client.incr('a', rate=0.5) # Not sampled
+        client.flush()
+        assert_that(self.sink.observations, contains_inanyorder(
+            is_counter('a', '14'),
+        ))
+
+    def test_gauges_keep_last_value(self):
+        client = self._makeOne()
+        client.gauge('g', 1)
+        client.gauge('g', 42)
+        client.random = lambda: 0.99
+        client.gauge('g', 7, rate=0.5)
+        client.flush()
+        assert_that(self.sink.observations, contains_inanyorder(
+            is_gauge('g', '42'),
+        ))
+
+    def test_sets_are_deduplicated(self):
+        client = self._makeOne()
+        for value in (1, 2, 1, 1, 3):
+            client.set_add('s', value)
+        client.random = lambda: 0.99
+        client.set_add('s', 4, rate=0.5)
+        client.flush()
+        assert_that(self.sink.observations, contains_inanyorder(
+            is_set('s', '1'),
+            is_set('s', '2'),
+            is_set('s', '3'),
+        ))
+
+    def test_timers_are_summarized(self):
+        client = self._makeOne()
+        for value in range(1, 101):
+            client.timing('t', value)
+        client.flush()
+        assert_that(self.sink.observations, contains_inanyorder(
+            is_counter('t.count', '100'),
+            is_gauge('t.sum', '5050'),
+            is_gauge('t.lower', '1'),
+            is_gauge('t.upper', '100'),
+            is_gauge('t.upper_90', '90'),
+        ))
+
+    def test_sampled_timers_are_extrapolated(self):
+        client = self._makeOne(percentile=50)
+        client.random = lambda: 0.01
+        client.timing('t', 8, rate=0.5)
+        client.timing('t', 2, rate=0.5, rate_applied=True)
+        client.random = lambda: 0.99
+        client.timing('t', 1000, rate=0.5)
+        client.flush()
+        assert_that(self.sink.observations, contains_inanyorder(
+            is_counter('t.count', '4'),
+            is_gauge('t.sum', '20'),
+            is_gauge('t.lower', '2'),
+            is_gauge('t.upper', '8'),
+            is_gauge('t.upper_50', '2'),
+        ))
+
+    def test_timer_samples_are_bounded(self):
+        client = self._makeOne(max_samples=10)
+        client.random = lambda: 0.5
+        for value in range(100):
+            client.timing('t', value)
+        timer = client._timers[('t', None)]
+        self.assertEqual(len(timer.samples), 10)
+        self.assertEqual(timer.seen, 100)
+        self.assertEqual(timer.count, 100)
+
+    def test_tags_are_aggregated_separately(self):
+        client = self._makeOne()
+        client.incr('a', tags={'env': 'prod'})
+        client.incr('a', tags=['env:prod'])
+        client.incr('a')
+        client.decr('a', tags={'env': 'dev'})
+        client.gauge('g', 1, tags={'env': 'prod'})
+        client.set_add('s', 1, tags={'env': 'prod'})
+        client.timing('t', 5, tags={'env': 'prod'})
+        client.flush()
+        prod = {'env': 'prod'}
+        assert_that(self.sink.observations, contains_inanyorder(
+            is_counter('a', '2', tags=prod),
+            is_counter('a', '1', tags=None),
+            is_counter('a', '-1', tags={'env': 'dev'}),
+            is_gauge('g', '1', tags=prod),
+            is_set('s', '1', tags=prod),
+            is_counter('t.count', '1', tags=prod),
+            is_gauge('t.sum', '5', tags=prod),
+            is_gauge('t.lower', '5', tags=prod),
+            is_gauge('t.upper', '5', tags=prod),
+            is_gauge('t.upper_90', '5', tags=prod),
+        ))
+
+    def test_histograms_and_distributions_are_forwarded(self):
+        client = self._makeOne()
+        client.histogram('h', 1.5, tags={'a': 'b'})
+        client.distribution('d', 2)
+        assert_that(self.sink.observations, contains_inanyorder(
+            is_histogram('h', '1.5', tags={'a': 'b'}),
+            is_distribution('d', '2'),
+        ))
+
+    def test_sendbuf_forwards(self):
+        client = self._makeOne()
+        client.sendbuf([])
+        client.sendbuf(['a:1|c'])
+        assert_that(self.sink.observations, contains_inanyorder(
+            is_counter('a', '1'),
+        ))
+
+    def test_metric_uses_aggregator(self):
+        from perfmetrics import Metric
+        from perfmetrics import statsd_client_stack
+
+        client = self._makeOne()
+        statsd_client_stack.push(client)
+        self.addCleanup(statsd_client_stack.pop)
+
+        @Metric('func')
+        def func():
+            """Does nothing"""
+
+        for _ in range(3):
+            func()
+        self.assertEqual(self.sink.packets, [])
+        client.flush()
+        names = sorted(o.name for o in self.sink.observations)
+        self.assertEqual(names, ['func', 'func.t.count', 'func.t.lower', 'func.t.sum',
+                                 'func.t.upper', 'func.t.upper_90'])
+
+    def test_background_flush(self):
+        client = self._makeOne(flush_interval=0.01)
+        client.incr('a')
+        for _ in range(500):
+            if self.sink.packets:
+                break
+            client._stopped.wait(0.01)
+        self.assertEqual(self.sink.packets, ['a:1|c'])
+        client.close()
+        self.assertIsNone(client._thread)
+
+    def test_background_flush_error(self):
+        client = self._makeOne(flush_interval=0.01)
+        flushed = []
+        def flush():
+            flushed.append(1)
+            client._stopped.set()
+            raise RuntimeError("synthetic")
+        client.flush = flush
+        client._thread.join()
+        self.assertEqual(flushed, [1])
+        del client.flush
+
+    def test_after_fork(self):
+        client = self._makeOne(flush_interval=60)
+        client.incr('a')
+        client.timing('t', 5)
+        thread = client._thread
+        client._after_fork()
+        self.assertIsNot(client._thread, thread)
+        self.assertTrue(client._thread.is_alive())
+        client.incr('b')
+        client.flush()
+        self.assertEqual(self.sink.packets, ['b:1|c'])
+
+    def test_from_uri(self):
+        from perfmetrics import statsd_client_from_uri
+        from perfmetrics.aggregate import AggregatingStatsdClient
+        client = statsd_client_from_uri('statsd://localhost:8125?aggregate_interval=5')
+        self.addCleanup(client.close)
+        self.assertIsInstance(client, AggregatingStatsdClient)
+        self.assertEqual(client.flush_interval, 5.0)
+        self.assertEqual(client.client.packet_size, 1432)
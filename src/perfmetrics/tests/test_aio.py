@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import asyncio
+import socket
+import unittest
+
+from zope.interface import verify
+
+from hamcrest import assert_that
+
+from perfmetrics.interfaces import IStatsdClient
+
+from . import is_true
+
+# pylint:disable=protected-access
+
+
+class TestAsyncStatsdClient(unittest.TestCase):
+
+    def setUp(self):
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(self.receiver.close)
+        self.receiver.bind(('127.0.0.1', 0))
+        self.receiver.settimeout(5)
+
+    def _makeOne(self, **kwargs):
+        from perfmetrics.aio import AsyncStatsdClient
+        port = self.receiver.getsockname()[1]
+        inst = AsyncStatsdClient('127.0.0.1', port, **kwargs)
+        self.addCleanup(inst.close)
+        return inst
+
+    def _recv(self):
+        return self.receiver.recv(65536)
+
+    def test_implements(self):
+        from perfmetrics.aio import AsyncStatsdClient
+        assert_that(verify.verifyClass(IStatsdClient, AsyncStatsdClient), is_true())
+
+    def test_queues_until_started(self):
+        client = self._makeOne()
+        client.incr('a')
+        client.flush()
+        self.assertEqual(list(client._queue), [b'a:1|c'])
+
+    def test_context_manager_flushes(self):
+        client = self._makeOne(flush_interval=60)
+
+        async def main():
+            async with client:
+                client.incr('a')
+                client.timing('b', 5)
+                await asyncio.sleep(0)
+            self.assertIsNone(client._transport)
+
+        asyncio.run(main())
+        self.assertEqual(self._recv(), b'a:1|c\nb:5|ms')
+
+    def test_task_flushes_periodically(self):
+        client = self._makeOne(flush_interval=0.001, packet_size=10)
+        received = []
+
+        async def main():
+            await client.start()
+            await client.start() # Does nothing
+            client.sendbuf(['a:1|c', 'b:2|c'])
+            client.sendbuf([])
+            received.append(await asyncio.get_running_loop().run_in_executor(
+                None, self._recv))
+            received.append(await asyncio.get_running_loop().run_in_executor(
+                None, self._recv))
+            await client.stop()
+            await client.stop() # Does nothing
+
+        asyncio.run(main())
+        self.assertEqual(received, [b'a:1|c', b'b:2|c'])
+
+    def test_loop_shutdown_flushes(self):
+        client = self._makeOne(flush_interval=60)
+
+        async def main():
+            await client.start()
+            client.gauge('g', 42)
+
+        asyncio.run(main())
+        self.assertIsNone(client._transport)
+        self.assertEqual(self._recv(), b'g:42|g')
+
+    def test_close_from_coroutine(self):
+        client = self._makeOne(flush_interval=60)
+
+        async def main():
+            await client.start()
+            client.set_add('s', 1)
+            client.close()
+            self.assertIsNone(client._task)
+
+        asyncio.run(main())
+        self.assertEqual(self._recv(), b's:1|s')
+
+    def test_queue_is_bounded(self):
+        client = self._makeOne(max_queue=3)
+        for i in range(4):
+            client.incr('a', i)
+        self.assertEqual(client.dropped, 1)
+        client.sendbuf(['b:1|c', 'c:1|c'])
+        self.assertEqual(client.dropped, 3)
+        self.assertEqual(list(client._queue), [b'a:3|c', b'b:1|c', b'c:1|c'])
+
+    def test_after_fork(self):
+        client = self._makeOne(max_queue=1)
+        client.sendbuf(['a:1|c', 'b:1|c'])
+        client._after_fork()
+        self.assertEqual(list(client._queue), [])
+        self.assertEqual(client.dropped, 0)
+
+    def test_error_received(self):
+        from perfmetrics.aio import _StatsdProtocol
+        _StatsdProtocol().error_received(OSError('synthetic'))
@@ -10,6 +10,30 @@ class Test_ClientStack(unittest.TestCase):
     def test_ctor(self):
         obj = self._class()
         self.assertIsNotNone(obj.stack)
+        from perfmetrics import _util
+        if not _util.PURE_PYTHON: # pragma: no cover
+            self.assertEqual(self._class.__module__, 'perfmetrics._clientstack')
+
+    def test_default(self):
+        from perfmetrics.clientstack import set_statsd_client
+        obj = self._class()
+        self.assertIsNone(obj.default)
+        client = object()
+        set_statsd_client(client)
+        self.addCleanup(set_statsd_client, None)
+        self.assertIs(obj.default, client)
+        self.assertIs(obj.get(), client)
+
+    def test_stack_is_per_thread(self):
+        import threading
+        obj = self._class()
+        obj.push(1)
+        stacks = []
+        thread = threading.Thread(target=lambda: stacks.append(list(obj.stack)))
+        thread.start()
+        thread.join()
+        self.assertEqual(stacks, [[]])
+        self.assertEqual(obj.stack, [1])
 
     def test_push(self):
         obj = self._class()
@@ -47,3 +71,100 @@ class Test_ClientStack(unittest.TestCase):
         obj.stack.append(client)
         obj.clear()
         self.assertEqual(obj.stack, [])
+
+
+class Test_ContextClientStack(unittest.TestCase):
+    @property
+    def _class(self):
+        from perfmetrics.clientstack import ContextClientStack
+        return ContextClientStack
+
+    def test_push_pop(self):
+        obj = self._class()
+        self.assertEqual(obj.stack, [])
+        self.assertIsNone(obj.pop())
+        client1 = object()
+        client2 = object()
+        obj.push(client1)
+        obj.push(client2)
+        self.assertEqual(obj.stack, [client1, client2])
+        self.assertIs(obj.get(), client2)
+        self.assertIs(obj.pop(), client2)
+        self.assertIs(obj.get(), client1)
+        self.assertIs(obj.pop(), client1)
+        self.assertEqual(obj.stack, [])
+        self.assertIsNone(obj.pop())
+
+    def test_get_default(self):
+        from perfmetrics.clientstack import set_statsd_client
+        obj = self._class()
+        self.assertIsNone(obj.get())
+        client = object()
+        set_statsd_client(client)
+        self.addCleanup(set_statsd_client, None)
+        self.assertIs(obj.get(), client)
+        other = object()
+        obj.push(other)
+        self.assertIs(obj.get(), other)
+        obj.pop()
+        self.assertIs(obj.get(), client)
+
+    def test_clear(self):
+        obj = self._class()
+        obj.push(object())
+        obj.push(object())
+        obj.clear()
+        self.assertEqual(obj.stack, [])
+        self.assertIsNone(obj.get())
+
+    def test_copied_context(self):
+        import contextvars
+        obj = self._class()
+        client = object()
+        obj.push(client)
+
+        def in_copy():
+            obj.push(object())
+            obj.push(object())
+            obj.pop()
+            return len(obj.stack)
+
+        self.assertEqual(contextvars.copy_context().run(in_copy), 2)
+        self.assertEqual(obj.stack, [client])
+
+    def test_tasks_are_isolated(self):
+        import asyncio
+        obj = self._class()
+        seen = []
+
+        async def task(name):
+            obj.push(name)
+            await asyncio.sleep(0)
+            seen.append((name, obj.stack))
+            await asyncio.sleep(0)
+            obj.pop()
+
+        async def main():
+            await asyncio.gather(task('a'), task('b'))
+
+        asyncio.run(main())
+        self.assertEqual(sorted(seen), [('a', ['a']), ('b', ['b'])])
+        self.assertEqual(obj.stack, [])
+
+
+class TestNewClientStack(unittest.TestCase):
+
+    def _call(self, environ):
+        from perfmetrics.clientstack import _new_client_stack
+        return _new_client_stack(environ)
+
+    def test_default(self):
+        from perfmetrics.clientstack import ClientStack
+        self.assertIsInstance(self._call({}), ClientStack)
+        self.assertIsInstance(self._call({'PERFMETRICS_CLIENT_STACK': 'thread'}),
+                              ClientStack)
+
+    def test_context(self):
+        from perfmetrics.clientstack import ContextClientStack
+        self.assertIsInstance(self._call({'PERFMETRICS_CLIENT_STACK': 'context'}),
+                              ContextClientStack)
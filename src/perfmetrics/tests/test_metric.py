@@ -6,7 +6,13 @@ from __future__ import print_function
 
 import unittest
 
+from hamcrest import assert_that
+
+# pylint:disable=too-many-public-methods
+
 class MockStatsdClient(object):
+    fractional_timing = False
+
     def __init__(self):
         self.changes = []
         self.timings = []
@@ -444,36 +450,651 @@ class TestMetric(unittest.TestCase):
         self.assertEqual(len(client.timings), 0)
         self.assertEqual(client.sentbufs, [])
 
-class SequenceDecorator(object):
+    def test_tags(self):
+        from hamcrest import contains_exactly
+        from perfmetrics.testing import FakeStatsDClient
+        from perfmetrics.testing.matchers import is_counter
+        from perfmetrics.testing.matchers import is_timer
 
-    def __init__(self, *args, **kwargs):
-        from perfmetrics import Metric
-        from perfmetrics import MetricMod
+        client = FakeStatsDClient()
+        self.statsd_client_stack.push(client)
+        metric = self._makeOne('spam', tags={'env': 'prod', 'host': None})
+        self.assertEqual(metric.tags, ('env:prod', 'host'))
 
-        self.args = args
-        self.kwargs = kwargs
-        self.metric = Metric(*args, **kwargs)
-        self.metricmod = MetricMod("%s")
+        @metric
+        def spam():
+            """Does nothing"""
+
+        spam()
+        with metric:
+            pass
+
+        tags = {'env': 'prod', 'host': None}
+        assert_that(client.observations, contains_exactly(
+            is_counter('spam', '1', tags=tags),
+            is_timer('spam.t', tags=tags),
+            is_counter('spam', '1', tags=tags),
+            is_timer('spam.t', tags=tags),
+        ))
+
+    def test_kind(self):
+        from perfmetrics.testing import FakeStatsDClient
+        from perfmetrics.testing.matchers import is_distribution
+        from perfmetrics.testing.matchers import is_histogram
+
+        client = FakeStatsDClient()
+        self.statsd_client_stack.push(client)
 
-    def __getattr__(self, name):
-        return getattr(self.metric, name)
+        @self._makeOne('spam', count=False, kind='distribution')
+        def spam():
+            """Does nothing"""
 
-    def __call__(self, func):
-        return self.metricmod(self.metric(func))
+        spam()
+        with self._makeOne('eggs', count=False, kind='histogram', tags={'a': 'b'}):
+            pass
 
-    def __enter__(self):
-        self.metricmod.__enter__()
-        self.metric.__enter__()
+        observations = client.observations
+        self.assertEqual(len(observations), 2)
+        assert_that(observations[0], is_distribution('spam.t'))
+        assert_that(observations[1], is_histogram('eggs.t', tags={'a': 'b'}))
 
-    def __exit__(self, t, v, tb):
-        self.metric.__exit__(t, v, tb)
-        self.metricmod.__exit__(t, v, tb)
+    def test_precise(self):
+        client = self._add_client()
 
-    def __str__(self):
-        return str(self.metricmod)
+        @self._makeOne('spam', count=False)
+        def spam():
+            """Does nothing"""
+
+        @self._makeOne('eggs', count=False, precise=True)
+        def eggs():
+            """Does nothing"""
+
+        spam()
+        eggs()
+        with self._makeOne('cm', count=False, precise=True):
+            pass
+
+        spam_ms, eggs_ms, cm_ms = [t[1] for t in client.timings]
+        self.assertIsInstance(spam_ms, int)
+        self.assertIsInstance(eggs_ms, float)
+        self.assertIsInstance(cm_ms, float)
+        self.assertLess(eggs_ms, 10000)
+
+    def _sent_timing(self, client, **kwargs):
+        # Time a call that takes at least 1.5ms, and return the value
+        # and type the client sent for it.
+        import time
+        from perfmetrics.testing.client import _TrackingSocket
+        client.udp_sock.close()
+        client.udp_sock = sock = _TrackingSocket()
+        self.statsd_client_stack.push(client)
 
+        @self._makeOne('spam', count=False, **kwargs)
+        def spam():
+            time.sleep(0.0015)
+
+        spam()
+        self.assertEqual(len(sock.sent_packets), 1)
+        packet, _ = sock.sent_packets[0]
+        self.assertRegex(packet, r'^spam\.t:[0-9.]+\|(ms|us)$')
+        value, kind = packet.split(':')[1].split('|')
+        return value, kind
+
+    def test_timing_precision_alone(self):
+        from perfmetrics.statsd import StatsdClient
+        value, kind = self._sent_timing(StatsdClient(timing_precision=3))
+        self.assertEqual(kind, 'ms')
+        self.assertRegex(value, r'^[0-9]+\.[0-9]{3}$')
+        self.assertGreaterEqual(float(value), 1.5)
+
+    def test_timing_unit_alone(self):
+        from perfmetrics.statsd import StatsdClient
+        value, kind = self._sent_timing(StatsdClient(timing_unit='us'))
+        self.assertEqual(kind, 'us')
+        self.assertRegex(value, r'^[0-9]+$')
+        self.assertGreaterEqual(int(value), 1500)
+
+    def test_precise_alone(self):
+        from perfmetrics.statsd import StatsdClient
+        value, kind = self._sent_timing(StatsdClient(), precise=True)
+        self.assertEqual(kind, 'ms')
+        self.assertRegex(value, r'^[0-9]+\.[0-9]{3}$')
+        self.assertGreaterEqual(float(value), 1.5)
+
+    def test_default_whole_milliseconds(self):
+        from perfmetrics.statsd import StatsdClient
+        value, kind = self._sent_timing(StatsdClient())
+        self.assertEqual(kind, 'ms')
+        self.assertRegex(value, r'^[0-9]+$')
+        self.assertGreaterEqual(int(value), 1)
+
+    def test_other_clients_whole_milliseconds(self):
+        client = self._add_client()
+        with self._makeOne('spam', count=False):
+            pass
+        self.assertEqual(len(client.timings), 1)
+        self.assertIs(type(client.timings[0][1]), int)
 
-class TestMetricMod(TestMetric):
+        client.fractional_timing = True
+        with self._makeOne('spam', count=False):
+            pass
+        self.assertIs(type(client.timings[1][1]), float)
 
-    def _makeOne(self, *args, **kwargs):
-        return SequenceDecorator(*args, **kwargs)
+    def test_histogram_whole_milliseconds(self):
+        from perfmetrics.testing import FakeStatsDClient
+        client = FakeStatsDClient()
+        self.statsd_client_stack.push(client)
+        with self._makeOne('spam', count=False, kind='histogram'):
+            pass
+        with self._makeOne('eggs', count=False, kind='histogram', precise=True):
+            pass
+        self.assertEqual(len(client.udp_sock.sent_packets), 2)
+        spam, eggs = [p[0] for p in client.udp_sock.sent_packets]
+        self.assertRegex(spam, r'^spam\.t:[0-9]+\|h$')
+        self.assertRegex(eggs, r'^eggs\.t:[0-9]+\.[0-9]+(e-[0-9]+)?\|h$')
+
+    def test_counter_sampling(self):
+        client = self._add_client()
+
+        @self._makeOne('spam', rate=0.3, timing=False, sampling='counter')
+        def spam():
+            """Does nothing"""
+
+        for _ in range(10):
+            spam()
+        # One call in every three, starting with the first.
+        self.assertEqual([change[2] for change in client.changes], [1.0 / 3] * 4)
+
+        metric = self._makeOne('cm', rate=0.5, timing=False, sampling='counter')
+        for _ in range(5):
+            with metric:
+                pass
+        self.assertEqual([c[2] for c in client.changes if c[0] == 'cm'], [0.5] * 3)
+
+        metric = self._makeOne('quarter', rate=0.25, timing=False, sampling='counter')
+        for _ in range(20):
+            with metric:
+                pass
+        self.assertEqual([c[2] for c in client.changes if c[0] == 'quarter'], [0.25] * 5)
+
+    def test_geometric_sampling(self):
+        client = self._add_client()
+
+        @self._makeOne('spam', rate=0.5, timing=False, sampling='geometric',
+                       random=lambda: 0.5)
+        def spam():
+            """Does nothing"""
+
+        for _ in range(7):
+            spam()
+        # log(0.5) / log(1 - 0.5) == 1, so we record every second call.
+        self.assertEqual([change[2] for change in client.changes], [0.5] * 3)
+
+    def test_sampling_reports_rate_of_interval(self):
+        client = self._add_client()
+
+        @self._makeOne('spam', rate=0.5, timing=False, sampling='counter')
+        def spam():
+            """Does nothing"""
+
+        # MetricMod wraps us in a function.
+        impl = spam if hasattr(spam, 'metric_rate') else spam.__wrapped__
+        spam()
+        impl.metric_rate = 0.25
+        for _ in range(6):
+            spam()
+        # The first interval was chosen with a rate of 0.5; the ones
+        # that start after the change use the new rate.
+        self.assertEqual([change[2] for change in client.changes], [0.5, 0.25, 0.25])
+
+        impl.metric_rate = 0
+        for _ in range(10):
+            spam()
+        self.assertEqual(len(client.changes), 3)
+
+    def test_bad_sampling(self):
+        with self.assertRaises(ValueError):
+            self._makeOne(sampling='sometimes')
+
+    def test_bad_kind(self):
+        with self.assertRaises(ValueError):
+            self._makeOne(kind='gauge')
+
+    def test_decorate_coroutine_function(self):
+        import asyncio
+        metric = self._makeOne('spam')
+
+        @metric
+        async def spam(x):
+            await asyncio.sleep(0.02)
+            return x
+
+        self.assertTrue(asyncio.iscoroutinefunction(spam))
+        self.assertEqual(spam.__name__, 'spam')
+
+        # Without a client.
+        self.assertEqual(asyncio.run(spam(1)), 1)
+
+        client = self._add_client()
+        self.assertEqual(asyncio.run(spam(2)), 2)
+        self.assertEqual(len(client.changes), 1)
+        self.assertEqual(len(client.timings), 1)
+        stat, ms, _rate, _buf, _rate_applied = client.timings[0]
+        self.assertEqual(stat, 'spam.t')
+        # The time until the coroutine returned, not the time to
+        # create it.
+        self.assertGreaterEqual(ms, 15)
+        self.assertEqual(client.sentbufs, [['count_line', 'timing_line']])
+
+    def test_decorate_coroutine_method(self):
+        import asyncio
+        metricmethod = self._makeOne(method=True, timing=False)
+
+        class Spam(object):
+            @metricmethod
+            async def f(self):
+                raise ValueError
+
+        self.assertTrue(asyncio.iscoroutinefunction(Spam().f))
+        client = self._add_client()
+        with self.assertRaises(ValueError):
+            asyncio.run(Spam().f())
+        self.assertEqual(client.changes, [
+            (__name__ + '.Spam.f', 1, 1, None, True),
+        ])
+
+    def test_ignore_coroutine_sample(self):
+        import asyncio
+
+        @self._makeOne('spam', rate=0.99, random=lambda: 0.999)
+        async def spam():
+            return 77
+
+        client = self._add_client()
+        self.assertEqual(asyncio.run(spam()), 77)
+        self.assertFalse(client.changes)
+        self.assertFalse(client.timings)
+        self.assertFalse(client.sentbufs)
+
+    def test_decorate_coroutine_without_count(self):
+        import asyncio
+
+        @self._makeOne('spam', count=False)
+        async def spam():
+            return 77
+
+        client = self._add_client()
+        self.assertEqual(asyncio.run(spam()), 77)
+        self.assertFalse(client.changes)
+        self.assertEqual([t[0] for t in client.timings], ['spam.t'])
+        self.assertFalse(client.sentbufs)
+
+    def test_errors(self):
+        metric = self._makeOne('spam', errors=True)
+        self.assertTrue(metric.errors)
+        self.assertFalse(metric.error_types)
+
+        @metric
+        def spam(fail):
+            if fail:
+                raise ValueError
+            return 42
+
+        impl = spam if hasattr(spam, 'metric_errors') else spam.__wrapped__
+        self.assertTrue(impl.metric_errors)
+        self.assertFalse(impl.metric_error_types)
+        client = self._add_client()
+        self.assertEqual(spam(False), 42)
+        self.assertEqual([c[0] for c in client.changes], ['spam'])
+        self.assertEqual([t[0] for t in client.timings], ['spam.t'])
+
+        del client.changes[:]
+        del client.timings[:]
+        del client.sentbufs[:]
+        with self.assertRaises(ValueError):
+            spam(True)
+        self.assertEqual([c[0] for c in client.changes], ['spam', 'spam.error'])
+        self.assertEqual([t[0] for t in client.timings], ['spam.error.t'])
+        # All in one packet.
+        self.assertEqual(client.sentbufs, [['count_line', 'count_line', 'timing_line']])
+
+    def test_error_types(self):
+        metric = self._makeOne('spam', timing=False, error_types=True)
+        self.assertTrue(metric.errors)
+
+        class Interrupted(BaseException):
+            pass
+
+        @metric
+        def spam(exc):
+            raise exc
+
+        client = self._add_client()
+        for exc in (ValueError, KeyError, ValueError, Interrupted):
+            with self.assertRaises(exc):
+                spam(exc)
+        self.assertEqual([c[0] for c in client.changes], [
+            'spam', 'spam.error', 'spam.error.ValueError',
+            'spam', 'spam.error', 'spam.error.KeyError',
+            'spam', 'spam.error', 'spam.error.ValueError',
+            # Not an Exception
+            'spam',
+        ])
+        self.assertEqual(client.timings, [])
+        # The names are cached.
+        self.assertIs(client.changes[2][0], client.changes[8][0])
+
+    def test_errors_coroutine(self):
+        import asyncio
+        metric = self._makeOne('spam', error_types=True)
+
+        @metric
+        async def spam():
+            raise ValueError
+
+        client = self._add_client()
+        with self.assertRaises(ValueError):
+            asyncio.run(spam())
+        self.assertEqual([c[0] for c in client.changes],
+                         ['spam', 'spam.error', 'spam.error.ValueError'])
+        self.assertEqual([t[0] for t in client.timings], ['spam.error.t'])
+        self.assertEqual(len(client.sentbufs), 1)
+
+    def test_errors_generator(self):
+        metric = self._makeOne('spam', errors=True)
+
+        @metric
+        def spam(fail):
+            yield 1
+            if fail:
+                raise ValueError
+
+        client = self._add_client()
+        self.assertEqual(list(spam(False)), [1])
+        with self.assertRaises(ValueError):
+            list(spam(True))
+        self.assertEqual([c[0] for c in client.changes], [
+            'spam', 'spam.items',
+            'spam', 'spam.error', 'spam.items',
+        ])
+        self.assertEqual([t[0] for t in client.timings], [
+            'spam.t', 'spam.first.t',
+            'spam.error.t', 'spam.first.t',
+        ])
+
+        # Closing it early isn't an error.
+        del client.changes[:]
+        gen = spam(True)
+        next(gen)
+        gen.close()
+        self.assertEqual([c[0] for c in client.changes], ['spam', 'spam.items'])
+
+    def test_errors_context_manager(self):
+        client = self._add_client()
+        with self.assertRaises(ValueError):
+            with self._makeOne('spam', error_types=True):
+                raise ValueError
+        with self._makeOne('spam', error_types=True):
+            pass
+        self.assertEqual([c[0] for c in client.changes], [
+            'spam', 'spam.error', 'spam.error.ValueError',
+            'spam',
+        ])
+        self.assertEqual([t[0] for t in client.timings], ['spam.error.t', 'spam.t'])
+
+    def _iterated(self, client, stat):
+        # Return the timings reported for a generator, and its number
+        # of items.
+        timings = {t[0]: t[1] for t in client.timings}
+        changes = {c[0]: c[1] for c in client.changes}
+        self.assertEqual(changes[stat], 1)
+        return timings, changes.get(stat + '.items')
+
+    def test_decorate_generator_function(self):
+        import time
+        metric = self._makeOne('spam')
+
+        @metric
+        def spam(n):
+            for i in range(n):
+                time.sleep(0.01)
+                yield i
+            return 'done'
+
+        self.assertEqual(spam.__name__, 'spam')
+        # Without a client.
+        self.assertEqual(list(spam(2)), [0, 1])
+
+        client = self._add_client()
+        gen = spam(3)
+        self.assertEqual(client.sentbufs, [])
+        self.assertEqual(list(gen), [0, 1, 2])
+        timings, items = self._iterated(client, 'spam')
+        self.assertEqual(items, 3)
+        self.assertGreaterEqual(timings['spam.t'], 25)
+        self.assertGreaterEqual(timings['spam.first.t'], 5)
+        self.assertLess(timings['spam.first.t'], timings['spam.t'])
+        self.assertEqual(len(client.sentbufs), 1)
+
+        # The return value is kept.
+        def outer():
+            result = yield from spam(0)
+            self.assertEqual(result, 'done')
+        self.assertEqual(list(outer()), [])
+
+    def test_generator_send_throw_close(self):
+        metric = self._makeOne('spam', count=False)
+        closed = []
+
+        @metric
+        def spam():
+            try:
+                total = 0
+                while True:
+                    try:
+                        total += yield total
+                    except ValueError:
+                        total = -1
+            finally:
+                closed.append(True)
+
+        client = self._add_client()
+        gen = spam()
+        self.assertEqual(next(gen), 0)
+        self.assertEqual(gen.send(2), 2)
+        self.assertEqual(gen.send(3), 5)
+        self.assertEqual(gen.throw(ValueError), -1)
+        self.assertEqual(client.sentbufs, [])
+        gen.close()
+        self.assertEqual(closed, [True])
+        self.assertEqual([t[0] for t in client.timings], ['spam.t', 'spam.first.t'])
+        self.assertEqual([c[:3] for c in client.changes], [('spam.items', 4, 1)])
+
+    def test_generator_exception(self):
+        metric = self._makeOne('spam')
+
+        @metric
+        def spam():
+            yield 1
+            raise ValueError
+
+        client = self._add_client()
+        gen = spam()
+        self.assertEqual(next(gen), 1)
+        with self.assertRaises(ValueError):
+            next(gen)
+        _timings, items = self._iterated(client, 'spam')
+        self.assertEqual(items, 1)
+
+        # A generator that fails before its first item reports no
+        # items.
+        @metric
+        def eggs():
+            raise ValueError
+            yield # pylint:disable=unreachable
+
+        del client.timings[:]
+        del client.changes[:]
+        with self.assertRaises(ValueError):
+            list(eggs())
+        timings, items = self._iterated(client, 'spam')
+        self.assertEqual(items, None)
+        self.assertEqual(list(timings), ['spam.t'])
+
+    def test_ignore_generator_sample(self):
+        @self._makeOne('spam', rate=0.99, random=lambda: 0.999)
+        def spam():
+            yield 1
+
+        client = self._add_client()
+        self.assertEqual(list(spam()), [1])
+        self.assertFalse(client.changes)
+        self.assertFalse(client.timings)
+        self.assertFalse(client.sentbufs)
+
+    def test_generator_tags(self):
+        from perfmetrics.testing import FakeStatsDClient
+
+        @self._makeOne('spam', timing=False, errors=True, tags={'env': 'prod'})
+        def spam():
+            yield 1
+            yield 2
+
+        client = FakeStatsDClient()
+        self.statsd_client_stack.push(client)
+        self.assertEqual(list(spam()), [1, 2])
+        self.assertEqual(client.packets, ['spam:1|c|#env:prod\nspam.items:2|c|#env:prod'])
+
+    def test_async_generator_exception(self):
+        import asyncio
+
+        @self._makeOne('spam', errors=True)
+        async def spam():
+            yield 1
+            raise ValueError
+
+        client = self._add_client()
+
+        async def main():
+            return [i async for i in spam()]
+
+        with self.assertRaises(ValueError):
+            asyncio.run(main())
+        self.assertEqual([c[:2] for c in client.changes], [
+            ('spam', 1), ('spam.error', 1), ('spam.items', 1),
+        ])
+        self.assertEqual(sorted(t[0] for t in client.timings),
+                         ['spam.error.t', 'spam.first.t'])
+
+    def test_generator_without_timing(self):
+        metric = self._makeOne('spam', timing=False)
+
+        @metric
+        def spam():
+            yield 1
+
+        client = self._add_client()
+        self.assertEqual(list(spam()), [1])
+        self.assertEqual(client.timings, [])
+        self.assertEqual(client.changes, [('spam', 1, 1, ['count_line'], True)])
+
+    def test_decorate_generator_method(self):
+        metricmethod = self._makeOne(method=True)
+
+        class Spam(object):
+            @metricmethod
+            def f(self):
+                yield 1
+                yield 2
+
+        client = self._add_client()
+        self.assertEqual(list(Spam().f()), [1, 2])
+        stat = __name__ + '.Spam.f'
+        timings, items = self._iterated(client, stat)
+        self.assertEqual(items, 2)
+        self.assertEqual(sorted(timings), [stat + '.first.t', stat + '.t'])
+
+    def test_decorate_async_generator_function(self):
+        import asyncio
+        metric = self._makeOne('spam')
+        closed = []
+
+        @metric
+        async def spam(n):
+            try:
+                for i in range(n):
+                    await asyncio.sleep(0.01)
+                    try:
+                        yield i
+                    except ValueError:
+                        yield -1
+            finally:
+                closed.append(True)
+
+        client = self._add_client()
+
+        async def main():
+            items = [i async for i in spam(3)]
+            gen = spam(5)
+            items.append(await gen.__anext__())
+            items.append(await gen.athrow(ValueError))
+            await gen.aclose()
+            return items
+
+        self.assertEqual(asyncio.run(main()), [0, 1, 2, 0, -1])
+        self.assertEqual(closed, [True, True])
+        self.assertEqual(len(client.sentbufs), 2)
+        timings = [t for t in client.timings if t[0] == 'spam.t']
+        self.assertEqual(len(timings), 2)
+        self.assertGreaterEqual(timings[0][1], 25)
+        self.assertEqual([c[:2] for c in client.changes if c[0] == 'spam.items'],
+                         [('spam.items', 3), ('spam.items', 2)])
+
+        @self._makeOne(method=True)
+        async def eggs(_self):
+            yield 1
+
+        del client.changes[:]
+        async def method():
+            return [i async for i in eggs(self)]
+        self.assertEqual(asyncio.run(method()), [1])
+        self.assertEqual(len(client.changes), 2)
+
+    def test_async_context_manager(self):
+        import asyncio
+        client = self._add_client()
+
+        async def spam():
+            async with self._makeOne('spam'):
+                await asyncio.sleep(0.02)
+
+        asyncio.run(spam())
+        self.assertEqual(len(client.changes), 1)
+        self.assertEqual(len(client.timings), 1)
+        stat, ms, _rate, _buf, _rate_applied = client.timings[0]
+        self.assertEqual(stat, 'spam.t')
+        self.assertGreaterEqual(ms, 15)
+
+
+class TestErrorStats(unittest.TestCase):
+    # The cache of error stat names is shared by all metrics, so this
+    # isn't part of TestMetric (and isn't run again for MetricMod).
+
+    def test_cache_is_bounded(self):
+        from perfmetrics import Metric
+        from perfmetrics import statsd_client_stack
+        client = MockStatsdClient()
+        statsd_client_stack.push(client)
+        self.addCleanup(statsd_client_stack.clear)
+        # Each new name is cached until there are 10000 of them and
+        # the cache is emptied; the same for the names by exception type.
+        metrics = [Metric('spam%d' % i, count=False, timing=False, errors=True)
+                   for i in range(10001)]
+        metrics += [Metric('spam', count=False, timing=False, error_types=True)] * 10001
+        for i, metric in enumerate(metrics):
+            with self.assertRaises(Exception):
+                with metric:
+                    raise type('Error%d' % i, (Exception,), {})
+        self.assertEqual(len(client.changes), 30003)
+        self.assertEqual([c[0] for c in client.changes[-2:]],
+                         ['spam.error', 'spam.error.Error20001'])
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from . import test_metric
+from .test_metric import MockStatsdClient
+
+
+class SequenceDecorator(object):
+
+    def __init__(self, *args, **kwargs):
+        from perfmetrics import Metric
+        from perfmetrics import MetricMod
+
+        self.args = args
+        self.kwargs = kwargs
+        self.metric = Metric(*args, **kwargs)
+        self.metricmod = MetricMod("%s")
+
+    def __getattr__(self, name):
+        return getattr(self.metric, name)
+
+    def __call__(self, func):
+        return self.metricmod(self.metric(func))
+
+    def __enter__(self):
+        self.metricmod.__enter__()
+        self.metric.__enter__()
+
+    def __exit__(self, t, v, tb):
+        self.metric.__exit__(t, v, tb)
+        self.metricmod.__exit__(t, v, tb)
+
+    async def __aenter__(self):
+        # Not MetricMod.__aenter__, which warns about the thread-local
+        # stack the tests use.
+        self.metricmod.__enter__()
+        await self.metric.__aenter__()
+
+    async def __aexit__(self, t, v, tb):
+        await self.metric.__aexit__(t, v, tb)
+        self.metricmod.__exit__(t, v, tb)
+
+    def __str__(self):
+        return str(self.metricmod)
+
+
+class TestMetricMod(test_metric.TestMetric):
+
+    def _makeOne(self, *args, **kwargs):
+        return SequenceDecorator(*args, **kwargs)
+
+    def test_mod_tags(self):
+        from perfmetrics import Metric
+        from perfmetrics import MetricMod
+        from perfmetrics.testing import FakeStatsDClient
+
+        client = FakeStatsDClient()
+        self.statsd_client_stack.push(client)
+
+        @MetricMod('mod.%s', tags=['env:prod'])
+        @Metric('spam', timing=False, tags={'host': 'web1'})
+        def spam():
+            """Does nothing"""
+
+        spam()
+        with MetricMod('mod.%s', tags=['env:prod']):
+            with Metric('eggs', timing=False):
+                pass
+
+        self.assertEqual(client.packets, [
+            'mod.spam:1|c|#env:prod,host:web1',
+            'mod.eggs:1|c|#env:prod',
+        ])
+
+    def test_mod_coroutine(self):
+        import asyncio
+        import warnings
+        from perfmetrics import Metric
+        from perfmetrics.clientstack import ContextClientStack
+        from perfmetrics import MetricMod
+        from perfmetrics.testing import FakeStatsDClient
+
+        client = FakeStatsDClient()
+        self.statsd_client_stack.push(client)
+
+        @MetricMod('mod.%s')
+        async def spam():
+            await asyncio.sleep(0)
+            with Metric('spam', timing=False):
+                pass
+
+        self.assertTrue(asyncio.iscoroutinefunction(spam))
+
+        async def eggs():
+            async with MetricMod('mod2.%s'):
+                await asyncio.sleep(0)
+                async with Metric('eggs', timing=False):
+                    pass
+
+        asyncio.run(spam())
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            asyncio.run(eggs())
+        self.assertEqual(client.packets, [
+            'mod.spam:1|c',
+            'mod2.eggs:1|c',
+        ])
+        self.assertEqual(self.statsd_client_stack.stack, [client])
+        # Other tasks would see the modification while the block is
+        # suspended, unless each has its own stack.
+        context = isinstance(self.statsd_client_stack, ContextClientStack)
+        self.assertEqual([w.category for w in caught], [] if context else [RuntimeWarning])
+
+    def test_mod_of_metric_coroutine(self):
+        import asyncio
+        from perfmetrics import Metric
+        from perfmetrics import MetricMod
+        from perfmetrics.testing import FakeStatsDClient
+
+        client = FakeStatsDClient()
+        self.statsd_client_stack.push(client)
+
+        @MetricMod('mod.%s')
+        @Metric('spam', timing=False)
+        async def spam():
+            await asyncio.sleep(0)
+
+        asyncio.run(spam())
+        self.assertEqual(client.packets, ['mod.spam:1|c'])
+
+    def test_mod_concurrent_coroutines(self):
+        import asyncio
+        from perfmetrics import Metric
+        from perfmetrics import MetricMod
+        from perfmetrics.testing import FakeStatsDClient
+
+        client = FakeStatsDClient()
+        self.statsd_client_stack.push(client)
+
+        async def spam(name):
+            for _ in range(3):
+                await asyncio.sleep(0)
+                with Metric(name, timing=False):
+                    pass
+
+        eggs = MetricMod('eggs.%s')(spam)
+        ham = MetricMod('ham.%s')(spam)
+
+        async def main():
+            await asyncio.gather(eggs('a'), ham('b'), spam('c'))
+
+        asyncio.run(main())
+        # Each task only saw its own modification, even when they
+        # share the stack.
+        self.assertEqual(sorted(client.packets),
+                         ['c:1|c'] * 3 + ['eggs.a:1|c'] * 3 + ['ham.b:1|c'] * 3)
+        self.assertEqual(self.statsd_client_stack.stack, [client])
+
+    def test_mod_coroutine_interrupted(self):
+        import asyncio
+        from perfmetrics import Metric
+        from perfmetrics import MetricMod
+        from perfmetrics.testing import FakeStatsDClient
+
+        client = FakeStatsDClient()
+        self.statsd_client_stack.push(client)
+
+        @MetricMod('mod.%s')
+        async def spam(name):
+            try:
+                # Interrupted here.
+                await asyncio.sleep(0)
+            except asyncio.CancelledError:
+                with Metric(name + '.cancelled', timing=False):
+                    pass
+                raise
+            finally:
+                with Metric(name + '.done', timing=False):
+                    pass
+
+        async def cancel():
+            task = asyncio.ensure_future(spam('a'))
+            await asyncio.sleep(0)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(cancel())
+
+        coro = spam('b')
+        coro.send(None)
+        coro.close()
+
+        self.assertEqual(client.packets, [
+            'mod.a.cancelled:1|c',
+            'mod.a.done:1|c',
+            'mod.b.done:1|c',
+        ])
+        self.assertEqual(self.statsd_client_stack.stack, [client])
+
+    def test_nested_mods(self):
+        from perfmetrics import Metric
+        from perfmetrics import MetricMod
+        from perfmetrics.testing import FakeStatsDClient
+
+        client = FakeStatsDClient()
+        self.statsd_client_stack.push(client)
+
+        outer = MetricMod('a.%s', tags=['env:prod'])
+        inner = MetricMod('b.%s', tags=['role:web'])
+        literal = MetricMod('c%%d.%s')
+
+        pushed = []
+        for _ in range(2):
+            with outer:
+                with inner:
+                    pushed.append(self.statsd_client_stack.get())
+                    with literal:
+                        pushed.append(self.statsd_client_stack.get())
+                        with Metric('spam', timing=False):
+                            pass
+
+        self.assertEqual(client.packets, [
+            'a.b.c%d.spam:1|c|#env:prod,role:web',
+        ] * 2)
+
+        # The wrappers are composed, so only the real client is
+        # wrapped, and the second time around the same combinations
+        # come from the cache.
+        for inner_wrapper, literal_wrapper in (pushed[:2], pushed[2:]):
+            self.assertIs(inner_wrapper._wrapped, client) # pylint:disable=protected-access
+            self.assertEqual(inner_wrapper.format, 'a.b.%s')
+            self.assertEqual(inner_wrapper.tags, ('env:prod', 'role:web'))
+            self.assertIs(literal_wrapper._wrapped, client) # pylint:disable=protected-access
+            self.assertEqual(literal_wrapper.format, 'a.b.c%%d.%s')
+            self.assertEqual(literal_wrapper.tags, ('env:prod', 'role:web'))
+
+    def test_mod_reuses_formatted_stats(self):
+        from perfmetrics import MetricMod
+
+        class Stat(object):
+            formatted = 0
+
+            def __str__(self):
+                Stat.formatted += 1
+                return 'spam'
+
+        stat = Stat()
+        client = self._add_client()
+        outer = MetricMod('a.%s')
+        inner = MetricMod('b.%s')
+        for _ in range(2):
+            with outer:
+                with inner:
+                    self.statsd_client_stack.get().incr(stat)
+                with outer:
+                    self.statsd_client_stack.get().incr(stat)
+        self.assertEqual([c[0] for c in client.changes], ['a.b.spam', 'a.a.spam'] * 2)
+        # Each combination formatted the stat once; the second time
+        # around, the names were already cached.
+        self.assertEqual(Stat.formatted, 2)
+
+    def test_mod_of_unhashable_client(self):
+        from perfmetrics import Metric
+        from perfmetrics import MetricMod
+
+        class Client(MockStatsdClient):
+            __hash__ = None
+
+        client = Client()
+        self.statsd_client_stack.push(client)
+        with MetricMod('a.%s'):
+            with MetricMod('%s.b'):
+                with Metric('spam', timing=False):
+                    pass
+        self.assertEqual([c[0] for c in client.changes], ['a.spam.b'])
+
+    def test_mod_does_not_keep_client(self):
+        import gc
+        import weakref
+        from perfmetrics import MetricMod
+        from perfmetrics.testing import FakeStatsDClient
+
+        mod = MetricMod('a.%s')
+        client = FakeStatsDClient()
+        self.statsd_client_stack.push(client)
+        with mod:
+            with MetricMod('b.%s'):
+                pass
+        self.statsd_client_stack.pop()
+        ref = weakref.ref(client)
+        del client
+        gc.collect()
+        self.assertIsNone(ref())
@@ -56,6 +56,38 @@ class Test_statsd_client_from_uri(unittest.TestCase):
         client = self._call('statsd://localhost:8129?prefix=spamalot')
         self.assertEqual(client.prefix, 'spamalot.')
 
+    def test_with_packet_size(self):
+        client = self._call('statsd://localhost:8129?packet_size=512&flush_interval=2')
+        self.assertEqual(client.packet_size, 512)
+        self.assertEqual(client.flush_interval, 2.0)
+
+    def test_with_timing_precision(self):
+        client = self._call('statsd://localhost:8129?timing_precision=3&timing_unit=us')
+        self.assertEqual(client.timing_precision, 3)
+        self.assertEqual(client.timing_unit, 'us')
+
+    def test_nonblocking(self):
+        client = self._call('statsd://localhost:8129?nonblocking=1&sndbuf=65536')
+        self.assertTrue(client.nonblocking)
+        self.assertEqual(client.sndbuf, 65536)
+        client = self._call('statsd://localhost:8129?nonblocking=false')
+        self.assertFalse(client.nonblocking)
+
+    def test_resolve_interval(self):
+        client = self._call('statsd://localhost:8129?resolve_interval=30')
+        self.assertEqual(client.resolve_interval, 30.0)
+        self.assertIsNotNone(client._resolver) # pylint:disable=protected-access
+
+    def test_sharded(self):
+        from perfmetrics.transports import ShardedStatsdClient
+        client = self._call('statsd://localhost:8129,127.0.0.1?prefix=spamalot&packet_size=512')
+        self.assertIsInstance(client, ShardedStatsdClient)
+        self.assertEqual(client.prefix, 'spamalot.')
+        self.assertEqual(sorted(client.clients), [('127.0.0.1', 8125), ('localhost', 8129)])
+        for sub in client.clients.values():
+            self.assertEqual(sub.prefix, '')
+            self.assertEqual(sub.packet_size, 512)
+
 
 class TestDisabledDecorators(unittest.TestCase):
 
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import math
+import threading
+import unittest
+from urllib.request import urlopen
+
+from hamcrest import assert_that
+
+from perfmetrics.interfaces import IStatsdClient
+
+from . import validly_provides
+
+# pylint:disable=protected-access
+
+
+class TestPrometheusStatsdClient(unittest.TestCase):
+
+    def _makeOne(self, **kwargs):
+        from perfmetrics.prometheus import PrometheusStatsdClient
+        inst = PrometheusStatsdClient(**kwargs)
+        self.addCleanup(inst.close)
+        return inst
+
+    def _render(self, client):
+        return b''.join(client.render()).decode('utf-8')
+
+    def test_provides(self):
+        assert_that(self._makeOne(), validly_provides(IStatsdClient))
+
+    def test_empty(self):
+        self.assertEqual(self._render(self._makeOne()), '')
+
+    def test_special_values(self):
+        client = self._makeOne()
+        client.gauge('a', math.inf)
+        client.gauge('b', -math.inf)
+        client.gauge('c', math.nan)
+        self.assertEqual(self._render(client), '\n'.join([
+            '# TYPE a gauge',
+            'a +Inf',
+            '# TYPE b gauge',
+            'b -Inf',
+            '# TYPE c gauge',
+            'c NaN',
+            '',
+        ]))
+
+    def test_counters_and_gauges(self):
+        client = self._makeOne(prefix='app')
+        gauge = self._makeOne()
+        gauge.gauge('1-sessions', 1)
+        self.assertEqual(self._render(gauge), '# TYPE _1_sessions gauge\n_1_sessions 1.0\n')
+        client.incr('requests.count', tags={'path': '/a"b\\c\nd', 'host': None})
+        client.incr('requests.count', 2, tags={'path': '/a"b\\c\nd', 'host': None})
+        client.decr('requests.count')
+        client.random = lambda: 0.1
+        client.incr('requests.count', rate=0.5)
+        client.incr('requests.count', rate=0.05)
+        client.gauge('1-sessions', 42, tags=('env:prod', 'env-2:x'))
+        client.gauge('1-sessions', 43, rate=0.05)
+        client.set_add('users', 'bob')
+        client.sendbuf([b'other:1|c'])
+        client.flush()
+        self.assertEqual(self._render(client), '\n'.join([
+            '# TYPE app_1_sessions gauge',
+            'app_1_sessions{env="prod",env_2="x"} 42.0',
+            '# TYPE app_requests_count_total counter',
+            'app_requests_count_total{host="true",path="/a\\"b\\\\c\\nd"} 3.0',
+            'app_requests_count_total 1.0',
+            '',
+        ]))
+
+    def test_timers_and_histograms(self):
+        client = self._makeOne(buckets=(1, '0.1'))
+        client.timing('render', 50)
+        client.timing('render', 500, tags={'kind': 'page'})
+        client.timing('render', 5000, rate=0.5, rate_applied=True)
+        client.random = lambda: 0.9
+        client.timing('render', 5000, rate=0.5)
+        client.histogram('size', 0.1)
+        client.distribution('size', 2)
+        self.assertEqual(self._render(client), '\n'.join([
+            '# TYPE render_seconds histogram',
+            'render_seconds_bucket{le="0.1"} 1.0',
+            'render_seconds_bucket{le="1.0"} 1.0',
+            'render_seconds_bucket{le="+Inf"} 3.0',
+            'render_seconds_sum 10.05',
+            'render_seconds_count 3.0',
+            'render_seconds_bucket{le="0.1",kind="page"} 0.0',
+            'render_seconds_bucket{le="1.0",kind="page"} 1.0',
+            'render_seconds_bucket{le="+Inf",kind="page"} 1.0',
+            'render_seconds_sum{kind="page"} 0.5',
+            'render_seconds_count{kind="page"} 1.0',
+            '# TYPE size histogram',
+            'size_bucket{le="0.1"} 1.0',
+            'size_bucket{le="1.0"} 1.0',
+            'size_bucket{le="+Inf"} 2.0',
+            'size_sum 2.1',
+            'size_count 2.0',
+            '',
+        ]))
+
+    def test_same_series_spelled_differently(self):
+        from types import MappingProxyType
+        client = self._makeOne()
+        client.incr('a.b', tags={'x': '1', 'y': '2'})
+        client.incr('a.b', tags={'y': '2', 'x': '1'})
+        client.incr('a_b', tags=('y:2', 'x:1'))
+        client.incr('a_b', tags=MappingProxyType({'x': '1', 'y': '2'}))
+        client.incr('a_b', tags=MappingProxyType({'x': '1', 'y': '3'}))
+        self.assertEqual(self._render(client), '\n'.join([
+            '# TYPE a_b_total counter',
+            'a_b_total{x="1",y="2"} 4.0',
+            'a_b_total{x="1",y="3"} 1.0',
+            '',
+        ]))
+
+    def test_series_added_by_another_thread(self):
+        client = self._makeOne()
+        key = ('counter', 'a', None)
+        # Both threads missed the series before taking the lock.
+        series = client._add_series(key, None)
+        self.assertIs(client._add_series(key, None), series)
+        client.incr('a')
+        self.assertEqual(self._render(client), '# TYPE a_total counter\na_total 1.0\n')
+
+    def test_name_used_by_another_type(self):
+        client = self._makeOne()
+        client.gauge('x_total', 5)
+        with self.assertLogs('perfmetrics.prometheus', 'WARNING') as logs:
+            client.incr('x')
+            client.incr('x')
+            client.histogram('x_total', 1)
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn('x_total is already a gauge', logs.output[0])
+        self.assertEqual(self._render(client), '\n'.join([
+            '# TYPE x_total gauge',
+            'x_total 5.0',
+            '',
+        ]))
+
+    def test_render_is_incremental(self):
+        client = self._makeOne()
+        client.incr('a')
+        client.incr('b')
+        chunks = client.render()
+        self.assertEqual(next(chunks), b'# TYPE a_total counter\na_total 1.0\n')
+        # Recording isn't blocked in the middle of a scrape.
+        client.incr('b')
+        client.incr('c')
+        self.assertEqual(next(chunks), b'# TYPE b_total counter\nb_total 2.0\n')
+        self.assertEqual(list(chunks), [])
+
+    def test_after_fork(self):
+        client = self._makeOne()
+        client.incr('a')
+        client._after_fork()
+        self.assertEqual(self._render(client), '')
+
+    def test_from_uri(self):
+        from perfmetrics import statsd_client_from_uri
+        from perfmetrics.prometheus import PrometheusStatsdClient
+        client = statsd_client_from_uri('prometheus://?prefix=app&buckets=0.5,1')
+        self.addCleanup(client.close)
+        self.assertIsInstance(client, PrometheusStatsdClient)
+        self.assertEqual(client.prefix, 'app.')
+        self.assertEqual(client.buckets, (0.5, 1.0))
+        self.assertIsNone(client.server)
+
+    def test_server(self):
+        from perfmetrics import statsd_client_from_uri
+        client = statsd_client_from_uri('prometheus://127.0.0.1:0')
+        server = client.server
+        self.assertIsNotNone(server)
+        client.incr('a')
+        url = 'http://127.0.0.1:%d' % server.server_address[1]
+        with urlopen(url + '/metrics', timeout=5) as response:
+            self.assertEqual(response.headers['Content-Type'],
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.assertEqual(response.read(), b'# TYPE a_total counter\na_total 1.0\n')
+        self.assertRaises(IOError, urlopen, url + '/other', timeout=5)
+        client.close()
+        self.assertIsNone(client.server)
+        client.close()
+
+
+class Test_make_prometheus_app(unittest.TestCase):
+
+    def setUp(self):
+        from perfmetrics import set_statsd_client, statsd_client_stack
+        set_statsd_client(None)
+        statsd_client_stack.clear()
+
+    def test_requires_client(self):
+        from perfmetrics.prometheus import make_prometheus_app
+        with self.assertRaises(ValueError):
+            make_prometheus_app(lambda environ, start_response: None)
+
+    def test_composes_with_statsd_app(self):
+        from perfmetrics import make_statsd_app
+        from perfmetrics.prometheus import make_prometheus_app
+
+        def dummy_app(_environ, start_response):
+            start_response('200 OK', [])
+            return [b'ok.']
+
+        statsd_app = make_statsd_app(dummy_app, None, 'prometheus://')
+        app = make_prometheus_app(statsd_app, None)
+        self.assertIs(app.statsd_client, statsd_app.statsd_client)
+        statuses = []
+
+        def start_response(status, _headers):
+            statuses.append(status)
+
+        self.assertEqual(app({'PATH_INFO': '/'}, start_response), [b'ok.'])
+        body = b''.join(app({'PATH_INFO': '/metrics'}, start_response))
+        self.assertEqual(statuses, ['200 OK', '200 OK'])
+        self.assertIn(b'perfmetrics_wsgi_total 1.0\n', body)
+        self.assertIn(b'perfmetrics_wsgi_t_seconds_count 1.0\n', body)
+
+    def test_threaded_scrape(self):
+        from perfmetrics.prometheus import PrometheusStatsdClient
+        client = PrometheusStatsdClient()
+        for i in range(1000):
+            client.timing('t%d' % i, i)
+        done = threading.Event()
+
+        def record():
+            while not done.is_set():
+                client.timing('t1', 1)
+        thread = threading.Thread(target=record)
+        thread.start()
+        try:
+            body = b''.join(client.render())
+        finally:
+            done.set()
+            thread.join()
+        self.assertEqual(body.count(b'# TYPE'), 1000)
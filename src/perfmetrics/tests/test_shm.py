@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import unittest
+
+from hamcrest import assert_that
+from hamcrest import contains_inanyorder
+
+from perfmetrics.interfaces import IStatsdClient
+from perfmetrics.testing import FakeStatsDClient
+from perfmetrics.testing.matchers import is_counter
+from perfmetrics.testing.matchers import is_gauge
+from perfmetrics.testing.matchers import is_histogram
+
+from . import validly_provides
+
+# pylint:disable=protected-access
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), "Requires fork")
+class TestSharedMemoryStatsdClient(unittest.TestCase):
+
+    sink = None
+
+    def _makeOne(self, flush_interval=0, **kwargs):
+        from perfmetrics.shm import SharedMemoryStatsdClient
+        self.sink = FakeStatsDClient()
+        inst = SharedMemoryStatsdClient(self.sink, flush_interval, **kwargs)
+        self.addCleanup(inst.close)
+        return inst
+
+    def _fork(self, child):
+        pid = os.fork()
+        if not pid: # pragma: no cover
+            # In the child. Never return to the test runner.
+            status = 1
+            try:
+                child()
+                status = 0
+            finally:
+                os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+
+    def test_provides(self):
+        assert_that(self._makeOne(), validly_provides(IStatsdClient))
+
+    def test_aggregates_across_processes(self):
+        client = self._makeOne()
+        client.incr('a')
+        client.timing('t', 5, tags={'env': 'prod'})
+
+        for i in range(3):
+            def child(i=i): # pragma: no cover
+                client.incr('a', 2)
+                client.decr('b')
+                client.timing('t', 10 * (i + 1), tags={'env': 'prod'})
+                # Not shared.
+                client.gauge('g', 1)
+                assert self.sink.observations[-1].name == 'g'
+                client.close()
+            self._fork(child)
+
+        client.flush()
+        tags = {'env': 'prod'}
+        assert_that(self.sink.observations, contains_inanyorder(
+            is_counter('a', '7'),
+            is_counter('b', '-3'),
+            is_counter('t.count', '4', tags=tags),
+            is_gauge('t.sum', '65', tags=tags),
+            is_gauge('t.lower', '5', tags=tags),
+            is_gauge('t.upper', '30', tags=tags),
+        ))
+
+        # Only what changed is sent next time.
+        self.sink.clear()
+        client.timing('t', 7, tags={'env': 'prod'})
+        client.flush()
+        assert_that(self.sink.observations, contains_inanyorder(
+            is_counter('t.count', '1', tags=tags),
+            is_gauge('t.sum', '7', tags=tags),
+            is_gauge('t.lower', '7', tags=tags),
+            is_gauge('t.upper', '7', tags=tags),
+        ))
+        self.sink.clear()
+        client.flush()
+        self.assertEqual(self.sink.packets, [])
+
+    def test_stripes_of_exited_processes_are_reused(self):
+        client = self._makeOne(max_workers=2)
+        client.incr('a')
+        for _ in range(3):
+            def child(): # pragma: no cover
+                client.incr('a')
+                assert client._stripe == 1
+            self._fork(child)
+        client.flush()
+        self.assertEqual(self.sink.packets, ['a:4|c'])
+
+    def test_after_fork_state(self):
+        # What a child sees, checked in this process.
+        client = self._makeOne()
+        client.incr('a')
+        client.decr('b')
+        client._after_fork()
+        self.assertIsNone(client._stripe)
+        self.assertIsNone(client._thread)
+        # A name registered by another process is found in the
+        # shared segment.
+        client._slots.clear()
+        del client._names[:]
+        client.incr('a')
+        self.assertEqual(client._stripe, 0)
+        self.assertEqual(client._slots, {('c', 'a', None): 0, ('c', 'b', None): 1})
+        client.flush()
+        self.assertEqual(self.sink.packets, ['a:2|c\nb:-1|c'])
+
+    def test_pid_is_alive(self):
+        from perfmetrics.shm import _pid_is_alive
+        self.assertTrue(_pid_is_alive(os.getpid()))
+        pid = os.fork()
+        if not pid: # pragma: no cover
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertFalse(_pid_is_alive(pid))
+
+        def kill(_pid, _signal):
+            raise PermissionError("Not ours")
+        old = os.kill
+        os.kill = kill
+        try:
+            self.assertTrue(_pid_is_alive(1))
+        finally:
+            os.kill = old
+
+    def test_no_free_stripe(self):
+        client = self._makeOne(max_workers=1)
+        # Our parent is running.
+        client._ints[8] = os.getppid()
+        client.incr('a')
+        client.timing('t', 5)
+        self.assertEqual(self.sink.packets, ['a:1|c', 't:5|ms'])
+
+    def test_no_room_for_stat(self):
+        client = self._makeOne(max_stats=1)
+        client.incr('a')
+        client.incr('b')
+        self.assertEqual(self.sink.packets, ['b:1|c'])
+        client.timing('a', 1)
+        self.assertEqual(self.sink.packets, ['b:1|c', 'a:1|ms'])
+        client.max_stats = 2
+        client._slots.clear()
+        client.incr('x' * 300)
+        self.assertEqual(len(self.sink.packets), 3)
+        client.flush()
+        self.assertEqual(self.sink.packets[-1], 'a:1|c')
+
+    def test_sampling(self):
+        client = self._makeOne()
+        client.random = lambda: 0.5
+        client.incr('a', rate=0.1)
+        client.incr('a', rate=0.9)
+        client.timing('t', 3, rate=0.1)
+        client.timing('t', 2, rate=0.5, rate_applied=True)
+        client.timing('t', 4, rate=0.9)
+        client.timing('t', 1)
+        client.flush()
+        assert_that(self.sink.observations, contains_inanyorder(
+            is_counter('a', '1.1111111111111112'),
+            is_counter('t.count', '4.111111111111111'),
+            is_gauge('t.sum', '9.444444444444445'),
+            is_gauge('t.lower', '1'),
+            is_gauge('t.upper', '4'),
+        ))
+
+    def test_unshared_kinds(self):
+        client = self._makeOne()
+        client.gauge('g', 1)
+        client.set_add('s', 2)
+        client.histogram('h', 3)
+        client.distribution('d', 4)
+        client.sendbuf([])
+        client.sendbuf(['x:1|c'])
+        self.assertEqual(self.sink.packets,
+                         ['g:1|g', 's:2|s', 'h:3|h', 'd:4|d', 'x:1|c'])
+        assert_that(self.sink.observations[2], is_histogram('h', '3'))
+
+    def test_background_flush(self):
+        client = self._makeOne(flush_interval=0.01)
+        client.incr('a')
+        for _ in range(500):
+            if self.sink.packets:
+                break
+            client._stopped.wait(0.01)
+        self.assertEqual(self.sink.packets, ['a:1|c'])
+        client.close()
+        self.assertIsNone(client._thread)
+        client.close()
+
+    def test_background_flush_error(self):
+        client = self._makeOne(flush_interval=0.01)
+        flushed = []
+        def flush():
+            flushed.append(1)
+            client._stopped.set()
+            raise RuntimeError("synthetic")
+        client.flush = flush
+        client._thread.join()
+        self.assertEqual(flushed, [1])
+        del client.flush
+
+    def test_from_uri(self):
+        from perfmetrics import statsd_client_from_uri
+        from perfmetrics.shm import SharedMemoryStatsdClient
+        client = statsd_client_from_uri('statsd://localhost:8125?shared_interval=5')
+        self.addCleanup(client.close)
+        self.assertIsInstance(client, SharedMemoryStatsdClient)
+        self.assertEqual(client.flush_interval, 5.0)
+        self.assertEqual(client.client.packet_size, 1432)
@@ -3,6 +3,13 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import errno
+import logging
+import os
+import socket
+import sys
+import threading
+import time
 import unittest
 
 from zope.interface import verify
@@ -14,6 +21,7 @@ from perfmetrics.interfaces import IStatsdClient
 from . import validly_provides
 from . import is_true
 from . import implements
+from . import use_sendmmsg
 
 
 # pylint:disable=protected-access
@@ -79,8 +87,8 @@ class TestStatsdClient(TestBasics):
     STAT_NAME2 = 'other.thing'
     STAT_NAME2B = b'other.thing'
 
-    def _make(self, patch_socket=True, error=None, prefix=''):
-        obj = self._makeOne(prefix=prefix)
+    def _make(self, patch_socket=True, error=None, prefix='', **kwargs):
+        obj = self._makeOne(prefix=prefix, **kwargs)
 
         if patch_socket:
             obj.udp_sock.close()
@@ -198,6 +206,67 @@ class TestStatsdClient(TestBasics):
         obj.sendbuf(['some.thing:41|g'])
         self.assertEqual(self.sent, [])
 
+    def test_send_with_full_buffer(self):
+        obj = self._make(error=BlockingIOError(errno.EAGAIN, 'synthetic'))
+        with self.assertLogs('perfmetrics.statsd') as logs:
+            obj.sendbuf(['some.thing:41|g', 'some.thing:42|g'])
+            obj.incr(self.STAT_NAME)
+            # assertLogs requires something to be logged.
+            obj.log.info("Done")
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(obj.dropped, 3)
+        self.assertEqual(obj.errors, 0)
+
+    def test_send_errors_logged_periodically(self):
+        obj = self._make(error=IOError('synthetic'))
+        with self.assertLogs('perfmetrics.statsd') as logs:
+            obj.incr(self.STAT_NAME)
+            obj.incr(self.STAT_NAME)
+            obj.incr(self.STAT_NAME)
+            obj.error_log_interval = 0
+            obj.incr(self.STAT_NAME)
+        self.assertEqual(obj.errors, 4)
+        self.assertEqual(obj.dropped, 0)
+        self.assertEqual(
+            [r.getMessage() for r in logs.records],
+            ['Failed to send to statsd (failures since the last message: 1)',
+             'Failed to send to statsd (failures since the last message: 3)'])
+
+    def test_send_errors_logged_after_recovery(self):
+        obj = self._make(error=IOError('synthetic'))
+        with self.assertLogs('perfmetrics.statsd') as logs:
+            obj.incr(self.STAT_NAME)
+            obj.incr(self.STAT_NAME)
+            obj.incr(self.STAT_NAME)
+            obj.udp_sock.error = None
+            # Not until the interval has passed.
+            obj.incr(self.STAT_NAME)
+            obj.flush()
+            obj.error_log_interval = 0
+            obj.incr(self.STAT_NAME)
+            obj.incr(self.STAT_NAME)
+        self.assertEqual(len(self.sent), 3)
+        self.assertEqual(
+            [r.getMessage() for r in logs.records],
+            ['Failed to send to statsd (failures since the last message: 1)',
+             'Failed to send to statsd (failures since the last message: 2)'])
+
+    def test_send_errors_logged_by_flush_and_close(self):
+        obj = self._make(error=IOError('synthetic'))
+        with self.assertLogs('perfmetrics.statsd') as logs:
+            obj.incr(self.STAT_NAME)
+            obj.incr(self.STAT_NAME)
+            obj.error_log_interval = 0
+            obj.flush()
+            obj.error_log_interval = 60
+            obj.incr(self.STAT_NAME)
+            obj.close()
+        self.assertEqual(
+            [r.getMessage() for r in logs.records],
+            ['Failed to send to statsd (failures since the last message: 1)',
+             'Failed to send to statsd (failures since the last message: 1)',
+             'Failed to send to statsd (failures since the last message: 1)'])
+
     def test_sendbuf_with_empty_buf(self):
         obj = self._make()
         obj.sendbuf([])
@@ -217,6 +286,173 @@ class TestStatsdClient(TestBasics):
         self.assertEqual(self.sent,
                          [(self.STAT_NAMEB + b':42|s\n' + self.STAT_NAME2B + b':23|s', obj.addr)])
 
+    def test_encoded_stats_cache_is_bounded(self):
+        obj = self._make(prefix='pfx')
+        obj.max_cached_stats = 2
+        buf = []
+        for name in (self.STAT_NAME, self.STAT_NAME2, 'third') * 2:
+            obj.incr(name, buf=buf)
+        self.assertEqual(len(buf), 6)
+        self.assertEqual(len(set(buf)), 3)
+        self.assertEqual(buf[:3], buf[3:])
+        self.assertTrue(buf[0].startswith(b'pfx.'))
+
+    def test_histogram(self):
+        obj = self._make()
+        buf = []
+        obj.histogram(self.STAT_NAME, 1.5, buf=buf)
+        obj.histogram(self.STAT_NAME, 2, buf=buf, tags={'a': 'b'})
+        obj.random = lambda: 0.01
+        obj.histogram(self.STAT_NAME, 3, rate=0.1, buf=buf)
+        obj.random = lambda: 0.99
+        obj.histogram(self.STAT_NAME, 4, rate=0.1, buf=buf)
+        self.assertEqual(buf, [
+            self.STAT_NAMEB + b':1.5|h',
+            self.STAT_NAMEB + b':2|h|#a:b',
+            self.STAT_NAMEB + b':3|h|@0.1',
+        ])
+        obj.histogram(self.STAT_NAME, 5)
+        self.assertEqual(self.sent, [(self.STAT_NAMEB + b':5|h', obj.addr)])
+
+    def test_distribution(self):
+        obj = self._make()
+        buf = []
+        obj.distribution(self.STAT_NAME, 1.5, buf=buf)
+        obj.distribution(self.STAT_NAME, 2, buf=buf, tags={'a': 'b'})
+        obj.random = lambda: 0.01
+        obj.distribution(self.STAT_NAME, 3, rate=0.1, buf=buf)
+        obj.random = lambda: 0.99
+        obj.distribution(self.STAT_NAME, 4, rate=0.1, buf=buf)
+        self.assertEqual(buf, [
+            self.STAT_NAMEB + b':1.5|d',
+            self.STAT_NAMEB + b':2|d|#a:b',
+            self.STAT_NAMEB + b':3|d|@0.1',
+        ])
+        obj.distribution(self.STAT_NAME, 5)
+        self.assertEqual(self.sent, [(self.STAT_NAMEB + b':5|d', obj.addr)])
+
+    def test_timing_precision(self):
+        self.assertFalse(self._make().fractional_timing)
+        obj = self._make(timing_precision=3)
+        self.assertTrue(obj.fractional_timing)
+        buf = []
+        obj.timing(self.STAT_NAME, 0.0123, buf=buf)
+        obj.timing(self.STAT_NAME, 5, buf=buf)
+        self.assertEqual(buf, [
+            self.STAT_NAMEB + b':0.012|ms',
+            self.STAT_NAMEB + b':5.000|ms',
+        ])
+
+    def test_timing_in_microseconds(self):
+        obj = self._make(timing_unit='us')
+        self.assertTrue(obj.fractional_timing)
+        buf = []
+        obj.timing(self.STAT_NAME, 0.0123, buf=buf)
+        obj.timing(self.STAT_NAME, 5, buf=buf)
+        self.assertEqual(buf, [
+            self.STAT_NAMEB + b':12|us',
+            self.STAT_NAMEB + b':5000|us',
+        ])
+
+        obj = self._make(timing_unit='us', timing_precision='1')
+        buf = []
+        obj.timing(self.STAT_NAME, 0.01234, buf=buf)
+        self.assertEqual(buf, [self.STAT_NAMEB + b':12.3|us'])
+
+    def test_precise_timing(self):
+        from perfmetrics.statsd import _PreciseMilliseconds
+        obj = self._make()
+        buf = []
+        obj.timing(self.STAT_NAME, 0.0123, buf=buf)
+        obj.timing(self.STAT_NAME, _PreciseMilliseconds(0.0123), buf=buf)
+        self.assertEqual(buf, [
+            self.STAT_NAMEB + b':0|ms',
+            self.STAT_NAMEB + b':0.012|ms',
+        ])
+
+        obj = self._make(timing_precision=5)
+        buf = []
+        obj.timing(self.STAT_NAME, _PreciseMilliseconds(0.0123), buf=buf)
+        self.assertEqual(buf, [self.STAT_NAMEB + b':0.01230|ms'])
+
+        obj = self._make(timing_unit='us')
+        buf = []
+        obj.timing(self.STAT_NAME, _PreciseMilliseconds(0.0123), buf=buf)
+        self.assertEqual(buf, [self.STAT_NAMEB + b':12|us'])
+
+    def test_bad_timing_unit(self):
+        with self.assertRaises(ValueError):
+            self._make(timing_unit='s')
+
+    def test_tags(self):
+        obj = self._make()
+        tags = {'host': 'web1', 'env': 'prod'}
+        buf = []
+        obj.timing(self.STAT_NAME, 750, buf=buf, tags=tags)
+        obj.gauge(self.STAT_NAME, 50, buf=buf, tags=tags)
+        obj.incr(self.STAT_NAME, buf=buf, tags=tags)
+        obj.decr(self.STAT_NAME, buf=buf, tags=tags)
+        obj.set_add(self.STAT_NAME, 42, buf=buf, tags=tags)
+        obj.incr(self.STAT_NAME, buf=buf, tags={})
+        self.assertEqual(buf, [
+            self.STAT_NAMEB + b':750|ms|#env:prod,host:web1',
+            self.STAT_NAMEB + b':50|g|#env:prod,host:web1',
+            self.STAT_NAMEB + b':1|c|#env:prod,host:web1',
+            self.STAT_NAMEB + b':-1|c|#env:prod,host:web1',
+            self.STAT_NAMEB + b':42|s|#env:prod,host:web1',
+            self.STAT_NAMEB + b':1|c',
+        ])
+
+    def test_tags_follow_rate(self):
+        obj = self._make()
+        obj.random = lambda: 0.01
+        obj.incr(self.STAT_NAME, 51, rate=0.1, tags=['a:b'])
+        self.assertEqual(self.sent, [(self.STAT_NAMEB + b':51|c|@0.1|#a:b', obj.addr)])
+
+    def test_tags_are_canonical(self):
+        obj = self._make()
+        buf = []
+        obj.incr(self.STAT_NAME, buf=buf, tags={'b': 2, 'a': None})
+        obj.incr(self.STAT_NAME, buf=buf, tags={'a': None, 'b': 2})
+        obj.incr(self.STAT_NAME, buf=buf, tags=['b:2', 'a', 'b:2'])
+        obj.incr(self.STAT_NAME, buf=buf, tags=('b:2', 'a'))
+        self.assertEqual(set(buf), {self.STAT_NAMEB + b':1|c|#a,b:2'})
+
+    def test_tags_from_other_mappings(self):
+        from types import MappingProxyType
+        obj = self._make()
+        buf = []
+        obj.incr(self.STAT_NAME, buf=buf, tags=MappingProxyType({'env': 'prod'}))
+        obj.incr(self.STAT_NAME, buf=buf, tags=MappingProxyType({'env': 'dev'}))
+        obj.incr(self.STAT_NAME, buf=buf, tags=('env',))
+        self.assertEqual(buf, [
+            self.STAT_NAMEB + b':1|c|#env:prod',
+            self.STAT_NAMEB + b':1|c|#env:dev',
+            self.STAT_NAMEB + b':1|c|#env',
+        ])
+
+    def test_tags_from_other_iterables(self):
+        obj = self._make()
+        buf = []
+        obj.incr(self.STAT_NAME, buf=buf, tags={'b:2', 'a'})
+        obj.incr(self.STAT_NAME, buf=buf, tags=(t for t in ('env:prod',)))
+        self.assertEqual(buf, [
+            self.STAT_NAMEB + b':1|c|#a,b:2',
+            self.STAT_NAMEB + b':1|c|#env:prod',
+        ])
+
+    def test_encoded_tags_cache_is_bounded(self):
+        obj = self._make()
+        obj.max_cached_stats = 1
+        buf = []
+        for tags in ({'a': 1}, {'b': 2}, {'a': 1}):
+            obj.incr(self.STAT_NAME, buf=buf, tags=tags)
+        self.assertEqual(buf, [
+            self.STAT_NAMEB + b':1|c|#a:1',
+            self.STAT_NAMEB + b':1|c|#b:2',
+            self.STAT_NAMEB + b':1|c|#a:1',
+        ])
+
 
     def test_set_add_with_rate_hit(self):
         obj = self._make()
@@ -230,6 +466,520 @@ class TestStatsdClient(TestBasics):
         obj.set_add(self.STAT_NAME, 51, rate=0.1)
         self.assertEqual(self.sent, [])
 
+    def test_flush_without_batching(self):
+        obj = self._make()
+        obj.flush()
+        self.assertEqual(self.sent, [])
+
+    def test_batching_coalesces_calls(self):
+        obj = self._make(packet_size=512)
+        obj.incr(self.STAT_NAME)
+        obj.timing(self.STAT_NAME2, 750)
+        self.assertEqual(self.sent, [])
+        obj.flush()
+        self.assertEqual(self.sent,
+                         [(self.STAT_NAMEB + b':1|c\n' + self.STAT_NAME2B + b':750|ms',
+                           obj.addr)])
+        obj.flush()
+        self.assertEqual(len(self.sent), 1)
+
+    def test_batching_flushes_when_full(self):
+        line = self.STAT_NAMEB + b':1|c'
+        # Room for exactly two lines.
+        obj = self._make(packet_size=len(line) * 2 + 1)
+        for _ in range(5):
+            obj.incr(self.STAT_NAME)
+        self.assertEqual(self.sent, [(line + b'\n' + line, obj.addr)] * 2)
+        obj.close()
+        self.assertEqual(self.sent[2:], [(line, obj.addr)])
+
+    def test_batching_sends_oversized_line_alone(self):
+        obj = self._make(packet_size=4)
+        obj.incr(self.STAT_NAME)
+        self.assertEqual(self.sent, [(self.STAT_NAMEB + b':1|c', obj.addr)])
+
+    def test_batching_flushes_after_interval(self):
+        obj = self._make(packet_size=512, flush_interval=60)
+        obj.incr(self.STAT_NAME)
+        self.assertEqual(self.sent, [])
+        obj._batch_started -= 61
+        obj.incr(self.STAT_NAME2)
+        self.assertEqual(self.sent,
+                         [(self.STAT_NAMEB + b':1|c\n' + self.STAT_NAME2B + b':1|c',
+                           obj.addr)])
+
+    def test_batching_splits_sendbuf(self):
+        obj = self._make(packet_size=len(self.STAT_NAMEB) + 10)
+        buf = []
+        obj.incr(self.STAT_NAME, buf=buf)
+        obj.gauge(self.STAT_NAME, 42, buf=buf)
+        obj.sendbuf(buf)
+        self.assertEqual(self.sent, [(self.STAT_NAMEB + b':1|c', obj.addr)])
+        obj.flush()
+        self.assertEqual(self.sent[1:], [(self.STAT_NAMEB + b':42|g', obj.addr)])
+
+    def test_background_sender(self):
+        obj = self._make(queue_size='100', flush_interval=60)
+        self.assertIsNotNone(obj._sender)
+        obj.incr(self.STAT_NAME)
+        buf = []
+        obj.gauge(self.STAT_NAME2, 42, buf=buf)
+        obj.sendbuf(buf)
+        self.assertEqual(self.sent, [])
+        obj.flush()
+        self.assertEqual(self.sent,
+                         [(self.STAT_NAMEB + b':1|c\n' + self.STAT_NAME2B + b':42|g',
+                           obj.addr)])
+        obj.close()
+        self.assertIsNone(obj._sender)
+
+    def test_background_sender_wakes_when_half_full(self):
+        obj = self._make(queue_size=4, flush_interval=60)
+        obj.incr(self.STAT_NAME)
+        obj.incr(self.STAT_NAME)
+        for _ in range(500):
+            if self.sent:
+                break
+            time.sleep(0.01)
+        line = self.STAT_NAMEB + b':1|c'
+        self.assertEqual(self.sent, [(line + b'\n' + line, obj.addr)])
+
+    def test_background_sender_drops_when_full(self):
+        obj = self._make(queue_size=3, flush_interval=60)
+        obj._stop_sender()
+        obj.sendbuf(['a:1|c', 'b:1|c'])
+        obj.sendbuf(['c:1|c', 'd:1|c'])
+        obj.incr(self.STAT_NAME)
+        self.assertEqual(obj.dropped, 2)
+        self.assertEqual(list(obj._queue), [b'a:1|c', b'b:1|c', b'c:1|c'])
+
+    def test_background_sender_error(self):
+        obj = self._make(queue_size=10, flush_interval=60)
+        sent = []
+        orig_send_queued = obj._send_queued
+        def send_queued():
+            if not sent:
+                sent.append(1)
+                obj._stopping = True
+                raise RuntimeError("synthetic")
+            orig_send_queued()
+        obj._send_queued = send_queued
+        obj._wakeup.set()
+        obj._sender.join()
+        self.assertEqual(sent, [1])
+
+    def test_background_sender_flushed_at_exit(self):
+        from perfmetrics.statsd import _flush_background_clients
+        obj = self._make(queue_size=10, flush_interval=60)
+        obj.incr(self.STAT_NAME)
+        _flush_background_clients()
+        self.assertIsNone(obj._sender)
+        self.assertEqual(self.sent, [(self.STAT_NAMEB + b':1|c', obj.addr)])
+
+    def test_batching_starts_sender(self):
+        obj = self._make(packet_size=512, flush_interval=60)
+        self.assertIsNotNone(obj._sender)
+        obj.incr(self.STAT_NAME)
+        obj._wakeup.set()
+        for _ in range(500):
+            if self.sent:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.sent, [(self.STAT_NAMEB + b':1|c', obj.addr)])
+        obj.close()
+        self.assertIsNone(obj._sender)
+
+    def test_batching_options_from_strings(self):
+        obj = self._make(patch_socket=False, packet_size='1432', flush_interval='0.5')
+        self.assertEqual(obj.packet_size, 1432)
+        self.assertEqual(obj.flush_interval, 0.5)
+
+
+class TestSendPackets(unittest.TestCase):
+
+    def _receiver(self, family=socket.AF_INET, host='127.0.0.1'):
+        receiver = socket.socket(family, socket.SOCK_DGRAM)
+        self.addCleanup(receiver.close)
+        receiver.bind((host, 0))
+        receiver.settimeout(5)
+        return receiver
+
+    def _makeOne(self, receiver, **kwargs):
+        from perfmetrics.statsd import StatsdClient
+        host, port = receiver.getsockname()[:2]
+        inst = StatsdClient(host, port, **kwargs)
+        self.addCleanup(inst.close)
+        return inst
+
+    def test_coalesced_line_sent_after_interval(self):
+        receiver = self._receiver()
+        obj = self._makeOne(receiver, packet_size=512, flush_interval=0.1)
+        obj.incr('some.thing')
+        # Nothing else is sent, but the background thread sends the
+        # line once it's old enough.
+        self.assertEqual(receiver.recv(1024), b'some.thing:1|c')
+
+    def test_coalesced_lines_sent_at_exit(self):
+        import subprocess
+        receiver = self._receiver()
+        host, port = receiver.getsockname()[:2]
+        subprocess.check_call([
+            sys.executable, '-c',
+            'from perfmetrics.statsd import StatsdClient\n'
+            'client = StatsdClient(%r, %d, packet_size=512, flush_interval=60)\n'
+            'client.incr("some.thing")\n' % (host, port)
+        ])
+        self.assertEqual(receiver.recv(1024), b'some.thing:1|c')
+
+    def _check_send_packets(self, receiver):
+        use_sendmmsg(self)
+        obj = self._makeOne(receiver)
+        packets = [b'some.thing:%d|c' % i for i in range(200)]
+        obj.send_packets(packets)
+        received = [receiver.recv(1024) for _ in packets]
+        self.assertEqual(received, packets)
+        return obj
+
+    def test_send_packets_ipv4(self):
+        obj = self._check_send_packets(self._receiver())
+        self.assertEqual(obj._sockaddr[0], obj.addr)
+
+    @unittest.skipUnless(socket.has_ipv6, "Requires IPv6")
+    def test_send_packets_ipv6(self):
+        try:
+            receiver = self._receiver(socket.AF_INET6, '::1')
+        except OSError: # pragma: no cover
+            self.skipTest("IPv6 loopback not available")
+        self._check_send_packets(receiver)
+
+    def test_send_one_packet(self):
+        receiver = self._receiver()
+        obj = self._makeOne(receiver)
+        obj.send_packets([b'a:1|c'])
+        self.assertEqual(receiver.recv(1024), b'a:1|c')
+        self.assertIsNone(obj._sockaddr)
+
+    def test_send_packets_error(self):
+        use_sendmmsg(self)
+        receiver = self._receiver()
+        obj = self._makeOne(receiver)
+        obj.udp_sock.close()
+        obj.send_packets([b'a:1|c', b'b:1|c'])
+        self.assertEqual(obj.errors, 1)
+
+    def test_coalesced_flush_uses_send_packets(self):
+        receiver = self._receiver()
+        obj = self._makeOne(receiver, packet_size=6)
+        obj.sendbuf(['a:1|c', 'b:1|c', 'c:1|c'])
+        obj.flush()
+        self.assertEqual([receiver.recv(1024) for _ in range(3)],
+                         [b'a:1|c', b'b:1|c', b'c:1|c'])
+
+    def test_nonblocking(self):
+        receiver = self._receiver()
+        obj = self._makeOne(receiver, nonblocking='true', sndbuf='65536')
+        self.assertTrue(obj._connected)
+        self.assertFalse(obj.udp_sock.getblocking())
+        self.assertGreaterEqual(
+            obj.udp_sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF), 65536)
+        obj.incr('a')
+        self.assertEqual(receiver.recv(1024), b'a:1|c')
+        obj.send_packets([b'b:1|c', b'c:1|c'])
+        self.assertEqual(receiver.recv(1024), b'b:1|c')
+        self.assertEqual(receiver.recv(1024), b'c:1|c')
+        self.assertEqual(obj.dropped, 0)
+
+    def test_send_packets_full_buffer(self):
+        statsd = use_sendmmsg(self)
+        receiver = self._receiver()
+        obj = self._makeOne(receiver)
+        results = [2, BlockingIOError(errno.ENOBUFS, 'synthetic')]
+
+        def sendmmsg(_fd, _packets, _address):
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        old = statsd.sendmmsg
+        statsd.sendmmsg = sendmmsg
+        try:
+            obj.send_packets([b'a:1|c', b'b:1|c', b'c:1|c\nd:1|c'])
+            self.assertEqual(obj.dropped, 2)
+            obj.send_packets([b'a:1|c', b'b:1|c'])
+            self.assertEqual(obj.dropped, 4)
+        finally:
+            statsd.sendmmsg = old
+        self.assertEqual(obj.errors, 0)
+
+    def test_send_packets_errors_logged_after_recovery(self):
+        statsd = use_sendmmsg(self)
+        receiver = self._receiver()
+        obj = self._makeOne(receiver)
+        results = [IOError('synthetic'), IOError('synthetic'), 2]
+
+        def sendmmsg(_fd, _packets, _address):
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        old = statsd.sendmmsg
+        statsd.sendmmsg = sendmmsg
+        try:
+            with self.assertLogs('perfmetrics.statsd') as logs:
+                obj.send_packets([b'a:1|c', b'b:1|c'])
+                obj.send_packets([b'a:1|c', b'b:1|c'])
+                obj.error_log_interval = 0
+                obj.send_packets([b'a:1|c', b'b:1|c'])
+        finally:
+            statsd.sendmmsg = old
+        self.assertEqual(obj.errors, 2)
+        self.assertEqual(
+            [r.getMessage() for r in logs.records],
+            ['Failed to send to statsd (failures since the last message: 1)',
+             'Failed to send to statsd (failures since the last message: 1)'])
+
+    def test_resolve(self):
+        receiver = self._receiver()
+        obj = self._makeOne(receiver)
+        addr = obj.addr
+        self.assertEqual(obj._addrs, (addr,))
+        obj.resolve()
+        self.assertEqual(obj.addr, addr)
+        # The server moved here from somewhere else.
+        obj.addr = ('127.0.0.2', addr[1])
+        obj.resolve()
+        self.assertEqual(obj.addr, addr)
+        obj.incr('a')
+        self.assertEqual(receiver.recv(1024), b'a:1|c')
+
+    def test_resolve_connected(self):
+        receiver = self._receiver()
+        obj = self._makeOne(receiver, nonblocking=True)
+        addr = obj.addr
+        obj.addr = ('127.0.0.2', addr[1])
+        obj.udp_sock.connect(obj.addr)
+        obj.resolve()
+        self.assertEqual(obj.udp_sock.getpeername(), addr)
+        obj.incr('a')
+        self.assertEqual(receiver.recv(1024), b'a:1|c')
+
+    def test_resolver_thread(self):
+        receiver = self._receiver()
+        obj = self._makeOne(receiver, resolve_interval='0.001')
+        calls = []
+        resolved = threading.Event()
+
+        def resolve():
+            calls.append(1)
+            if len(calls) == 1:
+                raise socket.gaierror("Logged and ignored")
+            resolved.set()
+        obj.resolve = resolve
+        self.assertTrue(resolved.wait(5))
+        obj.close()
+        self.assertIsNone(obj._resolver)
+        obj.close()
+
+    def test_failover(self):
+        receiver = self._receiver()
+        obj = self._makeOne(receiver, nonblocking=True)
+        live = obj.addr
+        dead = self._receiver()
+        dead_addr = dead.getsockname()
+        dead.close()
+        obj._addrs = (dead_addr, live)
+        obj._use_address(dead_addr)
+        # The first packet is refused by the kernel, and the second
+        # reports that.
+        obj.incr('a')
+        obj.incr('b')
+        self.assertEqual(obj.addr, live)
+        self.assertEqual(obj.errors, 1)
+        obj.incr('c')
+        self.assertEqual(receiver.recv(1024), b'c:1|c')
+        # Failing over goes around the list.
+        obj._failover()
+        self.assertEqual(obj.addr, dead_addr)
+        obj.addr = ('127.0.0.2', 1)
+        obj._failover()
+        self.assertEqual(obj.addr, dead_addr)
+
+    def test_use_address_connect_error(self):
+        receiver = self._receiver()
+        obj = self._makeOne(receiver, nonblocking=True)
+        obj.udp_sock.close()
+        with self.assertLogs('perfmetrics.statsd'):
+            obj._use_address(('127.0.0.1', 1))
+        self.assertEqual(obj.addr, ('127.0.0.1', 1))
+        self.assertEqual(obj.errors, 1)
+
+    def test_pack_sockaddr_unknown_family(self):
+        from perfmetrics.statsd import _pack_sockaddr
+        self.assertIsNone(_pack_sockaddr(-1, None))
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), "Requires fork")
+class TestFork(unittest.TestCase):
+
+    def setUp(self):
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(self.receiver.close)
+        self.receiver.bind(('127.0.0.1', 0))
+        self.receiver.settimeout(5)
+
+    def _makeOne(self, **kwargs):
+        from perfmetrics.statsd import StatsdClient
+        inst = StatsdClient(*self.receiver.getsockname(), **kwargs)
+        self.addCleanup(inst.close)
+        return inst
+
+    def _fork(self, child):
+        pid = os.fork()
+        if not pid: # pragma: no cover
+            # In the child. Never return to the test runner.
+            status = 1
+            try:
+                child()
+                status = 0
+            finally:
+                os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+
+    def _received(self, count):
+        by_sender = {}
+        for _ in range(count):
+            data, sender = self.receiver.recvfrom(1024)
+            by_sender.setdefault(sender, []).append(data)
+        return sorted(by_sender.values())
+
+    def _check(self, client):
+        parent_sock = client.udp_sock
+        client.incr('parent')
+
+        def child(): # pragma: no cover
+            assert client.udp_sock is not parent_sock
+            client.incr('child')
+            client.close()
+        self._fork(child)
+        client.incr('parent', 2)
+        client.flush()
+        # The child's lines came from its own socket, and it didn't
+        # send the parent's pending line.
+        return self._received(2)
+
+    def test_coalescing(self):
+        client = self._makeOne(packet_size=512, flush_interval=60)
+        self.assertEqual(self._check(client), [
+            [b'child:1|c'],
+            [b'parent:1|c\nparent:2|c'],
+        ])
+
+    def test_queue(self):
+        client = self._makeOne(queue_size=100, flush_interval=60)
+        self.assertEqual(self._check(client), [
+            [b'child:1|c'],
+            [b'parent:1|c\nparent:2|c'],
+        ])
+
+    def test_after_fork_error(self):
+        from perfmetrics import _util
+
+        class Broken(object):
+            def _after_fork(self):
+                raise ValueError("Logged and ignored")
+        broken = Broken()
+        # Don't reinitialize every client that exists.
+        registry = _util._fork_reinit
+        _util._fork_reinit = type(registry)()
+        try:
+            _util.reinit_after_fork(broken)
+            with self.assertLogs('perfmetrics._util'):
+                _util._after_fork_in_child()
+        finally:
+            _util._fork_reinit = registry
+
+    def test_after_fork_tcp(self):
+        from perfmetrics.transports import TCPStatsdClient
+        client = TCPStatsdClient('127.0.0.1', 1)
+        self.addCleanup(client.close)
+        sock = client.udp_sock = socket.socket()
+        client.incr('a')
+
+        def child(): # pragma: no cover
+            assert client.udp_sock is None
+            assert sock.fileno() == -1
+            assert not client._pending
+            assert client._sender.is_alive()
+        self._fork(child)
+        self.assertIs(client.udp_sock, sock)
+
+    def test_after_fork_other_socket(self):
+        from perfmetrics.testing import FakeStatsDClient
+        from perfmetrics.testing.client import _TrackingSocket
+        fake = FakeStatsDClient()
+        client = self._makeOne(queue_size=100, flush_interval=60)
+        fake.incr('parent')
+        failures = []
+        handler = logging.Handler(logging.ERROR)
+        handler.emit = failures.append
+        logger = logging.getLogger('perfmetrics._util')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        def child(): # pragma: no cover
+            assert not failures, failures
+            assert isinstance(fake.udp_sock, _TrackingSocket)
+            assert client._sender.is_alive()
+            fake.incr('child')
+            assert fake.packets == ['parent:1|c', 'child:1|c'], fake.packets
+        self._fork(child)
+
+    def test_after_fork_state(self):
+        # What the child sees, checked in this process. The threads
+        # must be stopped first; the child only has their objects.
+        client = self._makeOne(queue_size=100, flush_interval=60, resolve_interval=60)
+        client._stop_sender()
+        client._stop_resolver()
+        client._sender = client._resolver = threading.Thread(target=lambda: None)
+        parent_sock = client.udp_sock
+        client.incr('a')
+        self.assertEqual(list(client._queue), [b'a:1|c'])
+        client.errors = 1
+        client._after_fork()
+        self.assertIsNot(client.udp_sock, parent_sock)
+        self.assertEqual(parent_sock.fileno(), -1)
+        self.assertEqual(client.errors, 0)
+        self.assertEqual(list(client._queue), [])
+        self.assertTrue(client._sender.is_alive())
+        self.assertTrue(client._resolver.is_alive())
+        client.incr('b')
+        client.flush()
+        self.assertEqual(self.receiver.recv(1024), b'b:1|c')
+
+    def test_after_fork_socket_error(self):
+        from perfmetrics.statsd import StatsdClient
+
+        class Client(StatsdClient):
+            def _reopen_socket(self):
+                raise OSError("No more files")
+
+        client = Client(*self.receiver.getsockname(),
+                        packet_size=512, flush_interval=60)
+        self.addCleanup(client.close)
+        # Without the background thread; this isn't really a child.
+        client._stop_sender()
+        client.incr('a')
+        client.errors = 1
+        with self.assertLogs('perfmetrics.statsd'):
+            client._after_fork()
+        self.assertEqual(client.errors, 0)
+        # The pending line was dropped, and the client still works.
+        client.incr('b')
+        client.flush()
+        self.assertEqual(self.receiver.recv(1024), b'b:1|c')
+
+
 class TestStatsdClientMod(TestStatsdClient):
 
     STAT_NAMEB = b'wrap.some.thing'
@@ -249,3 +999,71 @@ class TestStatsdClientMod(TestStatsdClient):
         # can prove the method is getting called. With __getattr__ there, we could
         # silently call through to the wrapped class without knowing it.
         return self._class(wrapped, 'wrap.%s')
+
+    def test_mod_tags(self):
+        from perfmetrics.statsd import StatsdClient
+        wrapped = self._make()._wrapped
+        mod = self._class(wrapped, 'wrap.%s', tags={'env': 'prod'})
+        self.assertEqual(mod.tags, ('env:prod',))
+        buf = []
+        mod.timing(self.STAT_NAME, 750, buf=buf)
+        mod.gauge(self.STAT_NAME, 50, buf=buf)
+        mod.incr(self.STAT_NAME, buf=buf, tags={'host': 'web1'})
+        mod.decr(self.STAT_NAME, buf=buf)
+        mod.set_add(self.STAT_NAME, 42, buf=buf)
+        mod.histogram(self.STAT_NAME, 1, buf=buf)
+        mod.distribution(self.STAT_NAME, 2, buf=buf)
+        self.assertEqual(buf, [
+            self.STAT_NAMEB + b':750|ms|#env:prod',
+            self.STAT_NAMEB + b':50|g|#env:prod',
+            self.STAT_NAMEB + b':1|c|#env:prod,host:web1',
+            self.STAT_NAMEB + b':-1|c|#env:prod',
+            self.STAT_NAMEB + b':42|s|#env:prod',
+            self.STAT_NAMEB + b':1|h|#env:prod',
+            self.STAT_NAMEB + b':2|d|#env:prod',
+        ])
+        self.assertIsInstance(wrapped, StatsdClient)
+
+    def test_stat_cache(self):
+        class Mod(self._class):
+            max_cached_stats = 2
+        mod = Mod(self._make()._wrapped, 'wrap.%s')
+        buf = []
+        for name in ('a', 'b', 'c', 'a'):
+            mod.incr(name, buf=buf)
+            mod.incr(name, buf=buf)
+        self.assertEqual(buf, [
+            b'wrap.a:1|c', b'wrap.a:1|c',
+            b'wrap.b:1|c', b'wrap.b:1|c',
+            b'wrap.c:1|c', b'wrap.c:1|c',
+            b'wrap.a:1|c', b'wrap.a:1|c',
+        ])
+
+    def test_compose_mod(self):
+        from perfmetrics.statsd import _compose_mod
+        wrapped = self._make()._wrapped
+        outer = self._class(wrapped, 'a.%s', tags=['x:1'])
+        composed = _compose_mod(outer, 'b.%s', ['y:2'])
+        self.assertIs(composed._wrapped, wrapped)
+        self.assertEqual(composed.format, 'a.b.%s')
+        self.assertEqual(composed.tags, ('x:1', 'y:2'))
+
+        composed = _compose_mod(outer, 'b.%s', None)
+        self.assertEqual(composed.tags, ('x:1',))
+
+        # Formats that aren't a single plain %s are applied in turn.
+        for fmt in ('a%%.%s', '%-10s', '%s.%s'):
+            outer = self._class(wrapped, fmt)
+            composed = _compose_mod(outer, 'b.%s', None)
+            self.assertIs(composed._wrapped, outer)
+
+    def test_compose_mod_cache_is_bounded(self):
+        from perfmetrics.statsd import _compose_mod
+        wrapped = self._make()._wrapped
+        mods = {}
+        for i in range(20):
+            outer = self._class(wrapped, 'a%d.%%s' % i)
+            composed = _compose_mod(outer, 'b.%s', None, mods)
+            self.assertEqual(composed.format, 'a%d.b.%%s' % i)
+            self.assertLessEqual(len(mods), 16)
+        self.assertIn(('a19.%s', None), mods)
@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from hamcrest import assert_that
+
+from perfmetrics.interfaces import IStatsdClient
+
+from . import use_sendmmsg
+from . import validly_provides
+
+# pylint:disable=protected-access
+
+
+class TestImports(unittest.TestCase):
+
+    def test_available_from_statsd(self):
+        from perfmetrics import statsd
+        from perfmetrics import transports
+        # Where they were first defined.
+        for name in ('UnixStatsdClient', 'TCPStatsdClient', 'ShardedStatsdClient',
+                     'statsd_client_from_uri'):
+            self.assertIs(getattr(statsd, name), getattr(transports, name))
+        with self.assertRaises(AttributeError):
+            getattr(statsd, 'NoSuchClient')
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), "Requires Unix domain sockets")
+class TestUnixStatsdClient(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'statsd.sock')
+        self.receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(self.receiver.close)
+        self.receiver.bind(self.path)
+        self.receiver.settimeout(5)
+
+    def _makeOne(self, **kwargs):
+        from perfmetrics.transports import UnixStatsdClient
+        inst = UnixStatsdClient(self.path, **kwargs)
+        self.addCleanup(inst.close)
+        return inst
+
+    def test_provides(self):
+        assert_that(self._makeOne(), validly_provides(IStatsdClient))
+
+    def test_send(self):
+        obj = self._makeOne(prefix='foo')
+        self.assertEqual(obj.addr, self.path)
+        obj.incr('some.thing')
+        self.assertEqual(self.receiver.recv(1024), b'foo.some.thing:1|c')
+
+    def test_resolve_does_nothing(self):
+        from perfmetrics.transports import statsd_client_from_uri
+        obj = statsd_client_from_uri('unix://%s?resolve_interval=0.01' % (self.path,))
+        self.addCleanup(obj.close)
+        obj.resolve()
+        obj.incr('some.thing')
+        self.assertEqual(self.receiver.recv(1024), b'some.thing:1|c')
+
+    def test_send_large_batch(self):
+        obj = self._makeOne(packet_size=8192)
+        for i in range(1000):
+            obj.incr('some.thing', i)
+        obj.flush()
+        packet = self.receiver.recv(65536)
+        self.assertGreater(len(packet), 4096)
+        self.assertLessEqual(len(packet), 8192)
+        self.assertTrue(packet.startswith(b'some.thing:0|c\nsome.thing:1|c\n'))
+
+    def test_send_packets(self):
+        use_sendmmsg(self)
+        obj = self._makeOne()
+        obj.send_packets([b'a:1|c', b'b:1|c'])
+        self.assertEqual(self.receiver.recv(1024), b'a:1|c')
+        self.assertEqual(self.receiver.recv(1024), b'b:1|c')
+
+    def test_send_without_receiver(self):
+        self.receiver.close()
+        os.unlink(self.path)
+        obj = self._makeOne()
+        obj.incr('some.thing')
+
+    def test_nonblocking_without_receiver(self):
+        self.receiver.close()
+        os.unlink(self.path)
+        with self.assertLogs('perfmetrics.statsd', 'WARNING'):
+            obj = self._makeOne(nonblocking=True)
+        self.assertFalse(obj._connected)
+        obj.incr('some.thing')
+        self.assertEqual(obj.errors, 1)
+
+    def test_from_uri(self):
+        from perfmetrics.transports import UnixStatsdClient
+        from perfmetrics.transports import statsd_client_from_uri
+        for scheme in ('unix', 'statsd+unix'):
+            obj = statsd_client_from_uri('%s://%s?prefix=bar' % (scheme, self.path))
+            self.addCleanup(obj.close)
+            self.assertIsInstance(obj, UnixStatsdClient)
+            obj.gauge('some.thing', 42)
+            self.assertEqual(self.receiver.recv(1024), b'bar.some.thing:42|g')
+
+
+class MockStreamSocket(object):
+    def __init__(self, error=None):
+        self.sent = []
+        self.error = error
+        self.closed = False
+
+    def sendall(self, data):
+        if self.error is not None:
+            raise self.error # pylint:disable=raising-bad-type
+        self.sent.append(data)
+
+    def close(self):
+        self.closed = True
+
+
+class TestTCPStatsdClient(unittest.TestCase):
+
+    def _makeOne(self, *args, **kwargs):
+        from perfmetrics.transports import TCPStatsdClient
+        inst = TCPStatsdClient(*args, **kwargs)
+        self.addCleanup(inst.close)
+        return inst
+
+    def _make_connecting(self, sockets, **kwargs):
+        # Each connection attempt uses the next item in *sockets*;
+        # exceptions are raised. Only the tests flush, unless they wake
+        # the background thread.
+        kwargs.setdefault('flush_interval', 60)
+        obj = self._makeOne(**kwargs)
+        sockets = list(sockets)
+        def connect():
+            sock = sockets.pop(0)
+            if isinstance(sock, Exception):
+                raise sock
+            return sock
+        obj._connect = connect
+        return obj
+
+    def test_provides(self):
+        assert_that(self._makeOne(), validly_provides(IStatsdClient))
+
+    def test_defaults(self):
+        obj = self._makeOne(packet_size=0)
+        self.assertEqual(obj.packet_size, 8192)
+        self.assertIsNone(obj.udp_sock)
+
+    def test_resolve_does_nothing(self):
+        from perfmetrics.transports import statsd_client_from_uri
+        obj = statsd_client_from_uri('statsd+tcp://localhost:8125?resolve_interval=0.01')
+        self.addCleanup(obj.close)
+        obj.resolve()
+        self.assertEqual(obj.addr, ('localhost', 8125))
+        self.assertIsNone(obj.udp_sock)
+
+    def test_send_to_server(self):
+        server = socket.socket()
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        server.settimeout(5)
+
+        obj = self._makeOne('127.0.0.1', server.getsockname()[1], prefix='foo')
+        obj.incr('a')
+        obj.timing('b', 5)
+        self.assertIsNone(obj.udp_sock)
+        obj.flush()
+        conn, _ = server.accept()
+        self.addCleanup(conn.close)
+        conn.settimeout(5)
+        obj.gauge('c', 1)
+        obj.close()
+        data = b''
+        while True:
+            chunk = conn.recv(1024)
+            if not chunk:
+                break
+            data += chunk
+        self.assertEqual(data, b'foo.a:1|c\nfoo.b:5|ms\nfoo.c:1|g\n')
+
+    def test_reconnect_with_backoff(self):
+        broken = MockStreamSocket(IOError('synthetic'))
+        good = MockStreamSocket()
+        obj = self._make_connecting(
+            [IOError('refused'), broken, good],
+            max_backoff=0.25)
+        obj.sendbuf(['a:1|c'])
+        obj.flush()
+        self.assertIsNone(obj.udp_sock)
+        self.assertEqual(obj._backoff, 0.1)
+        # Too soon to retry
+        obj.flush()
+        self.assertEqual(len(obj._pending), 1)
+
+        obj._retry_at = 0
+        obj.flush()
+        self.assertTrue(broken.closed)
+        self.assertIsNone(obj.udp_sock)
+        self.assertEqual(obj._backoff, 0.2)
+        # Some of it might have been sent, so it isn't sent again.
+        self.assertEqual(len(obj._pending), 0)
+        self.assertEqual(obj.dropped, 1)
+
+        obj._retry_at = 0
+        obj.incr('b')
+        obj.flush()
+        self.assertIs(obj.udp_sock, good)
+        self.assertEqual(obj._backoff, 0)
+        self.assertEqual(good.sent, [b'b:1|c\n'])
+        self.assertEqual(obj.errors, 2)
+
+    def test_sent_by_background_thread(self):
+        good = MockStreamSocket()
+        obj = self._make_connecting([good])
+        connected_by = []
+        connect = obj._connect
+        def record_thread():
+            connected_by.append(threading.current_thread())
+            return connect()
+        obj._connect = record_thread
+
+        obj.send_packets([b'a:1|c'])
+        deadline = time.time() + 5
+        while not good.sent and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(good.sent, [b'a:1|c\n'])
+        self.assertEqual(connected_by, [obj._sender])
+
+    def test_after_fork_state(self):
+        # What the child sees, checked in this process; see
+        # test_statsd.TestFork.
+        good = MockStreamSocket()
+        obj = self._make_connecting([good])
+        obj._stop_sender()
+        obj._sender = threading.Thread(target=lambda: None)
+        obj.incr('a')
+        obj.flush()
+        self.assertIs(obj.udp_sock, good)
+        obj.send_packets([b'b:1|c'])
+        self.assertTrue(obj._pending)
+        obj._backoff = 1.0
+        obj._after_fork()
+        self.assertIsNone(obj.udp_sock)
+        self.assertTrue(good.closed)
+        self.assertFalse(obj._pending)
+        self.assertEqual(obj._backoff, 0)
+        self.assertTrue(obj._sender.is_alive())
+
+    def test_backoff_is_bounded(self):
+        obj = self._make_connecting([IOError('refused')] * 3, max_backoff=0.25)
+        for _ in range(3):
+            obj._retry_at = 0
+            obj.incr('a')
+            obj.flush()
+        self.assertEqual(obj._backoff, 0.25)
+
+    def test_buffer_is_bounded(self):
+        obj = self._make_connecting([IOError('refused')], max_buffer=20)
+        obj.sendbuf(['a:1|c', 'a:2|c'])
+        obj.flush()
+        obj.incr('b', 3)
+        obj.flush()
+        obj.incr('c', 4)
+        obj.flush()
+        self.assertEqual(list(obj._pending), [b'b:3|c\n', b'c:4|c\n'])
+        self.assertEqual(obj.dropped, 2)
+
+    def test_from_uri(self):
+        from perfmetrics.transports import TCPStatsdClient
+        from perfmetrics.transports import statsd_client_from_uri
+        obj = statsd_client_from_uri('statsd+tcp://localhost:8125?packet_size=1024')
+        self.addCleanup(obj.close)
+        self.assertIsInstance(obj, TCPStatsdClient)
+        self.assertEqual(obj.addr, ('localhost', 8125))
+        self.assertEqual(obj.packet_size, 1024)
+
+
+class TestShardedStatsdClient(unittest.TestCase):
+
+    def setUp(self):
+        self.receivers = []
+        for _ in range(3):
+            receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.addCleanup(receiver.close)
+            receiver.bind(('127.0.0.1', 0))
+            receiver.settimeout(5)
+            self.receivers.append(receiver)
+
+    def _makeOne(self, **kwargs):
+        from perfmetrics.transports import ShardedStatsdClient
+        inst = ShardedStatsdClient(
+            [r.getsockname() for r in self.receivers],
+            **kwargs)
+        self.addCleanup(inst.close)
+        return inst
+
+    def _receiver_for(self, client, stat):
+        sub = client._client_for(stat.encode('ascii') + b':')
+        for receiver in self.receivers:
+            if receiver.getsockname() == sub.addr:
+                return receiver
+        raise AssertionError("Unknown client") # pragma: no cover
+
+    def test_provides(self):
+        assert_that(self._makeOne(), validly_provides(IStatsdClient))
+
+    def test_stats_go_to_one_server(self):
+        client = self._makeOne(prefix='foo')
+        stats = ['stat%d' % i for i in range(30)]
+        # The stats are divided among all the servers.
+        owners = {self._receiver_for(client, 'foo.' + stat) for stat in stats}
+        self.assertEqual(len(owners), 3)
+
+        for stat in stats:
+            client.incr(stat)
+            client.timing(stat, 5)
+            receiver = self._receiver_for(client, 'foo.' + stat)
+            self.assertEqual(receiver.recv(1024), b'foo.' + stat.encode('ascii') + b':1|c')
+            self.assertEqual(receiver.recv(1024), b'foo.' + stat.encode('ascii') + b':5|ms')
+
+    def test_sendbuf_groups_by_server(self):
+        client = self._makeOne(packet_size=512)
+        stats = ['stat%d' % i for i in range(30)]
+        buf = []
+        for stat in stats:
+            client.incr(stat, buf=buf)
+        client.sendbuf(buf)
+        client.sendbuf([])
+        client.flush()
+        expected = {}
+        for stat in stats:
+            receiver = self._receiver_for(client, stat)
+            expected.setdefault(receiver, []).append(stat.encode('ascii') + b':1|c')
+        for receiver, lines in expected.items():
+            self.assertEqual(receiver.recv(1024), b'\n'.join(lines))
+
+    def test_mapping_is_cached_and_bounded(self):
+        client = self._makeOne()
+        client.max_cached_stats = 5
+        first = client._client_for(b'a:1|c')
+        self.assertIs(client._server_cache[b'a'], first)
+        self.assertIs(client._client_for(b'a:2|c'), first)
+        for i in range(4):
+            client._client_for(b'b%d:1|c' % i)
+        self.assertEqual(len(client._server_cache), 5)
+        client._client_for(b'c:1|c')
+        self.assertEqual(list(client._server_cache), [b'c'])
+
+    def test_few_stats_move(self):
+        client = self._makeOne()
+        names = [b'stat%d' % i for i in range(1000)]
+        before = {name: client._client_for(name + b':') for name in names}
+
+        # Adding a fourth server moves only stats that it now owns, and
+        # roughly a quarter of them.
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(receiver.close)
+        receiver.bind(('127.0.0.1', 0))
+        client.add_server(*receiver.getsockname())
+        client.add_server(*receiver.getsockname()) # Does nothing
+        added = client.clients[receiver.getsockname()]
+        after = {name: client._client_for(name + b':') for name in names}
+        moved = [name for name in names if after[name] is not before[name]]
+        self.assertTrue(all(after[name] is added for name in moved))
+        self.assertTrue(150 < len(moved) < 350, len(moved))
+
+        # Removing it moves them back.
+        client.remove_server(*receiver.getsockname())
+        client.remove_server(*receiver.getsockname()) # Does nothing
+        self.assertEqual(before, {name: client._client_for(name + b':') for name in names})
+
+    def test_no_servers(self):
+        from perfmetrics.transports import ShardedStatsdClient
+        client = ShardedStatsdClient(())
+        client.incr('a')
+        client.sendbuf(['a:1|c'])
+        client.flush()
+        client.close()
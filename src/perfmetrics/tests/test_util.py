@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+
+class TestMarkCoroutineFunction(unittest.TestCase):
+
+    def _marked(self):
+        from perfmetrics._util import mark_coroutine_function
+
+        class Callable(object):
+            async def __call__(self):
+                """Does nothing"""
+
+        obj = Callable()
+        self.assertIs(mark_coroutine_function(obj), obj)
+        return obj
+
+    def _replace_markcoroutinefunction(self, replacement):
+        # For the rest of the test, inspect.markcoroutinefunction (new
+        # in Python 3.12) is *replacement*, or missing if that's None.
+        # Returns the original, or None.
+        import inspect
+        namespace = vars(inspect)
+        original = namespace.pop('markcoroutinefunction', None)
+        self.addCleanup(namespace.update,
+                        {'markcoroutinefunction': original} if original else {})
+        self.addCleanup(namespace.pop, 'markcoroutinefunction', None)
+        if replacement is not None:
+            namespace['markcoroutinefunction'] = replacement
+        return original
+
+    def test_without_markcoroutinefunction(self):
+        import asyncio
+        from perfmetrics._util import is_coroutine_function
+        self._replace_markcoroutinefunction(None)
+        obj = self._marked()
+        self.assertTrue(asyncio.iscoroutinefunction(obj))
+        self.assertTrue(is_coroutine_function(obj))
+        self.assertFalse(is_coroutine_function(lambda: None))
+
+    def test_with_markcoroutinefunction(self):
+        marked = []
+        def markcoroutinefunction(obj):
+            marked.append(obj)
+            return original(obj) if original is not None else obj
+        original = self._replace_markcoroutinefunction(markcoroutinefunction)
+        obj = self._marked()
+        self.assertEqual(marked, [obj])
@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+"""
+Statsd clients that send somewhere other than a single UDP address,
+and creating any of the clients from a URI.
+
+.. versionadded:: 4.4.0
+   The names here are also available from :mod:`perfmetrics.statsd`,
+   where `statsd_client_from_uri` used to be defined.
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import socket
+import threading
+from bisect import bisect_left
+from collections import deque
+from hashlib import md5
+from time import monotonic
+from urllib.parse import parse_qsl
+from urllib.parse import urlsplit
+from urllib.parse import uses_query
+
+from .interfaces import IStatsdClient
+from .interfaces import classImplements
+from .statsd import StatsdClient
+from .statsd import _AbstractStatsdClient
+from .statsd import _encoded_lines
+
+__all__ = [
+    'UnixStatsdClient',
+    'TCPStatsdClient',
+    'ShardedStatsdClient',
+    'statsd_client_from_uri',
+]
+
+for _scheme in ('statsd', 'statsd+tcp', 'statsd+unix', 'unix', 'prometheus'):
+    if _scheme not in uses_query:  # pragma: no cover
+        uses_query.append(_scheme)
+del _scheme
+
+def statsd_client_from_uri(uri):
+    """
+    Create and return :class:`perfmetrics.statsd.StatsdClient`.
+
+    A typical URI is ``statsd://localhost:8125``. An optional query
+    parameter is ``prefix``. The default prefix is an empty string.
+
+    The query parameters ``packet_size`` and ``flush_interval`` enable
+    and tune packet coalescing; see :class:`~perfmetrics.statsd.StatsdClient`. For
+    example, ``statsd://localhost:8125?packet_size=1432`` gathers
+    metrics into datagrams of at most 1432 bytes.
+
+    The ``timing_precision`` and ``timing_unit`` query parameters
+    control how timings are formatted; for example,
+    ``statsd://localhost:8125?timing_precision=3`` sends timings in
+    milliseconds with three decimal places.
+
+    The ``nonblocking`` and ``sndbuf`` query parameters select the
+    non-blocking socket mode of :class:`~perfmetrics.statsd.StatsdClient`, as in
+    ``statsd://localhost:8125?nonblocking=true&sndbuf=1048576``. The
+    ``resolve_interval`` query parameter makes it look up the host
+    name again periodically.
+
+    If the ``aggregate_interval`` query parameter is given, the
+    result is a :class:`perfmetrics.aggregate.AggregatingStatsdClient`
+    that sends a summary of the metrics it collected every that many
+    seconds. Unless ``packet_size`` is also given, the summary is
+    coalesced into packets of 1432 bytes. Similarly, the
+    ``shared_interval`` query parameter creates a
+    :class:`perfmetrics.shm.SharedMemoryStatsdClient`, which
+    aggregates counters and timers from all the processes forked
+    after it is created.
+
+    To send to a statsd server listening on a local Unix domain
+    datagram socket, use a URI like
+    ``statsd+unix:///var/run/statsd.sock`` (or just
+    ``unix:///var/run/statsd.sock``). This creates a
+    :class:`UnixStatsdClient`.
+
+    To send newline-framed metrics over a persistent TCP connection,
+    use a URI like ``statsd+tcp://localhost:8125``. This creates a
+    :class:`TCPStatsdClient`.
+
+    A ``prometheus://`` URI creates a
+    :class:`perfmetrics.prometheus.PrometheusStatsdClient`, which keeps
+    metrics for Prometheus to scrape; its query parameters are
+    ``prefix`` and ``buckets`` (comma-separated). If the URI has a
+    port, as in ``prometheus://0.0.0.0:9102``, the metrics are served
+    on it by :func:`perfmetrics.prometheus.start_prometheus_server`.
+
+    To divide the stats among several statsd servers, list them
+    separated by commas, as in ``statsd://host1:8125,host2:8125``
+    (the port defaults to 8125). This creates a
+    :class:`ShardedStatsdClient`; the other query parameters apply to
+    each server.
+
+    .. versionchanged:: 4.4.0
+       Accept the ``packet_size``, ``flush_interval`` and
+       ``aggregate_interval`` query parameters.
+    .. versionchanged:: 4.4.0
+       Accept ``statsd+unix://``, ``unix://`` and ``statsd+tcp://`` URIs.
+    .. versionchanged:: 4.4.0
+       Accept the ``timing_precision`` and ``timing_unit`` query
+       parameters.
+    .. versionchanged:: 4.4.0
+       Accept several comma-separated servers.
+    .. versionchanged:: 4.4.0
+       Accept the ``nonblocking``, ``sndbuf`` and ``resolve_interval``
+       query parameters.
+    .. versionchanged:: 4.4.0
+       Accept the ``shared_interval`` query parameter.
+    .. versionchanged:: 4.4.0
+       Accept ``prometheus://`` URIs.
+    """
+    parts = urlsplit(uri)
+    if parts.scheme not in ('statsd', 'statsd+tcp', 'statsd+unix', 'unix', 'prometheus'):
+        raise ValueError("URI scheme not supported: %s" % uri)
+
+    kw = {}
+    if parts.query:
+        kw.update(parse_qsl(parts.query))
+    if parts.scheme == 'prometheus':
+        return _prometheus_client_from_uri(parts, kw)
+    aggregate_interval = kw.pop('aggregate_interval', None)
+    shared_interval = kw.pop('shared_interval', None)
+    if aggregate_interval is not None or shared_interval is not None:
+        kw.setdefault('packet_size', 1432)
+    client = _transport_client_from_uri(parts, kw)
+    if aggregate_interval is not None:
+        from .aggregate import AggregatingStatsdClient
+        client = AggregatingStatsdClient(client, aggregate_interval)
+    if shared_interval is not None:
+        from .shm import SharedMemoryStatsdClient
+        client = SharedMemoryStatsdClient(client, shared_interval)
+    return client
+
+
+def _prometheus_client_from_uri(parts, kw):
+    from .prometheus import PrometheusStatsdClient
+    from .prometheus import start_prometheus_server
+    if 'buckets' in kw:
+        kw['buckets'] = [b for b in kw['buckets'].split(',') if b]
+    client = PrometheusStatsdClient(**kw)
+    if parts.port is not None:
+        start_prometheus_server(client, parts.port, parts.hostname or '')
+    return client
+
+
+def _transport_client_from_uri(parts, kw):
+    if parts.scheme == 'statsd' and ',' in parts.netloc:
+        servers = []
+        for netloc in parts.netloc.split(','):
+            server = urlsplit('//' + netloc)
+            servers.append((server.hostname, server.port or 8125))
+        return ShardedStatsdClient(servers, **kw)
+    if parts.scheme == 'statsd':
+        return StatsdClient(parts.hostname, parts.port, **kw)
+    if parts.scheme == 'statsd+tcp':
+        return TCPStatsdClient(parts.hostname, parts.port, **kw)
+    return UnixStatsdClient(parts.path, **kw)
+
+
+class UnixStatsdClient(StatsdClient):
+    """
+    Send packets to a statsd server listening on a Unix domain
+    datagram socket at *path*.
+
+    When the server runs on the same host, this avoids the IP stack.
+    Datagrams can be much larger than over the network (consider a
+    *packet_size* of 8192 or more), and if the server falls behind,
+    sending blocks instead of silently dropping packets. Sending to
+    a path that no server is listening on logs an error, just like
+    other failures to send.
+
+    This is not available on platforms without ``AF_UNIX``.
+
+    .. versionadded:: 4.4.0
+    """
+
+    def __init__(self, path, prefix='', **kwargs):
+        self.path = path
+        super().__init__(None, None, prefix, **kwargs)
+
+    def _open_socket(self):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM), self.path
+
+    def resolve(self):
+        """
+        Do nothing: a path has no host name to look up, so
+        *resolve_interval* has no effect.
+        """
+
+
+class TCPStatsdClient(StatsdClient):
+    """
+    Send newline-framed metrics to a statsd server over a persistent
+    TCP connection.
+
+    Lines are coalesced exactly as with :class:`~perfmetrics.statsd.StatsdClient`, except
+    that coalescing is always enabled (*packet_size* defaults to 8192
+    bytes), so each ``sendall`` writes many metrics at once.
+
+    Connecting and sending are left to the background thread (or to
+    :meth:`flush` and :meth:`close`), so the threads recording
+    metrics never wait for the network; they only add full packets
+    to the data waiting to be sent and wake the thread up.
+
+    The connection is opened when the first data is sent. If
+    connecting fails, the data is kept, and another attempt is made
+    when the thread next sends once a delay has passed. The delay
+    doubles after each failure, up to *max_backoff* seconds, and
+    resets once data is sent successfully. At most *max_buffer* bytes
+    are kept while the server is unreachable; beyond that, the oldest
+    data is discarded and counted in the ``dropped`` attribute. If
+    sending fails, the connection is closed, and since some of the
+    data may already have been written, the data being sent is
+    discarded and counted in ``dropped`` rather than sent twice.
+
+    Connecting and sending give up after *timeout* seconds.
+
+    Other keyword arguments are as for :class:`~perfmetrics.statsd.StatsdClient`.
+
+    .. versionadded:: 4.4.0
+    """
+
+    #: The delay before the first reconnection attempt.
+    min_backoff = 0.1
+
+    def __init__(self, host='localhost', port=8125, prefix='',
+                 packet_size=8192, max_buffer=1024 * 1024,
+                 max_backoff=30.0, timeout=5.0, **kwargs):
+        self.max_buffer = int(max_buffer)
+        self.max_backoff = float(max_backoff)
+        self.timeout = float(timeout)
+        self._pending = deque()
+        self._pending_size = 0
+        self._backoff = 0.0
+        self._retry_at = 0.0
+        # Guards _pending.
+        self._send_lock = threading.Lock()
+        # Held while connecting and sending.
+        self._drain_lock = threading.Lock()
+        if int(packet_size) <= 0:
+            packet_size = 8192
+        super().__init__(host, port, prefix, packet_size, **kwargs)
+
+    def _open_socket(self):
+        # Connect lazily.
+        return None, (self.host, int(self.port))
+
+    def _connect(self):
+        return socket.create_connection(self.addr, self.timeout)
+
+    def resolve(self):
+        """
+        Do nothing: the host name is looked up each time a
+        connection is opened, so *resolve_interval* has no effect.
+        """
+
+    def _reopen_socket(self):
+        # Connect again when there's something to send.
+        self._send_lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+        self._pending.clear()
+        self._pending_size = 0
+        self._backoff = 0.0
+        self._retry_at = 0.0
+        sock = self.udp_sock
+        self.udp_sock = None
+        if sock is not None:
+            sock.close()
+
+    def close(self):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.close`.
+        """
+        super().close()
+        with self._send_lock:
+            self._pending.clear()
+            self._pending_size = 0
+
+    def flush(self):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.flush`.
+
+        This also retries sending data that previously could not be
+        sent, if the reconnection delay has passed.
+        """
+        super().flush()
+        if self._pending:
+            self._drain()
+
+    def _send_packet(self, packet):
+        self.send_packets((packet,))
+
+    def send_packets(self, packets):
+        """
+        Frame the byte strings in *packets* and add them to the data
+        to write with the next ``sendall``.
+        """
+        with self._send_lock:
+            for packet in packets:
+                self._pending.append(packet + b'\n')
+                self._pending_size += len(packet) + 1
+            self._discard_excess()
+        if self._sender is not threading.current_thread():
+            self._wakeup.set()
+
+    def _drain(self):
+        # Send the pending data. Other threads can keep adding to it
+        # meanwhile.
+        with self._drain_lock:
+            sock = self.udp_sock
+            if sock is None:
+                now = monotonic()
+                if now < self._retry_at:
+                    return
+                try:
+                    sock = self._connect()
+                except IOError:
+                    self._failed(now, "Failed to connect to statsd")
+                    return
+                self.udp_sock = sock
+
+            with self._send_lock:
+                data = b''.join(self._pending)
+                self._pending.clear()
+                self._pending_size = 0
+            try:
+                sock.sendall(data)
+            except IOError:
+                self.udp_sock = None
+                sock.close()
+                self.dropped += data.count(b'\n')
+                self._failed(monotonic(), "Failed to send to statsd")
+                return
+            self._backoff = 0.0
+
+    def _failed(self, now, message):
+        self.errors += 1
+        self.log.exception(message)
+        self._backoff = min(max(self._backoff * 2, self.min_backoff), self.max_backoff)
+        self._retry_at = now + self._backoff
+
+    def _discard_excess(self):
+        # The caller must hold the send lock.
+        pending = self._pending
+        while self._pending_size > self.max_buffer:
+            chunk = pending.popleft()
+            self._pending_size -= len(chunk)
+            self.dropped += chunk.count(b'\n')
+
+
+def _ring_point(key):
+    # A position on the hash ring. MD5 is only used because it
+    # spreads keys evenly.
+    return int.from_bytes(md5(key, usedforsecurity=False).digest()[:8], 'big')
+
+
+class ShardedStatsdClient(_AbstractStatsdClient):
+    """
+    Send metrics to several statsd servers, each stat always going to
+    the same server.
+
+    Aggregating servers such as statsd need to see every sample of a
+    stat to compute correct counts, rates and percentiles. This
+    client divides the stats among *servers*, a sequence of ``(host,
+    port)`` pairs, by consistent hashing: each server is given
+    :attr:`replicas` points on a ring of hash values, and a stat
+    belongs to the server owning the first point at or after the
+    hash of its (prefixed) name. Adding or removing a server with
+    :meth:`add_server` or :meth:`remove_server` only moves about
+    ``1/len(servers)`` of the stats. The server chosen for each stat
+    is cached, so the hash is only computed the first time a stat is
+    sent.
+
+    Each server has its own :class:`~perfmetrics.statsd.StatsdClient`, created with the
+    other keyword arguments (such as *packet_size*,
+    *flush_interval* and *queue_size*), so lines are coalesced and
+    queued separately for each destination. Lines passed to
+    :meth:`sendbuf` are divided among the servers.
+
+    Create one from a URI by listing the servers separated by
+    commas, as in ``statsd://host1:8125,host2:8125``.
+
+    .. versionadded:: 4.4.0
+    """
+
+    #: The number of points each server has on the hash ring. More
+    #: points divide the stats more evenly.
+    replicas = 160
+
+    def __init__(self, servers, prefix='', timing_unit='ms', timing_precision=0,
+                 **kwargs):
+        super().__init__(prefix, timing_unit, timing_precision)
+        self._client_kwargs = kwargs
+        #: Maps ``(host, port)`` to the `~perfmetrics.statsd.StatsdClient` for that server.
+        self.clients = {}
+        #: The sorted points on the ring, and the client for each.
+        self._ring = ([], [])
+        self._server_cache = {}
+        for host, port in servers:
+            self.add_server(host, port)
+
+    def _make_client(self, host, port):
+        return StatsdClient(host, port, **self._client_kwargs)
+
+    def add_server(self, host, port):
+        """
+        Start sending a share of the stats to the server at *host*
+        and *port*.
+        """
+        key = (host, int(port))
+        if key not in self.clients:
+            self.clients[key] = self._make_client(*key)
+            self._build_ring()
+
+    def remove_server(self, host, port):
+        """
+        Stop sending stats to the server at *host* and *port*; its
+        stats are divided among the remaining servers. Anything its
+        client still holds is flushed.
+        """
+        client = self.clients.pop((host, int(port)), None)
+        if client is not None:
+            self._build_ring()
+            client.close()
+
+    def _build_ring(self):
+        points = []
+        for (host, port), client in self.clients.items():
+            server = ('%s:%d' % (host, port)).encode('utf-8')
+            for i in range(self.replicas):
+                points.append((_ring_point(b'%s-%d' % (server, i)), server, client))
+        # Ties (which are very unlikely) are broken by server name so
+        # the order servers are added in doesn't matter.
+        points.sort(key=lambda point: point[:2])
+        # Replace the ring with one assignment so other threads never
+        # see the points of one ring with the clients of another; then
+        # forget where stats used to go.
+        self._ring = (
+            [point[0] for point in points],
+            [point[2] for point in points],
+        )
+        self._server_cache = {}
+
+    def _client_for(self, line):
+        # Return the client for the encoded *line*, whose name ends at
+        # the first colon.
+        name = line[:line.find(b':')]
+        cache = self._server_cache
+        try:
+            return cache[name]
+        except KeyError:
+            pass
+        points, clients = self._ring
+        if not points:
+            return None
+        index = bisect_left(points, _ring_point(name))
+        client = clients[index if index < len(points) else 0]
+        if len(cache) >= self.max_cached_stats:
+            cache.clear()
+        cache[name] = client
+        return client
+
+    def close(self):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.close`.
+        """
+        for client in list(self.clients.values()):
+            client.close()
+
+    def flush(self):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.flush`.
+        """
+        for client in list(self.clients.values()):
+            client.flush()
+
+    def _send(self, data):
+        client = self._client_for(data)
+        if client is not None:
+            client._send(data) # pylint:disable=protected-access
+
+    def sendbuf(self, buf):
+        """
+        See :meth:`perfmetrics.interfaces.IStatsdClient.sendbuf`.
+
+        The lines are grouped by server, and each server's lines are
+        sent together.
+        """
+        if not buf:
+            return
+        by_client = {}
+        for line in _encoded_lines(buf):
+            client = self._client_for(line)
+            if client is not None:
+                try:
+                    by_client[client].append(line)
+                except KeyError:
+                    by_client[client] = [line]
+        for client, lines in by_client.items():
+            client.sendbuf(lines)
+
+classImplements(ShardedStatsdClient, IStatsdClient)
@@ -7,7 +7,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from .statsd import statsd_client_from_uri
+from .transports import statsd_client_from_uri
 from .clientstack import client_stack as statsd_client_stack
 from .metric import Metric
 